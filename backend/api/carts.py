@@ -1,11 +1,24 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, make_response
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import db, Cart
 from datetime import datetime
 from service.cart_service import CartService
 from service.product_service import ProductService 
+from service.recommendation_service import RecommendationService
 from service.discount_service import DiscountService
 carts_bp = Blueprint('carts', __name__, url_prefix='/carts')
+def _cart_response(cart, etag):
+    """購物車回應帶 ETag；前端帶相同的 If-None-Match 時回 304、不回內容"""
+    if not cart:
+        return jsonify({"cart": None, "items": []})
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = jsonify(cart)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"  # 瀏覽器每次都要帶 If-None-Match 回來驗證
+    return response
+
 #用戶查詢購物車
 @carts_bp.route('/<int:user_id>', methods=['GET'])
 @jwt_required()
@@ -23,9 +36,14 @@ def get_cart(user_id):
         type: integer
         required: true
         description: 用戶ID
+      - in: header
+        name: If-None-Match
+        type: string
+        required: false
+        description: 上次回應的 ETag，購物車沒變時回 304
     responses:
       200:
-        description: 購物車資訊
+        description: 購物車資訊（回應 header 帶 ETag）
         schema:
           type: object
           properties:
@@ -52,6 +70,8 @@ def get_cart(user_id):
             total:
               type: number
               example: 199.98
+      304:
+        description: 購物車沒有變動（If-None-Match 與目前的 ETag 相同）
       403:
         description: 僅能查詢本人
         schema:
@@ -70,10 +90,8 @@ def get_cart(user_id):
     current_user = get_jwt_identity()
     if int(current_user) != user_id:
         return jsonify({"error": "Permission denied"}), 403
-    cart = CartService.get_cart(user_id=user_id)
-    if not cart:
-        return jsonify({"cart": None, "items": []})
-    return jsonify(cart)
+    cart, etag = CartService.get_cart_snapshot(user_id=user_id)
+    return _cart_response(cart, etag)
 
 
 #用戶加入商品至購物車
@@ -484,8 +502,8 @@ def recommend_for_cart(user_id):
         return jsonify({"error": "Permission denied"}), 403
 
     limit = request.args.get('limit', 5, type=int)
-    products = ProductService.recommend_for_cart(user_id, limit)
-    return jsonify([p.to_dict() for p in products])
+    products = RecommendationService.get("cart", user_id, limit)
+    return jsonify(ProductService.to_dict_list(products))
 
 #協同過濾推薦購物車商品
 @carts_bp.route('/<int:user_id>/recommend/collaborative', methods=['GET'])
@@ -548,8 +566,8 @@ def recommend_cart_collaborative(user_id):
         return jsonify({"error": "Permission denied"}), 403
 
     limit = request.args.get('limit', 5, type=int)
-    products = ProductService.recommend_for_cart_collaborative(user_id, limit)
-    return jsonify([p.to_dict() for p in products])
+    products = RecommendationService.get("collaborative", user_id, limit)
+    return jsonify(ProductService.to_dict_list(products))
 
 @carts_bp.route('/<int:user_id>/apply_discount', methods=['POST'])
 @jwt_required()
@@ -617,10 +635,8 @@ def apply_discount(user_id):
 # 查詢訪客購物車
 @carts_bp.route('/guest/<string:guest_id>', methods=['GET'])
 def get_cart_guest(guest_id):
-    cart = CartService.get_cart(guest_id=guest_id)
-    if not cart:
-        return jsonify({"cart": None, "items": []})
-    return jsonify(cart)
+    cart, etag = CartService.get_cart_snapshot(guest_id=guest_id)
+    return _cart_response(cart, etag)
 
 # 加入商品至訪客購物車
 @carts_bp.route('/guest/<string:guest_id>', methods=['POST'])
@@ -1,13 +1,33 @@
 import os
 import requests
-from flask import Blueprint, request, render_template
+import json
+from flask import Blueprint, request, render_template, jsonify, current_app
 from models import db, User  
-from utils.line_bot import push_message,push_flex_message
-from linebot.models import FlexSendMessage
 from config import get_current_config
-from utils.line_bot import push_message, push_flex_message
+from service.line_event_service import LineEventService, get_line_dispatcher, verify_signature
+from service.line_user_resolver import get_line_user_resolver
+from utils.line_client import get_line_client
+from flask_jwt_extended import jwt_required
+from api.decorate import admin_required
 linemessage_bp = Blueprint('linemessage', __name__, url_prefix='/linemessage')
 
+@linemessage_bp.route("/stats", methods=["GET"])
+@jwt_required()
+@admin_required
+def line_client_stats():
+    """
+    LINE API 呼叫統計（需管理員，只含目前這個 process）
+    ---
+    tags:
+      - linemessage
+    security:
+      - Bearer: []
+    responses:
+      200:
+        description: 請求數、失敗數、重試數、限流等待秒數、延遲
+    """
+    return jsonify(get_line_client().stats())
+
 @linemessage_bp.route("/blinding")
 def line_login_callback():
     code = request.args.get('code')
@@ -57,10 +77,16 @@ def line_login_callback():
         pass
 
     if user:
+        old_line_user_id = user.line_user_id
         user.line_user_id = line_user_id
         user.line_display_name = display_name   # 如有欄位
         user.line_picture_url = picture_url     # 如有欄位
         db.session.commit()
+        # commit 後才讓 LINE userId → 會員的快取失效（換綁時舊的 LINE userId 也要失效）
+        resolver = get_line_user_resolver()
+        resolver.invalidate(line_user_id)
+        if old_line_user_id:
+            resolver.invalidate(old_line_user_id)
         return render_template("line_bind_success.html", user=user, display_name=display_name)
     else:
         return f"綁定失敗，請重新登入網站。<br>您的 LINE userId：{line_user_id}"
@@ -82,70 +108,24 @@ def get_jwt_token_for_linebot():
         print(f"取得 JWT token 失敗: {e}")
         return None
     
-from utils.line_bot import build_order_detail_flex,build_order_list_flex ,build_product_list_flex # 路徑依你實際目錄
 @linemessage_bp.route("/webhook", methods=["POST"])
 def line_webhook():
+    """
+    LINE webhook：驗證簽章後把事件交給背景 worker，立刻回 200（LINE 逾時會重送）
+    事件的查詢與回覆在 service/line_event_service.py
+    """
+    body = request.get_data()
+    if not verify_signature(current_app.config.get("LINE_CHANNEL_SECRET"), body, request.headers.get("X-Line-Signature")):
+        return "Invalid signature", 400
     try:
-        body = request.json
-        events = body.get("events", [])
-        for event in events:
-            if event.get("type") == "message" and event["message"].get("type") == "text":
-                line_user_id = event["source"]["userId"]
-                msg = event["message"]["text"].strip()
-                user = User.query.filter_by(line_user_id=line_user_id).first()
-                if not user:
-                    push_message(line_user_id, "請先到會員中心綁定 LINE 帳號")
-                    continue
-                 # 推薦商品（個人化，不管有無都給5個）
-                if msg.startswith("推薦商品"):
-                    from service.product_service import ProductService
-                    recommend_limit = 5
-                    products = ProductService.recommend_for_user(user.id, recommend_limit)
-                    if not products or len(products) < recommend_limit:
-                        # 不夠就用熱門/最新補滿
-                        # 可以改成 get_top_products、get_products 等
-                        products = ProductService.get_top_products(limit=recommend_limit)
-                    flex_content = build_product_list_flex(products)
-                    push_flex_message(line_user_id, flex_content, alt_text="推薦商品")
-
-                # 歷史訂單列表
-                elif msg in ("查詢歷史訂單","查詢訂單", "查詢我的訂單",  "我的訂單", "查訂單紀錄"):
-                    from service.order_service import OrderService
-                    
-                    orders = OrderService.get_user_orders(user.id, page=1, per_page=5)
-                    if not orders.items:
-                        push_message(line_user_id, "目前沒有訂單紀錄")
-                        continue
-                    flex_content = build_order_list_flex(orders.items)
-                    push_flex_message(line_user_id, flex_content, alt_text="訂單列表")
-                # 單筆訂單明細
-                elif msg.startswith("查訂單明細#"):
-                    try:
-                        order_id = int(msg.split("#")[1])
-                        from service.order_service import OrderService
-                        # 直接查 dict 版本
-                        order_detail = OrderService.get_order_detail(order_id)
-                        flex_content = build_order_detail_flex(order_detail)
-                        push_flex_message(line_user_id, flex_content, alt_text="訂單明細")
-                    except Exception:
-                        push_message(line_user_id, "查詢訂單明細失敗，請稍後再試")
-                elif msg.startswith("聯絡客服"):
-                        push_message(
-                            line_user_id,
-                            "聯絡客服資訊如下：\n"
-                            "\n"
-                            "📧 Email：talen3031@gmail.com\n"
-                            "\n"
-                            "📱 手機：0923956156\n"
-                            "\n"
-                            "💬 或至官網客服聊天室詢問(需登入)：\n"
-                            "https://ecommerce-frontend-production-d012.up.railway.app"
-                        )
-                else:
-                    push_message(line_user_id, "你好")
-        return "ok"
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print("Webhook Exception:", e)
-        return str(e), 500
+        events = json.loads(body).get("events", [])
+    except ValueError:
+        return "Invalid body", 400
+    dispatcher = get_line_dispatcher(current_app._get_current_object())
+    for event in events:
+        if dispatcher.is_duplicate(event):
+            continue
+        if not dispatcher.submit(event):
+            # 佇列滿了：在請求內直接處理，不丟事件
+            LineEventService.handle(event)
+    return "ok"
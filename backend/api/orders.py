@@ -32,6 +32,11 @@ def get_my_orders():
         required: false
         default: 10
         description: 每頁筆數
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: keyset 分頁游標；帶上 cursor（第一頁給空字串）改用游標分頁，回傳 next_cursor、不回傳 total/pages
     responses:
       200:
         description: 訂單列表
@@ -54,9 +59,12 @@ def get_my_orders():
     current_user_id = int(get_jwt_identity())
     page = request.args.get('page', default=1, type=int)
     per_page = request.args.get('per_page', default=10, type=int)
-    orders_page = OrderService.get_user_orders(current_user_id, page=page, per_page=per_page)
+    cursor = request.args.get('cursor', type=str)
+    orders_page = OrderService.get_user_orders(current_user_id, page=page, per_page=per_page, cursor=cursor)
 
     result = [order.to_dict() for order in orders_page.items]
+    if cursor is not None:
+        return jsonify({"orders": result, "per_page": orders_page.per_page, "next_cursor": orders_page.next_cursor})
     return jsonify({
         "orders": result,
         "total": orders_page.total,
@@ -118,6 +126,11 @@ def get_all_orders():
         required: false
         default: 10
         description: 每頁筆數
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: keyset 分頁游標；帶上 cursor（第一頁給空字串）改用游標分頁，回傳 next_cursor、不回傳 total/pages
     responses:
       200:
         description: 訂單列表
@@ -141,9 +154,12 @@ def get_all_orders():
     """
     page = request.args.get('page', default=1, type=int)
     per_page = request.args.get('per_page', default=10, type=int)
-    orders_page = OrderService.get_all_orders(page=page, per_page=per_page)
+    cursor = request.args.get('cursor', type=str)
+    orders_page = OrderService.get_all_orders(page=page, per_page=per_page, cursor=cursor)
 
     result = [order.to_dict(include_user=True) for order in orders_page.items]
+    if cursor is not None:
+        return jsonify({"orders": result, "per_page": orders_page.per_page, "next_cursor": orders_page.next_cursor})
     return jsonify({
         "orders": result,
         "total": orders_page.total,
@@ -6,9 +6,12 @@ from api.decorate import admin_required
 from models import db, Product  
 from service.product_service import ProductService
 from service.audit_service import AuditService
+from service.recommendation_service import RECOMMEND_KINDS, PENDING_NAME as RECOMMEND_PENDING_NAME
 from datetime import datetime
 # 引入 cache 實體
-from cache import cache
+from cache import cache, make_key, set_tagged, product_tag, category_tag, get_stats, count_pending
+
+PRODUCT_LIST_TIMEOUT = 300
 
 
 """
@@ -39,7 +42,6 @@ products_bp = Blueprint('products', __name__, url_prefix='/products')
 
 # 查詢所有商品
 @products_bp.route('', methods=['GET'])
-@cache.cached(timeout=300, query_string=True)   # <== 這行才是真正快取
 def get_products():
     """
     查詢所有商品
@@ -56,7 +58,12 @@ def get_products():
         name: keyword
         type: string
         required: false
-        description: 關鍵字模糊搜尋商品標題
+        description: 關鍵字搜尋商品標題與描述（全文檢索，依相關度排序）
+      - in: query
+        name: cursor
+        type: string
+        required: false
+        description: keyset 分頁游標；帶上 cursor（第一頁給空字串）改用游標分頁，回傳 next_cursor、不回傳 total/pages
     responses:
       200:
         description: 商品列表
@@ -65,6 +72,12 @@ def get_products():
           items:
             $ref: '#/definitions/Product'
     """
+    # 共用快取（Redis），key 依查詢參數；掛上分類與頁內商品的標籤，商品異動時只失效相關列表
+    cache_key = make_key("products:list", request.args.items(multi=True))
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return jsonify(cached)
+
     category_id = request.args.get('category_id', type=int)
     keyword = request.args.get('keyword', type=str)
     min_price = request.args.get('min_price', type=float)
@@ -72,6 +85,7 @@ def get_products():
     
     page = request.args.get('page', default=1, type=int)
     per_page = request.args.get('per_page', default=10, type=int)
+    cursor = request.args.get('cursor', type=str)
 
     products_page = ProductService.search(
         category_id = category_id, 
@@ -79,17 +93,28 @@ def get_products():
         min_price=min_price, 
         max_price=max_price,
         page=page,
-        per_page=per_page
+        per_page=per_page,
+        cursor=cursor
     )
-    result = [product.to_dict() for product in products_page.items]
+    result = ProductService.to_dict_list(products_page.items)
 
-    return jsonify({
-        "products": result,
-        "total": products_page.total,
-        "page": products_page.page,   #page 當前頁，pages 總頁數，total 總商品數，per_page 每頁幾筆
-        "per_page": products_page.per_page,
-        "pages": products_page.pages
-    })
+    if cursor is not None:
+        data = {
+            "products": result,
+            "per_page": products_page.per_page,
+            "next_cursor": products_page.next_cursor   # None 表示沒有下一頁
+        }
+    else:
+        data = {
+            "products": result,
+            "total": products_page.total,
+            "page": products_page.page,   #page 當前頁，pages 總頁數，total 總商品數，per_page 每頁幾筆
+            "per_page": products_page.per_page,
+            "pages": products_page.pages
+        }
+    tags = [category_tag(category_id)] + [product_tag(p["id"]) for p in result]
+    set_tagged(cache_key, data, tags, timeout=PRODUCT_LIST_TIMEOUT)
+    return jsonify(data)
 
 @products_bp.route('/admin', methods=['GET'])
 @jwt_required()
@@ -111,6 +136,11 @@ def get_products_admin():
         name: per_page
         type: integer
         required: false
+      - in: query
+        name: cursor
+        type: string
+        required: false
+        description: keyset 分頁游標；帶上 cursor（第一頁給空字串）改用游標分頁，回傳 next_cursor、不回傳 total/pages
     responses:
       200:
         description: 所有商品列表
@@ -126,8 +156,11 @@ def get_products_admin():
     """
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
-    products_page = ProductService.search_all_admin(page=page, per_page=per_page)
-    products = [p.to_dict() for p in products_page.items]
+    cursor = request.args.get('cursor', type=str)
+    products_page = ProductService.search_all_admin(page=page, per_page=per_page, cursor=cursor)
+    products = ProductService.to_dict_list(products_page.items)
+    if cursor is not None:
+        return jsonify({"products": products, "per_page": per_page, "next_cursor": products_page.next_cursor})
     return jsonify({"products": products, "total": products_page.total, "page": page, "per_page": per_page})
 
 # 查詢單一商品
@@ -165,13 +198,72 @@ def get_product(product_id):
       404:
         description: 商品不存在
     """
-    product = Product.get_active_by_product_id(product_id)
+    product = ProductService.get_product_detail(product_id)
     
     if product:
-        return jsonify(product.to_dict())
+        return jsonify(product)
     else:
         return jsonify({"error": "Product not found"}), 404
 
+@products_bp.route('/cache/stats', methods=['GET'])
+@jwt_required()
+@admin_required
+def get_cache_stats():
+    """
+    商品快取命中率（需管理員）
+    ---
+    tags:
+      - products
+    security:
+      - Bearer: []
+    responses:
+      200:
+        description: 各快取的命中/未命中次數（不過期：SimpleCache 時從 process 啟動起累計、各 worker 分開；Redis 時所有 worker 共用）
+        schema:
+          type: object
+          properties:
+            product_detail:
+              type: object
+              properties:
+                hits:
+                  type: integer
+                  example: 120
+                misses:
+                  type: integer
+                  example: 8
+                hit_rate:
+                  type: number
+                  example: 0.9375
+            category_popular:
+              type: object
+              description: 分類熱門排行（個人化 / 購物車推薦），欄位同 product_detail
+            cart_snapshot:
+              type: object
+              description: 購物車 snapshot（GET /carts），欄位同 product_detail
+            recommend_user:
+              type: object
+              description: 會員推薦結果快取，欄位同 product_detail，另有 stale（回傳過期結果、排進背景重算的次數）
+            recommend_cart:
+              type: object
+              description: 購物車推薦結果快取，欄位同 recommend_user
+            recommend_collaborative:
+              type: object
+              description: 共同購買推薦結果快取，欄位同 recommend_user
+            recommend_pending:
+              type: integer
+              description: 等待背景重算的推薦結果數
+              example: 0
+    """
+    stats = {
+        "product_detail": get_stats("product_detail"),
+        "category_popular": get_stats("category_popular"),
+        "cart_snapshot": get_stats("cart_snapshot"),
+    }
+    for kind in RECOMMEND_KINDS:
+        stats[f"recommend_{kind}"] = get_stats(f"recommend_{kind}", "stale")
+    stats["recommend_pending"] = count_pending(RECOMMEND_PENDING_NAME)
+    return jsonify(stats)
+
 # 新增商品
 @products_bp.route('', methods=['POST'])
 @jwt_required()
@@ -254,7 +346,6 @@ def create_product():
           category_id=category_id,
           images=images
     )
-    cache.clear()
     admin_id = get_jwt_identity()
     #寫入日志
     AuditService.log(
@@ -345,7 +436,6 @@ def update_product(product_id):
         description=description, 
         images = images
     )
-    cache.clear()
     # 取得操作者ID
     admin_id = get_jwt_identity()
 
@@ -398,7 +488,6 @@ def delete_product(product_id):
     """
 
     product = ProductService.delete_product(product_id)
-    cache.clear()
     admin_id = get_jwt_identity()
 
      #寫入日志
@@ -479,7 +568,6 @@ def add_product_sale(product_id):
                                            start_date=start_date_str,
                                            end_date=end_date_str,
                                            description=description)
-    cache.clear()
     admin_id = get_jwt_identity() 
     # 寫入日誌
     AuditService.log(
@@ -527,7 +615,6 @@ def deactivate_product(product_id):
     """
     
     product = ProductService.set_product_active_status(product_id, False)
-    cache.clear()
 
     AuditService.log(
         user_id=get_jwt_identity(),
@@ -543,7 +630,6 @@ def deactivate_product(product_id):
 @admin_required
 def activate_product(product_id):
     product = ProductService.set_product_active_status(product_id, True)
-    cache.clear()
     AuditService.log(
         user_id=get_jwt_identity(),
         action='activate',
@@ -556,7 +642,7 @@ def activate_product(product_id):
 @products_bp.route('/guest/recommend', methods=['GET'])
 def recommend_for_guest():
     """
-    未登入訪客推薦（回傳全站熱賣商品，按銷量排序）
+    未登入訪客推薦（回傳全站上架中的熱賣商品，按銷量排序）
     ---
     tags:
       - users
@@ -566,6 +652,12 @@ def recommend_for_guest():
         type: integer
         required: false
         description: 推薦幾個商品，預設5
+      - in: query
+        name: days
+        type: integer
+        required: false
+        enum: [7, 30]
+        description: 只看近幾天的銷量（7 或 30），不帶則為累計銷量
     responses:
       200:
         description: 推薦商品列表
@@ -594,5 +686,6 @@ def recommend_for_guest():
                 example: "http://img"
     """
     limit = request.args.get('limit', 5, type=int)
-    products = ProductService.get_top_products(limit=limit)
-    return jsonify([p.to_dict() for p in products])
+    days = request.args.get('days', type=int)
+    products = ProductService.get_top_products(limit=limit, days=days)
+    return jsonify(ProductService.to_dict_list(products))
@@ -4,6 +4,8 @@ from api.decorate import admin_required
 from models import db, User
 from service.user_service import UserService
 from service.product_service import ProductService
+from service.recommendation_service import RecommendationService
+from utils.pagination import keyset_paginate
 
 users_bp = Blueprint('users', __name__, url_prefix='/users')
 
@@ -103,6 +105,11 @@ def get_all_user():
         required: false
         default: 10
         description: 每頁筆數
+      - in: query
+        name: cursor
+        type: string
+        required: false
+        description: keyset 分頁游標；帶上 cursor（第一頁給空字串）改用游標分頁，回傳 next_cursor、不回傳 total/pages
     responses:
       200:
         description: 用戶資訊列表
@@ -148,6 +155,11 @@ def get_all_user():
     """
     page = request.args.get('page', default=1, type=int)
     per_page = request.args.get('per_page', default=10, type=int)
+    cursor = request.args.get('cursor', type=str)
+    if cursor is not None:
+        users_page = keyset_paginate(User.query, [User.id], cursor=cursor, per_page=per_page)
+        result = [user.to_dict() for user in users_page.items]
+        return jsonify({"users": result, "per_page": users_page.per_page, "next_cursor": users_page.next_cursor})
     users_page = User.query.order_by(User.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
     result = [user.to_dict() for user in users_page.items]
     return jsonify({
@@ -289,7 +301,7 @@ def recommend_for_user(user_id):
     limit = request.args.get('limit', 5, type=int)
 
     # 1. 先取得個人化推薦
-    products = ProductService.recommend_for_user(user_id, limit)
+    products = RecommendationService.get("user", user_id, limit)
     product_ids = set([p.id for p in products])
 
     # 2. 如果不足，補熱賣商品（排除重複）
@@ -302,4 +314,4 @@ def recommend_for_user(user_id):
             if len(products) >= limit:
                 break
 
-    return jsonify([p.to_dict() for p in products])
+    return jsonify(ProductService.to_dict_list(products))
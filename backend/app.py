@@ -64,6 +64,7 @@ def create_app(config_name=None, test_config=None):
         print(f"🗄️ DATABASE URI: {getattr(CurrentConfig, 'SQLALCHEMY_DATABASE_URI', None)}")
         print(f"⚙️ SQLALCHEMY_ENGINE_OPTIONS: {getattr(CurrentConfig, 'SQLALCHEMY_ENGINE_OPTIONS', None)}")
         print(f"🐞 DEBUG: {getattr(CurrentConfig, 'DEBUG', None)}")
+        print(f"🧊 CACHE_TYPE: {getattr(CurrentConfig, 'CACHE_TYPE', None)}")
         print("====================================")
 
     print_startup_config()
@@ -84,7 +85,12 @@ def create_app(config_name=None, test_config=None):
         api_secret=app.config["CLOUDINARY_API_SECRET"]
     )
     # 3. cache & 其他初始化
-    cache.init_app(app, config={'CACHE_TYPE': 'SimpleCache'})
+    cache.init_app(app, config={
+        'CACHE_TYPE': app.config['CACHE_TYPE'],
+        'CACHE_REDIS_URL': app.config['CACHE_REDIS_URL'],
+        'CACHE_DEFAULT_TIMEOUT': app.config['CACHE_DEFAULT_TIMEOUT'],
+        'CACHE_KEY_PREFIX': app.config['CACHE_KEY_PREFIX'],
+    })
     #socket 
     socketio.init_app(app, cors_allowed_origins=[
             "http://localhost:3000",
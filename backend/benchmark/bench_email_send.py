@@ -0,0 +1,100 @@
+# backend/benchmark/bench_email_send.py
+# 寄信吞吐量壓測：對本機假的 SendGrid HTTP server（回 202）寄 N 封信，比較
+#   legacy ：每封信 new 一個 SendGridAPIClient（舊的 send_email 寫法，每封重新建連線）
+#   pooled ：共用 SendGridClient 連線池，每封一個請求（send_email）
+#   batch  ：內容相同的信合併，每 1000 人一個請求（send_email_batch）
+#   python benchmark/bench_email_send.py --messages 2000
+# 另外比較範本 render：舊的字串串接 vs 預先編譯的 jinja2 範本
+# 本機沒有 TLS，實際環境每次重新建連線還要多一次 TLS handshake，差距會更大
+import argparse
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import Mail
+from app import create_app
+from models import Product
+from utils.send_email import send_email, send_email_batch, render_email, EMAIL_BATCH_LIMIT
+
+class Sink(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        Sink.requests += 1
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def legacy_render(product, discount, start_date, end_date, description):
+    return (
+        f"您好，您Raw type購物車中的商品 <b>{product.title}</b> 現正特價！<br>"
+        f"原價：<s>{float(product.price)}</s> 元<br>"
+        f"特價：<span style='color:red;font-size:20px;'>{float(product.price) * discount:.2f}</span> 元<br>"
+        f"優惠期間：{start_date.strftime('%Y/%m/%d')} ~ {end_date.strftime('%Y/%m/%d')}<br>"
+        f"特價說明：{description or ''}<br>"
+    )
+
+def timed(label, func, messages):
+    Sink.requests = 0
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<8} {elapsed * 1000:>9.1f} ms  {messages / elapsed:>10.0f} msg/s  HTTP requests={Sink.requests}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Sink)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    app = create_app("testing", test_config={
+        "SENDGRID_API_KEY": "bench", "SENDGRID_API_BASE_URL": url, "LINEBOT_ADMIN_EMAIL": "shop@example.com",
+    })
+    emails = [f"user{i}@example.com" for i in range(args.messages)]
+    html = "<b>hello</b>"
+
+    def legacy():
+        for email in emails:
+            SendGridAPIClient("bench", host=url).send(
+                Mail(from_email="shop@example.com", to_emails=email, subject="Hi", html_content=html))
+
+    def pooled():
+        for email in emails:
+            send_email(email, "Hi", html)
+
+    def batch():
+        for start in range(0, len(emails), EMAIL_BATCH_LIMIT):
+            send_email_batch(emails[start:start + EMAIL_BATCH_LIMIT], "Hi", html)
+
+    with app.app_context():
+        print(f"messages={args.messages}")
+        timed("legacy", legacy, args.messages)
+        timed("pooled", pooled, args.messages)
+        timed("batch", batch, args.messages)
+
+        product = Product(id=1, title="Bench Mug", price=200)
+        sale = dict(discount=0.8, start_date=datetime(2024, 1, 1), end_date=datetime(2024, 1, 31), description="sale")
+        for label, render in (("concat", lambda: legacy_render(product, **sale)),
+                              ("jinja2", lambda: render_email("product_on_sale", product=product, **sale))):
+            start = time.perf_counter()
+            for _ in range(args.messages):
+                render()
+            print(f"render {label:<7} {(time.perf_counter() - start) / args.messages * 1e6:>7.1f} µs/msg")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+# backend/build_copurchase.py
+# 協同過濾共同購買模型（product_copurchases / product_neighbors）
+#   python build_copurchase.py              # 增量：只處理上次之後的新訂單（可交給 cron）
+#   python build_copurchase.py --loop 300   # 常駐，每 300 秒增量一次（Dockerfile / docker-compose 預設啟動；第一輪即完整建立）
+#   python build_copurchase.py --rebuild    # 全部重算（首次上線、刪除訂單後、或定期校正）
+import sys
+import time
+import traceback
+from app import create_app
+from models import db
+from service.copurchase_service import CopurchaseService
+
+def main():
+    app = create_app()
+    args = sys.argv[1:]
+    with app.app_context():
+        if "--rebuild" in args:
+            count = CopurchaseService.rebuild()
+            print(f"✅ 已重建共同購買模型，共 {count} 筆鄰居")
+            return
+        interval = int(args[args.index("--loop") + 1]) if "--loop" in args else None
+        while True:
+            try:
+                count = CopurchaseService.update()
+                print(f"✅ 已處理 {count} 筆新訂單明細")
+            except Exception as e:
+                if not interval:
+                    raise
+                # 常駐模式：這一輪失敗（例如資料庫暫時連不上）下一輪再試，進度沒推進不會漏掉訂單
+                db.session.rollback()
+                traceback.print_exc()
+                print("共同購買模型更新失敗:", e, file=sys.stderr)
+            finally:
+                db.session.remove()
+            if not interval:
+                break
+            time.sleep(interval)
+
+if __name__ == "__main__":
+    main()
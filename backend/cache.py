@@ -1,3 +1,173 @@
+import hashlib
+import threading
 from flask_caching import Cache
 
 cache = Cache()
+
+# ========== 標籤式失效 ==========
+# 每個快取 key 可以掛多個標籤（product:<id>、category:<id>、category:all），
+# 寫入時只失效有掛到該標籤的 key，不再 cache.clear() 整個清掉
+#   - Redis（正式環境，多個 gunicorn worker 共用）：標籤用 Redis set 保存 key，SADD/SMEMBERS 都是原子操作
+#   - 其他 backend（SimpleCache，本機/測試用）：標籤存成一般快取值（key 清單）
+TAG_PREFIX = "tag:"
+TAG_TIMEOUT = 24 * 60 * 60  # 標籤本身保留一天，過期的 key 只是刪不到，不影響正確性
+
+def product_tag(product_id):
+    return f"product:{product_id}"
+
+def category_tag(category_id):
+    """category_id 為 None 代表沒有依分類篩選的列表"""
+    return f"category:{category_id}" if category_id is not None else "category:all"
+
+def make_key(prefix, params):
+    """依查詢參數 (key, value) 排序後產生快取 key，參數順序不同也會命中同一個 key"""
+    raw = "&".join(f"{k}={v}" for k, v in sorted(params))
+    return f"{prefix}:{hashlib.md5(raw.encode('utf-8')).hexdigest()}"
+
+def _redis_backend():
+    backend = cache.cache
+    if hasattr(backend, "_write_client") and hasattr(backend, "_get_prefix"):
+        return backend
+    return None
+
+def set_tagged(key, value, tags, timeout=None):
+    """寫入快取並把 key 掛到各標籤底下"""
+    cache.set(key, value, timeout=timeout)
+    backend = _redis_backend()
+    if backend is not None:
+        prefix = backend._get_prefix()
+        pipe = backend._write_client.pipeline()
+        for tag in tags:
+            pipe.sadd(prefix + TAG_PREFIX + tag, key)
+            pipe.expire(prefix + TAG_PREFIX + tag, TAG_TIMEOUT)
+        pipe.execute()
+        return
+    for tag in tags:
+        keys = cache.get(TAG_PREFIX + tag) or []
+        if key not in keys:
+            cache.set(TAG_PREFIX + tag, keys + [key], timeout=TAG_TIMEOUT)
+
+def invalidate_tags(*tags):
+    """刪除掛在任一標籤底下的快取 key，回傳刪除的 key 數"""
+    tags = {tag for tag in tags if tag}
+    if not tags:
+        return 0
+    backend = _redis_backend()
+    if backend is not None:
+        prefix = backend._get_prefix()
+        tag_keys = [prefix + TAG_PREFIX + tag for tag in tags]
+        keys = set()
+        for tag_key in tag_keys:
+            keys.update(k.decode("utf-8") if isinstance(k, bytes) else k
+                        for k in backend._write_client.smembers(tag_key))
+        if keys:
+            cache.delete_many(*keys)
+        backend._write_client.delete(*tag_keys)
+        return len(keys)
+    keys = set()
+    for tag in tags:
+        keys.update(cache.get(TAG_PREFIX + tag) or [])
+    if keys:
+        cache.delete_many(*keys)
+    cache.delete_many(*[TAG_PREFIX + tag for tag in tags])
+    return len(keys)
+
+def invalidate_product(product_id, *category_ids):
+    """
+    商品異動：失效含有該商品的快取
+    有傳 category_ids 代表商品可能新出現在（或離開）列表中，連同這些分類與不分類的列表一起失效
+    """
+    tags = [product_tag(product_id)]
+    if category_ids:
+        tags += [category_tag(cid) for cid in category_ids if cid is not None]
+        tags.append(category_tag(None))
+    return invalidate_tags(*tags)
+
+
+# ========== 命中率統計 ==========
+# 計數器不過期：從 process 啟動（Redis 時從 key 建立）起累計，用來評估快取大小/TTL
+#   - Redis：INCR，所有 worker 共用，key 沒有 TTL
+#   - 其他 backend：放在 app.extensions（process 內）。不放在 SimpleCache 裡：cachelib 的 inc 是 get + set，
+#     set 會套用 CACHE_DEFAULT_TIMEOUT（計數器每 300 秒歸零），timeout=0 的項目在超過 threshold 時又最先被清掉
+STATS_PREFIX = "stats:"
+_stats_lock = threading.Lock()
+
+def _local_stats():
+    from flask import current_app
+    return current_app.extensions.setdefault("cache_stats", {})
+
+def record_hit(name, hit):
+    record_event(name, "hits" if hit else "misses")
+
+def record_event(name, event):
+    """命中/未命中以外的計數（例如回傳了過期的結果）"""
+    key = f"{STATS_PREFIX}{name}:{event}"
+    backend = _redis_backend()
+    if backend is not None:
+        backend.inc(key)
+        return
+    with _stats_lock:
+        stats = _local_stats()
+        stats[key] = stats.get(key, 0) + 1
+
+def _get_count(key):
+    if _redis_backend() is not None:
+        return int(cache.get(key) or 0)
+    return _local_stats().get(key, 0)
+
+def get_stats(name, *events):
+    hits = _get_count(f"{STATS_PREFIX}{name}:hits")
+    misses = _get_count(f"{STATS_PREFIX}{name}:misses")
+    total = hits + misses
+    stats = {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 4) if total else None
+    }
+    for event in events:
+        stats[event] = _get_count(f"{STATS_PREFIX}{name}:{event}")
+    return stats
+
+
+# ========== 待處理集合 ==========
+# 背景工作的待辦清單（同一個成員只會排一次），例如等著重算的推薦結果
+#   - Redis：Redis set，SADD / SPOP 是原子操作，多個 worker 一起取也不會重複取到
+#   - 其他 backend：存成一般快取值，用 process 內的 lock 保護
+PENDING_PREFIX = "pending:"
+PENDING_TIMEOUT = 24 * 60 * 60
+_pending_lock = threading.Lock()
+
+def add_pending(name, *members):
+    if not members:
+        return
+    backend = _redis_backend()
+    if backend is not None:
+        key = backend._get_prefix() + PENDING_PREFIX + name
+        pipe = backend._write_client.pipeline()
+        pipe.sadd(key, *members)
+        pipe.expire(key, PENDING_TIMEOUT)
+        pipe.execute()
+        return
+    with _pending_lock:
+        pending = cache.get(PENDING_PREFIX + name) or []
+        pending += [m for m in members if m not in pending]
+        cache.set(PENDING_PREFIX + name, pending, timeout=PENDING_TIMEOUT)
+
+def pop_pending(name, count):
+    """取出（並移除）最多 count 個成員"""
+    backend = _redis_backend()
+    if backend is not None:
+        members = backend._write_client.spop(backend._get_prefix() + PENDING_PREFIX + name, count) or []
+        return [m.decode("utf-8") if isinstance(m, bytes) else m for m in members]
+    with _pending_lock:
+        pending = cache.get(PENDING_PREFIX + name) or []
+        if not pending:
+            return []
+        cache.set(PENDING_PREFIX + name, pending[count:], timeout=PENDING_TIMEOUT)
+        return pending[:count]
+
+def count_pending(name):
+    backend = _redis_backend()
+    if backend is not None:
+        return backend._write_client.scard(backend._get_prefix() + PENDING_PREFIX + name)
+    return len(cache.get(PENDING_PREFIX + name) or [])
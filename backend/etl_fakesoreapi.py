@@ -1,5 +1,6 @@
 import requests
 import random
+from datetime import datetime
 from werkzeug.security import generate_password_hash
 from models import db, Category, Product, User, Cart, CartItem, Order, OrderItem
 from app import create_app
@@ -113,7 +114,16 @@ def etl_carts_orders():
             unique_cart = Cart.query.filter_by(user_id=user_id, created_at=date).first()
             if unique_cart:
                 continue
-            cart = Cart(user_id=user_id, created_at=date, status='active')
+            # 每個會員只能有一台 active 購物車：保留日期最新的一台，其餘視為已結帳
+            status = 'active'
+            active_cart = Cart.query.filter_by(user_id=user_id, status='active').first()
+            created_at = datetime.fromisoformat(date.replace('Z', '+00:00')).replace(tzinfo=None)
+            if active_cart and active_cart.created_at >= created_at:
+                status = 'checked_out'
+            elif active_cart:
+                active_cart.status = 'checked_out'
+                db.session.flush()
+            cart = Cart(user_id=user_id, created_at=date, status=status)
             db.session.add(cart)
             db.session.flush()
             for item in items:
@@ -126,6 +136,9 @@ def etl_carts_orders():
                     quantity=item['quantity']
                 ))
     db.session.commit()
+    # 直接寫入的訂單不會經過結帳，熱賣排行要重算
+    from service.sales_rank_service import SalesRankService
+    SalesRankService.rebuild()
     print("✅ 已載入 API carts/orders")
 
 def main():
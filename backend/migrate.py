@@ -1,15 +1,53 @@
-from app import create_app
-from models import db, Product
-import json
+# backend/migrate.py
+# 資料庫 schema 版本管理（版本定義在 migrations/）
+#   python migrate.py status               # 目前版本與待套用的版本
+#   python migrate.py upgrade              # 升級到最新版（部署流程中、新版程式上線前執行；新資料庫也用這個建表）
+#   python migrate.py upgrade 3            # 升級到指定版本
+#   python migrate.py sql --from 2 > up.sql  # 不連資料庫，產生 v0002 之後的 SQL 給 DBA 審核 / psql -f 執行
+#   python migrate.py check                # 容器啟動檢查：版本落後時 exit 1
+import sys
+from config import BaseConfig
+from migrations import SchemaVersionError, check_schema_version, current_version, load_migrations, offline_sql, upgrade
 
-app = create_app()
-app.app_context().push()
+def main():
+    args = sys.argv[1:]
+    command = args[0] if args else "status"
+    if command == "sql":
+        rest = args[1:]
+        from_version = 0
+        if "--from" in rest:
+            index = rest.index("--from")
+            from_version = int(rest[index + 1])
+            del rest[index:index + 2]
+        print(offline_sql(from_version, int(rest[0]) if rest else None, BaseConfig.MIGRATION_LOCK_TIMEOUT))
+        return
 
-# 只查詢 id 25以上的商品
-products = Product.query.filter(Product.id >= 25).all()
-data = [p.to_dict() for p in products]
+    # sql 不連資料庫：載入 app 會印啟動參數到 stdout，混進輸出的 SQL
+    from app import create_app
+    from models import db
+    app = create_app()
+    with app.app_context():
+        if command == "check":
+            try:
+                version = check_schema_version(db.engine)
+            except SchemaVersionError as e:
+                print(f"❌ {e}", file=sys.stderr)
+                sys.exit(1)
+            print(f"✅ schema 版本 v{version:04d}")
+        elif command == "upgrade":
+            target = int(args[1]) if len(args) > 1 else None
+            applied = upgrade(db.engine, target, app.config["MIGRATION_LOCK_TIMEOUT"])
+            print(f"✅ 已套用 {len(applied)} 個版本" if applied else "✅ 已是最新版本")
+        elif command == "status":
+            with db.engine.connect() as connection:
+                current = current_version(connection)
+            print(f"目前版本 v{current:04d}")
+            for migration in load_migrations():
+                mark = "✔" if migration.version <= current else " "
+                print(f"  [{mark}] v{migration.version:04d}_{migration.name}：{migration.description}")
+        else:
+            print(f"未知的指令 {command}（status / upgrade / sql / check）", file=sys.stderr)
+            sys.exit(2)
 
-with open("products.json", "w", encoding="utf8") as f:
-    json.dump(data, f, ensure_ascii=False, indent=2)
-
-print("已匯出衣服商品到 products.json")
+if __name__ == "__main__":
+    main()
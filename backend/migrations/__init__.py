@@ -0,0 +1,188 @@
+# backend/migrations/__init__.py
+# 資料庫 schema 版本管理：取代每次啟動都跑 db.create_all()（create_all 只會建缺的表，加不了欄位 / 索引，還要反射整個 schema）
+# - 每個版本一個模組 vNNNN_<name>.py：docstring 第一行是說明，STEPS 是依序執行的 SQL，TRANSACTIONAL = False 代表不包交易
+#   （CREATE INDEX CONCURRENTLY 不能在交易內執行）
+# - 每個步驟都要可重跑（IF NOT EXISTS / 先檢查再做）：
+#   舊版 create_tables.py 建出來的資料庫停在哪個狀態都能直接 upgrade；不包交易的版本中途失敗，修好後重跑即可
+# - 已套用的版本記在 schema_migrations；upgrade 期間拿 advisory lock，同時部署的多個容器只有一個會真的執行
+# - 啟動時只用 check 比對版本（一個查詢），實際升級在部署流程中用 python migrate.py upgrade，或用 sql 產生 SQL 交給 DBA
+import importlib
+import pkgutil
+import re
+import textwrap
+
+VERSION_TABLE = "schema_migrations"
+ADVISORY_LOCK_KEY = 7_250_001
+MODULE_NAME = re.compile(r"^v(\d{4})_(\w+)$")
+CONCURRENT_INDEX = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+
+CREATE_VERSION_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT now()
+)"""
+
+class SchemaVersionError(RuntimeError):
+    """資料庫 schema 版本比程式需要的舊"""
+
+class OptionalStep(str):
+    """
+    失敗時略過的步驟（例如沒有權限安裝 extension），用法：OptionalStep("CREATE EXTENSION ...")
+    只能放在不包交易的版本：交易內一個步驟失敗整個交易就不能用了
+    """
+
+class Migration:
+    def __init__(self, version, name, description, steps, transactional=True):
+        self.version = version
+        self.name = name
+        self.description = description
+        self.steps = steps
+        self.transactional = transactional
+
+def load_migrations():
+    """依版本排序的 Migration list（版本號不能重複或跳號）"""
+    migrations = []
+    for module_info in pkgutil.iter_modules(__path__):
+        match = MODULE_NAME.match(module_info.name)
+        if not match:
+            continue
+        module = importlib.import_module(f"{__name__}.{module_info.name}")
+        migration = Migration(
+            version=int(match.group(1)),
+            name=match.group(2),
+            description=(module.__doc__ or "").strip().split("\n")[0],
+            steps=list(module.STEPS),
+            transactional=getattr(module, "TRANSACTIONAL", True),
+        )
+        if migration.transactional and any(isinstance(step, OptionalStep) for step in migration.steps):
+            raise RuntimeError(f"v{migration.version:04d}_{migration.name}：OptionalStep 只能用在 TRANSACTIONAL = False 的版本")
+        migrations.append(migration)
+    migrations.sort(key=lambda m: m.version)
+    for expected, migration in enumerate(migrations, start=1):
+        if migration.version != expected:
+            raise RuntimeError(f"migration 版本不連續：預期 v{expected:04d}，找到 v{migration.version:04d}_{migration.name}")
+    return migrations
+
+def latest_version():
+    migrations = load_migrations()
+    return migrations[-1].version if migrations else 0
+
+def current_version(connection):
+    """資料庫目前的版本；還沒有 schema_migrations（全新或舊版 create_all 建的資料庫）回傳 0"""
+    if connection.exec_driver_sql(f"SELECT to_regclass('{VERSION_TABLE}')").scalar() is None:
+        return 0
+    return connection.exec_driver_sql(f"SELECT coalesce(max(version), 0) FROM {VERSION_TABLE}").scalar()
+
+def check_schema_version(engine):
+    """
+    啟動檢查：資料庫版本比程式舊就 raise SchemaVersionError
+    比程式新可以啟動：migration 只做相容的變更（先加後用），滾動部署時舊版容器重啟不會被擋
+    """
+    expected = latest_version()
+    with engine.connect() as connection:
+        current = current_version(connection)
+    if current < expected:
+        raise SchemaVersionError(
+            f"資料庫 schema 版本 v{current:04d}，程式需要 v{expected:04d}：請先執行 python migrate.py upgrade"
+        )
+    return current
+
+def upgrade(engine, target=None, lock_timeout="5s", log=print):
+    """把資料庫升級到 target（預設最新），回傳套用的版本 list"""
+    migrations = load_migrations()
+    if target is None:
+        target = migrations[-1].version if migrations else 0
+    applied = []
+    # advisory lock 綁在這條連線上：其他 upgrade 會在這裡等，拿到鎖後重新讀版本就不會重跑
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_connection:
+        lock_connection.exec_driver_sql(f"SELECT pg_advisory_lock({ADVISORY_LOCK_KEY})")
+        try:
+            lock_connection.exec_driver_sql(CREATE_VERSION_TABLE)
+            current = current_version(lock_connection)
+            for migration in migrations:
+                if current < migration.version <= target:
+                    log(f"→ v{migration.version:04d}_{migration.name}：{migration.description}")
+                    _apply(engine, migration, lock_timeout, log)
+                    applied.append(migration.version)
+        finally:
+            lock_connection.exec_driver_sql(f"SELECT pg_advisory_unlock({ADVISORY_LOCK_KEY})")
+    return applied
+
+def _apply(engine, migration, lock_timeout, log):
+    # lock_timeout：ALTER TABLE 等不到鎖就失敗重跑，不要排在長交易後面把線上請求一起卡住
+    if migration.transactional:
+        with engine.begin() as connection:
+            connection.exec_driver_sql(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            for step in migration.steps:
+                connection.exec_driver_sql(step)
+            _record(connection, migration)
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql(f"SET lock_timeout = '{lock_timeout}'")
+        for step in migration.steps:
+            _drop_invalid_index(connection, step, log)
+            _execute(connection, step, log)
+        _record(connection, migration)
+
+def _execute(connection, step, log):
+    if not isinstance(step, OptionalStep):
+        connection.exec_driver_sql(step)
+        return
+    try:
+        connection.exec_driver_sql(step)
+    except Exception as e:
+        log(f"  略過選用步驟：{str(e).splitlines()[0]}")
+
+def _drop_invalid_index(connection, step, log):
+    """CONCURRENTLY 建索引失敗會留下 INVALID 的索引，IF NOT EXISTS 會直接跳過它：重跑前先刪掉"""
+    match = CONCURRENT_INDEX.search(step)
+    if not match:
+        return
+    invalid = connection.exec_driver_sql(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = %(name)s AND c.relnamespace = current_schema()::regnamespace AND NOT i.indisvalid",
+        {"name": match.group(1)},
+    ).first()
+    if invalid:
+        log(f"  刪除建立失敗（INVALID）的索引 {match.group(1)}")
+        connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+
+def _record(connection, migration):
+    connection.exec_driver_sql(
+        f"INSERT INTO {VERSION_TABLE} (version, name) VALUES (%(version)s, %(name)s) ON CONFLICT (version) DO NOTHING",
+        {"version": migration.version, "name": migration.name},
+    )
+
+def offline_sql(from_version=0, target=None, lock_timeout="5s"):
+    """
+    產生 from_version 之後到 target 的 SQL（給 DBA 審核或用 psql -f 執行），不連資料庫
+    包交易的版本以 BEGIN / COMMIT 包起來；不包交易的（CONCURRENTLY）逐句執行
+    """
+    migrations = load_migrations()
+    if target is None:
+        target = migrations[-1].version if migrations else 0
+    lines = [f"-- schema migration v{from_version:04d} → v{target:04d}", CREATE_VERSION_TABLE.strip() + ";", ""]
+    for migration in migrations:
+        if not from_version < migration.version <= target:
+            continue
+        lines.append(f"-- v{migration.version:04d}_{migration.name}：{migration.description}")
+        if migration.transactional:
+            lines += ["BEGIN;", f"SET LOCAL lock_timeout = '{lock_timeout}';"]
+        else:
+            lines += [
+                "-- 不包交易（CONCURRENTLY）；中途失敗時先 DROP INDEX CONCURRENTLY 掉 INVALID 的索引再重跑",
+                f"SET lock_timeout = '{lock_timeout}';",
+            ]
+        for step in migration.steps:
+            if isinstance(step, OptionalStep):
+                lines.append("-- 選用：失敗可略過")
+            lines.append(textwrap.dedent(step).strip() + ";")
+        lines.append(
+            f"INSERT INTO {VERSION_TABLE} (version, name) VALUES ({migration.version}, '{migration.name}') "
+            "ON CONFLICT (version) DO NOTHING;"
+        )
+        if migration.transactional:
+            lines.append("COMMIT;")
+        lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,176 @@
+"""初始 schema（原本 create_tables.py 用 db.create_all() 建出的表）
+
+全部用 IF NOT EXISTS：舊版 create_all 建好的資料庫直接套用，只會補上缺的部分
+"""
+
+STEPS = [
+    """
+    DO $$ BEGIN
+        CREATE TYPE order_status_enum AS ENUM (
+            'pending', 'paid', 'processing', 'shipped', 'delivered', 'cancelled', 'returned', 'refunded'
+        );
+    EXCEPTION WHEN duplicate_object THEN NULL;
+    END $$
+    """,
+    """
+    DO $$ BEGIN
+        CREATE TYPE cart_status_enum AS ENUM ('active', 'checked_out');
+    EXCEPTION WHEN duplicate_object THEN NULL;
+    END $$
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS categories (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(100) NOT NULL UNIQUE,
+        description TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        email VARCHAR(255) NOT NULL UNIQUE,
+        password TEXT NOT NULL,
+        full_name VARCHAR(255),
+        address TEXT,
+        phone VARCHAR(50),
+        created_at TIMESTAMP,
+        role VARCHAR(20),
+        line_user_id VARCHAR(50),
+        line_display_name VARCHAR(50),
+        line_picture_url VARCHAR(255),
+        oauth_provider VARCHAR(50),
+        google_sub VARCHAR(255) UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS audit_logs (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id),
+        guest_id VARCHAR(64),
+        action VARCHAR(50) NOT NULL,
+        target_type VARCHAR(50) NOT NULL,
+        target_id INTEGER,
+        description TEXT,
+        created_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS carts (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id),
+        guest_id VARCHAR(64),
+        created_at TIMESTAMP,
+        status cart_status_enum NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        sender VARCHAR(20) NOT NULL,
+        message TEXT NOT NULL,
+        created_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS password_reset_tokens (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        token VARCHAR(128) NOT NULL UNIQUE,
+        expire_at TIMESTAMP NOT NULL,
+        used BOOLEAN,
+        created_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS products (
+        id SERIAL PRIMARY KEY,
+        title VARCHAR(255) NOT NULL,
+        price NUMERIC NOT NULL,
+        description TEXT,
+        category_id INTEGER REFERENCES categories (id),
+        images JSONB,
+        is_active BOOLEAN,
+        CONSTRAINT unique_product_title_category UNIQUE (title, category_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cart_items (
+        id SERIAL PRIMARY KEY,
+        cart_id INTEGER REFERENCES carts (id) ON DELETE CASCADE,
+        product_id INTEGER REFERENCES products (id),
+        quantity INTEGER NOT NULL,
+        CONSTRAINT unique_cart_product UNIQUE (cart_id, product_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS discount_codes (
+        id SERIAL PRIMARY KEY,
+        code VARCHAR(50) NOT NULL UNIQUE,
+        product_id INTEGER REFERENCES products (id),
+        discount FLOAT,
+        amount FLOAT,
+        min_spend FLOAT,
+        valid_from TIMESTAMP NOT NULL,
+        valid_to TIMESTAMP NOT NULL,
+        usage_limit INTEGER,
+        used_count INTEGER,
+        per_user_limit INTEGER,
+        description TEXT,
+        is_active BOOLEAN
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS products_on_sale (
+        id SERIAL PRIMARY KEY,
+        product_id INTEGER NOT NULL REFERENCES products (id),
+        discount FLOAT NOT NULL,
+        start_date TIMESTAMP NOT NULL,
+        end_date TIMESTAMP NOT NULL,
+        description TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS orders (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id),
+        guest_id VARCHAR(64),
+        guest_email VARCHAR(255),
+        order_date TIMESTAMP,
+        total NUMERIC,
+        status order_status_enum NOT NULL,
+        discount_code_id INTEGER REFERENCES discount_codes (id),
+        discount_amount NUMERIC
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_discount_codes (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id),
+        guest_id VARCHAR(64),
+        discount_code_id INTEGER NOT NULL REFERENCES discount_codes (id),
+        used_count INTEGER,
+        last_used_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS order_items (
+        id SERIAL PRIMARY KEY,
+        order_id INTEGER REFERENCES orders (id) ON DELETE CASCADE,
+        product_id INTEGER REFERENCES products (id),
+        quantity INTEGER NOT NULL,
+        price NUMERIC NOT NULL,
+        CONSTRAINT unique_order_product UNIQUE (order_id, product_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS order_shipping (
+        id SERIAL PRIMARY KEY,
+        order_id INTEGER NOT NULL UNIQUE REFERENCES orders (id),
+        shipping_method VARCHAR(30) NOT NULL,
+        recipient_name VARCHAR(100) NOT NULL,
+        recipient_phone VARCHAR(30) NOT NULL,
+        store_name VARCHAR(100) NOT NULL
+    )
+    """,
+]
@@ -0,0 +1,107 @@
+"""價格投影、熱賣排行、共同購買、通知佇列、email outbox 的表，以及商品全文檢索、購物車版本欄位
+
+新表建好後是空的：熱賣排行由 v0005 依既有訂單回填；價格投影、共同購買模型由常駐的
+    python refresh_prices.py --loop 60、python build_copurchase.py --loop 300 在第一輪補齊
+"""
+
+STEPS = [
+    # 全文檢索 generated column：加欄位會重寫整張 products（表鎖），商品數量不大；已有這個欄位就跳過
+    """
+    ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector TSVECTOR GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'B')
+    ) STORED
+    """,
+    # 購物車 snapshot 的版本：有預設值的 NOT NULL 欄位（PostgreSQL 11+）不重寫表
+    "ALTER TABLE carts ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0",
+    # 用舊 schema.sql 建的資料庫 user_id 是 NOT NULL，訪客用不了折扣碼
+    "ALTER TABLE user_discount_codes ALTER COLUMN user_id DROP NOT NULL",
+    """
+    CREATE TABLE IF NOT EXISTS product_prices (
+        product_id INTEGER PRIMARY KEY REFERENCES products (id) ON DELETE CASCADE,
+        final_price NUMERIC NOT NULL,
+        sale_id INTEGER REFERENCES products_on_sale (id) ON DELETE SET NULL,
+        valid_until TIMESTAMP,
+        refreshed_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS product_sales_stats (
+        product_id INTEGER PRIMARY KEY REFERENCES products (id) ON DELETE CASCADE,
+        total_sold INTEGER NOT NULL,
+        order_count INTEGER NOT NULL,
+        updated_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS product_sales_daily (
+        product_id INTEGER NOT NULL REFERENCES products (id) ON DELETE CASCADE,
+        day DATE NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (product_id, day)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS product_copurchases (
+        product_id INTEGER NOT NULL,
+        other_product_id INTEGER NOT NULL,
+        users INTEGER NOT NULL,
+        PRIMARY KEY (product_id, other_product_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS product_neighbors (
+        product_id INTEGER NOT NULL,
+        neighbor_id INTEGER NOT NULL,
+        score INTEGER NOT NULL,
+        PRIMARY KEY (product_id, neighbor_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS job_watermarks (
+        name VARCHAR(50) PRIMARY KEY,
+        last_id BIGINT NOT NULL,
+        updated_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS notification_jobs (
+        id SERIAL PRIMARY KEY,
+        kind VARCHAR(50) NOT NULL,
+        payload JSONB NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        attempts INTEGER NOT NULL,
+        max_attempts INTEGER NOT NULL,
+        run_at TIMESTAMP NOT NULL,
+        locked_at TIMESTAMP,
+        last_error TEXT,
+        created_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS notification_dead_letters (
+        id SERIAL PRIMARY KEY,
+        job_id INTEGER,
+        kind VARCHAR(50) NOT NULL,
+        payload JSONB NOT NULL,
+        attempts INTEGER NOT NULL,
+        error TEXT,
+        created_at TIMESTAMP,
+        failed_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS email_outbox (
+        id SERIAL PRIMARY KEY,
+        dedupe_key VARCHAR(320) NOT NULL UNIQUE,
+        to_email VARCHAR(255) NOT NULL,
+        subject VARCHAR(255) NOT NULL,
+        html TEXT NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        attempts INTEGER NOT NULL,
+        last_error TEXT,
+        created_at TIMESTAMP,
+        sent_at TIMESTAMP
+    )
+    """,
+]
@@ -0,0 +1,27 @@
+"""商品列表 / 搜尋、訂單、購物車、特價通知、排行、通知佇列的索引
+
+CREATE INDEX CONCURRENTLY 不鎖寫入，大表也能線上建立
+"""
+from migrations import OptionalStep
+
+TRANSACTIONAL = False
+
+STEPS = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_products_search ON products USING gin (search_vector)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_products_title_id ON products (title, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_line_user_id ON users (line_user_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_order_date_id ON orders (order_date, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_user_id_order_date_id ON orders (user_id, order_date, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_guest_id_order_date_id ON orders (guest_id, order_date, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_cart_items_product_id ON cart_items (product_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_prices_valid_until ON product_prices (valid_until)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_sales_stats_total_sold ON product_sales_stats (total_sold, product_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_sales_daily_day ON product_sales_daily (day, product_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_notification_jobs_status_run_at ON notification_jobs (status, run_at)",
+    # 子字串搜尋（中文）的 trigram 索引：沒有 pg_trgm 或沒有權限安裝時略過，搜尋會退回不走索引的 ILIKE
+    OptionalStep("CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+    OptionalStep("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_products_title_trgm ON products USING gin (title gin_trgm_ops)"),
+    OptionalStep(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_products_description_trgm ON products USING gin (description gin_trgm_ops)"
+    ),
+]
@@ -0,0 +1,57 @@
+"""每個會員 / 訪客對同一折扣碼只有一列使用紀錄、只有一台 active 購物車（partial unique index）
+
+建索引前先整理既有的重複資料，整理和建索引在同一個（不包交易的）版本：
+CONCURRENTLY 建 unique 索引期間若又出現重複，索引建立失敗，重跑時會再整理一次
+- 折扣碼使用紀錄：同一人同一折扣碼的多列合併到 id 最小的一列（次數加總、最後使用時間取最晚）
+- 購物車：保留原本查詢會拿到的那台（created_at 最新），其他 active 購物車改成 checked_out
+"""
+
+TRANSACTIONAL = False
+
+def _merge_discount_usage(owner):
+    return [
+        f"""
+        UPDATE user_discount_codes u
+        SET used_count = d.total, last_used_at = d.last_used_at
+        FROM (
+            SELECT min(id) AS keep_id, sum(coalesce(used_count, 0)) AS total, max(last_used_at) AS last_used_at
+            FROM user_discount_codes
+            WHERE {owner} IS NOT NULL
+            GROUP BY {owner}, discount_code_id
+            HAVING count(*) > 1
+        ) d
+        WHERE u.id = d.keep_id
+        """,
+        f"""
+        DELETE FROM user_discount_codes u
+        USING user_discount_codes k
+        WHERE u.{owner} = k.{owner} AND u.discount_code_id = k.discount_code_id AND u.id > k.id
+        """,
+        f"""
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_user_discount_codes_{owner.split("_")[0]}
+        ON user_discount_codes ({owner}, discount_code_id) WHERE {owner} IS NOT NULL
+        """,
+    ]
+
+def _single_active_cart(owner):
+    return [
+        f"""
+        UPDATE carts c
+        SET status = 'checked_out', version = c.version + 1
+        FROM (
+            SELECT id, row_number() OVER (PARTITION BY {owner} ORDER BY created_at DESC, id DESC) AS rank
+            FROM carts
+            WHERE status = 'active' AND {owner} IS NOT NULL
+        ) r
+        WHERE c.id = r.id AND r.rank > 1
+        """,
+        f"""
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_carts_active_{owner.split("_")[0]}
+        ON carts ({owner}) WHERE status = 'active' AND {owner} IS NOT NULL
+        """,
+    ]
+
+STEPS = (
+    _merge_discount_usage("user_id") + _merge_discount_usage("guest_id")
+    + _single_active_cart("user_id") + _single_active_cart("guest_id")
+)
@@ -0,0 +1,29 @@
+"""熱賣排行（product_sales_stats / product_sales_daily）依既有訂單回填
+
+v0002 建出來的兩張表是空的，結帳才開始累加：沒回填前熱賣排行、訪客推薦只會列出還沒賣過的商品
+跟 SalesRankService.rebuild 相同的 INSERT … SELECT；兩張表都空的時候才執行（已經跑過 rebuild_sales_stats.py 的資料庫不動）
+每日銷量只回填最近 30 天（= SALES_RANK_WINDOWS 最大的視窗；migration 不 import 程式碼，改視窗時另外處理）
+"""
+
+# 先填每日銷量：判斷「還沒回填」的條件是累計銷量為空，累計銷量要最後填
+STEPS = [
+    """
+    INSERT INTO product_sales_daily (product_id, day, quantity)
+    SELECT oi.product_id, o.order_date::date, sum(oi.quantity)
+    FROM order_items oi
+    JOIN orders o ON o.id = oi.order_id
+    WHERE oi.product_id IS NOT NULL
+      AND o.order_date >= current_date - 29
+      AND NOT EXISTS (SELECT 1 FROM product_sales_stats)
+      AND NOT EXISTS (SELECT 1 FROM product_sales_daily)
+    GROUP BY oi.product_id, o.order_date::date
+    """,
+    """
+    INSERT INTO product_sales_stats (product_id, total_sold, order_count, updated_at)
+    SELECT product_id, sum(quantity), count(id), now()
+    FROM order_items
+    WHERE product_id IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM product_sales_stats)
+    GROUP BY product_id
+    """,
+]
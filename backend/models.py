@@ -1,9 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Enum
+from sqlalchemy import Enum, event, inspect, DDL
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 
+# 資料表 / 欄位 / 索引有變動時，在 migrations/ 加一個新版本（測試會比對 migration 建出的 schema 與這裡的定義）
 db = SQLAlchemy()
 
 class Category(db.Model):
@@ -41,8 +42,18 @@ class Product(db.Model):
     images = db.Column(JSONB)
     is_active = db.Column(db.Boolean, default=True)  # True: 上架, False: 下架
     category = db.relationship('Category', backref=db.backref('products', lazy=True))
+
+    # 全文檢索文件（標題權重 A、描述權重 B），存成 generated column：GIN 索引與 ts_rank 都直接讀，不必逐列重算 to_tsvector
+    # deferred：一般查商品不會載入這個欄位
+    search_vector = db.deferred(db.Column(TSVECTOR, db.Computed(
+        "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(description, '')), 'B')",
+        persisted=True
+    )))
     __table_args__ = (
         db.UniqueConstraint('title', 'category_id', name='unique_product_title_category'),
+        db.Index('ix_products_search', 'search_vector', postgresql_using='gin'),
+        db.Index('ix_products_title_id', 'title', 'id'),  # 商品列表排序 / keyset 分頁
     )
 
     @classmethod
@@ -58,7 +69,9 @@ class Product(db.Model):
 
     @classmethod
     def get_by_keyword(cls, keyword):
-        return cls.query.filter(cls.title.ilike(f"%{keyword}%")).all()
+        from service.search_service import ProductSearchService  # 避免循環 import
+        query, _ = ProductSearchService.apply(cls.query, keyword)
+        return query.all()
 
     @classmethod
     def get_by_min_price(cls, min_price):
@@ -72,32 +85,31 @@ class Product(db.Model):
     def get_by_price_range(cls, min_price, max_price):
         return cls.query.filter(cls.price >= min_price, cls.price <= max_price).all()
 
-    def get_current_sale(self):
+    def get_current_sale(self, sales_map=None):
+        # 有傳入 sales_map（ProductOnSale.get_current_by_product_ids 批次查好的）就直接用，不再 lazy load self.sales
+        if sales_map is not None:
+            return sales_map.get(self.id)
         now = datetime.now()
         for sale in self.sales:
             if sale.start_date <= now <= sale.end_date:
                 return sale
         return None
-    def get_final_price(self):
-        sale = self.get_current_sale()
+    def get_final_price(self, sales_map=None):
+        sale = self.get_current_sale(sales_map)
         if sale:
             return float(self.price) * sale.discount
         else:
             return float(self.price)
 
-    def to_dict(self):
-        now = datetime.now()
-        current_sale = None
+    def to_dict(self, sales_map=None):
         sale_price = None
         sale_description = None
 
         # 判斷是否有特價
-        for sale in self.sales:
-            if sale.start_date <= now <= sale.end_date:
-                current_sale = sale
-                sale_price = float(self.price) * sale.discount
-                sale_description = sale.description
-                break
+        current_sale = self.get_current_sale(sales_map)
+        if current_sale:
+            sale_price = float(self.price) * current_sale.discount
+            sale_description = current_sale.description
 
         return {
             "id": self.id,
@@ -117,6 +129,20 @@ class Product(db.Model):
         }
 
 
+# 子字串搜尋（中文沒有空白斷詞，全文檢索切不出詞）用 pg_trgm 的 GIN 索引；
+# 資料庫沒有 pg_trgm 時略過，ProductSearchService 會退回不走索引的 ILIKE
+event.listen(Product.__table__, 'after_create', DDL("""
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS ix_products_title_trgm ON products USING gin (title gin_trgm_ops);
+    CREATE INDEX IF NOT EXISTS ix_products_description_trgm ON products USING gin (description gin_trgm_ops);
+EXCEPTION WHEN others THEN
+    RAISE NOTICE 'pg_trgm is not available, trigram indexes skipped';
+END
+$$;
+"""))
+
 class User(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
@@ -127,8 +153,7 @@ class User(db.Model):
     phone = db.Column(db.String(50))
     created_at = db.Column(db.DateTime)
     role = db.Column(db.String(20), default='user')
-    line_user_id = db.Column(db.String(100), nullable=True)
-    line_user_id = db.Column(db.String(50))
+    line_user_id = db.Column(db.String(50), nullable=True, index=True)  # LINE webhook 用 LINE userId 找會員
     line_display_name = db.Column(db.String(50))
     line_picture_url = db.Column(db.String(255))
     oauth_provider = db.Column(db.String(50), nullable=True)
@@ -142,6 +167,10 @@ class User(db.Model):
     @classmethod
     def get_by_email(cls, email):
         return cls.query.filter_by(email=email).first()
+
+    @classmethod
+    def get_by_line_user_id(cls, line_user_id):
+        return cls.query.filter_by(line_user_id=line_user_id).first()
     
     def to_dict(self):
         return {
@@ -180,6 +209,12 @@ class Order(db.Model):
     discount_code_id = db.Column(db.Integer, db.ForeignKey('discount_codes.id'), nullable=True)
     discount_amount = db.Column(db.Numeric, nullable=True)  # 折扣金額，無折扣則為 NULL
     user = db.relationship('User', backref=db.backref('orders', lazy=True))
+    # 訂單列表依 (order_date, id) 排序 / keyset 分頁
+    __table_args__ = (
+        db.Index('ix_orders_order_date_id', 'order_date', 'id'),
+        db.Index('ix_orders_user_id_order_date_id', 'user_id', 'order_date', 'id'),
+        db.Index('ix_orders_guest_id_order_date_id', 'guest_id', 'order_date', 'id'),  # 訪客訂單
+    )
     
     @classmethod
     def get_by_order_id(cls, order_id):
@@ -241,7 +276,16 @@ class Cart(db.Model):
     guest_id = db.Column(db.String(64), nullable=True)   # <--- 新增
     created_at = db.Column(db.DateTime)
     status = db.Column(Enum(*CART_STATUS, name="cart_status_enum"), default='active', nullable=False)
+    # 購物車內容每變動一次（加入 / 移除 / 改數量 / 結帳）加一，快取的購物車 snapshot 用它判斷是否過期
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     user = db.relationship('User', backref=db.backref('carts', lazy=True))
+    # 每個會員 / 訪客只有一台 active 購物車；購物車操作用 (user_id | guest_id, status='active') 查詢也走這兩個索引
+    __table_args__ = (
+        db.Index('uq_carts_active_user', 'user_id',
+                 unique=True, postgresql_where=db.text("status = 'active' AND user_id IS NOT NULL")),
+        db.Index('uq_carts_active_guest', 'guest_id',
+                 unique=True, postgresql_where=db.text("status = 'active' AND guest_id IS NOT NULL")),
+    )
     
     def to_dict(self):
         return {
@@ -249,6 +293,7 @@ class Cart(db.Model):
             "user_id": self.user_id,
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "status": self.status,
+            "version": self.version,
         }
 
 class CartItem(db.Model):
@@ -261,6 +306,7 @@ class CartItem(db.Model):
     product = db.relationship('Product')
     __table_args__ = (
         db.UniqueConstraint('cart_id', 'product_id', name='unique_cart_product'),
+        db.Index('ix_cart_items_product_id', 'product_id'),  # 特價通知：用商品找購物車
     )
     def to_dict(self):
         return {
@@ -313,6 +359,28 @@ class ProductOnSale(db.Model):
 
     product = db.relationship('Product', backref=db.backref('sales', lazy=True))
 
+    @classmethod
+    def get_current_by_product_ids(cls, product_ids, now=None):
+        """
+        一次查出多個商品「目前進行中」的特價，回傳 {product_id: ProductOnSale}
+        取代列表頁每個商品各自 lazy load product.sales（N+1 查詢）
+        """
+        product_ids = {pid for pid in product_ids if pid is not None}
+        if not product_ids:
+            return {}
+        now = now or datetime.now()
+        sales = (
+            cls.query
+            .filter(cls.product_id.in_(product_ids), cls.start_date <= now, cls.end_date >= now)
+            .order_by(cls.id)
+            .all()
+        )
+        sales_map = {}
+        for sale in sales:
+            # 同一商品有多筆重疊特價時，與 get_current_sale 一樣取第一筆
+            sales_map.setdefault(sale.product_id, sale)
+        return sales_map
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -323,6 +391,96 @@ class ProductOnSale(db.Model):
             "description": self.description,
         }
 
+class ProductPrice(db.Model):
+    """
+    商品目前有效售價的預先計算投影（已套用進行中的特價），由 PriceService 維護
+    valid_until = 下一次特價開始/結束的時間，過了這個時間這筆投影就不可信，需重新計算
+    """
+    __tablename__ = 'product_prices'
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), primary_key=True)
+    final_price = db.Column(db.Numeric, nullable=False)  # 特價後售價（沒特價 = 原價），供 SQL 價格篩選
+    sale_id = db.Column(db.Integer, db.ForeignKey('products_on_sale.id', ondelete='SET NULL'), nullable=True)
+    valid_until = db.Column(db.DateTime, nullable=True, index=True)  # NULL = 之後沒有任何特價異動
+    refreshed_at = db.Column(db.DateTime, default=datetime.now)
+
+    sale = db.relationship('ProductOnSale', lazy='joined')
+
+    def is_fresh(self, now=None):
+        now = now or datetime.now()
+        return self.valid_until is None or now < self.valid_until
+
+# 特價或原價被任何方式修改（含直接寫 ORM）時，同一個 transaction 內刪掉該商品的價格投影，
+# 讀取端找不到投影就會改用即時計算，之後再由 PriceService.refresh 補回
+def _drop_product_price(connection, product_id):
+    if product_id is not None:
+        connection.execute(
+            ProductPrice.__table__.delete().where(ProductPrice.__table__.c.product_id == product_id)
+        )
+
+@event.listens_for(ProductOnSale, 'after_insert')
+@event.listens_for(ProductOnSale, 'after_update')
+@event.listens_for(ProductOnSale, 'after_delete')
+def _product_sale_changed(mapper, connection, target):
+    _drop_product_price(connection, target.product_id)
+    product_id_history = inspect(target).attrs.product_id.history
+    for old_product_id in product_id_history.deleted or ():
+        _drop_product_price(connection, old_product_id)
+
+@event.listens_for(Product, 'after_update')
+def _product_price_changed(mapper, connection, target):
+    if inspect(target).attrs.price.history.has_changes():
+        _drop_product_price(connection, target.id)
+
+class ProductSalesStat(db.Model):
+    """
+    商品累計銷量 / 訂單明細筆數（熱賣排行榜、分類熱門推薦），結帳時跟訂單同一個交易累加，由 SalesRankService 維護
+    排行直接走 (total_sold, product_id) 索引取前 N 名，不必每次彙總 order_items
+    """
+    __tablename__ = 'product_sales_stats'
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), primary_key=True)
+    total_sold = db.Column(db.Integer, nullable=False, default=0)
+    order_count = db.Column(db.Integer, nullable=False, default=0)  # 訂單明細筆數（分類熱門推薦的排序依據）
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+    __table_args__ = (
+        db.Index('ix_product_sales_stats_total_sold', 'total_sold', 'product_id'),
+    )
+
+class ProductSalesDaily(db.Model):
+    """商品每日銷量（近 7 / 30 天排行用），只加總視窗內的天數，不必掃全部訂單明細"""
+    __tablename__ = 'product_sales_daily'
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.Index('ix_product_sales_daily_day', 'day', 'product_id'),
+    )
+
+class ProductCopurchase(db.Model):
+    """
+    商品共同購買次數（item-item 共現矩陣的非零項，兩個方向各存一筆）：同時買過兩個商品的會員數
+    由 CopurchaseService 批次建立 / 增量累加，線上推薦不直接讀這張表
+    """
+    __tablename__ = 'product_copurchases'
+    # 衍生資料、筆數是商品數的平方級：不設外鍵，批次 COPY 時不必逐列檢查；刪除的商品在 rebuild 時清掉
+    product_id = db.Column(db.Integer, primary_key=True)
+    other_product_id = db.Column(db.Integer, primary_key=True)
+    users = db.Column(db.Integer, nullable=False, default=0)
+
+class ProductNeighbor(db.Model):
+    """每個商品共同購買次數最多的前 K 個商品，線上協同過濾推薦只查這張表"""
+    __tablename__ = 'product_neighbors'
+    # 同 product_copurchases 不設外鍵；讀取時會再用上架中的商品過濾
+    product_id = db.Column(db.Integer, primary_key=True)
+    neighbor_id = db.Column(db.Integer, primary_key=True)
+    score = db.Column(db.Integer, nullable=False)
+
+class JobWatermark(db.Model):
+    """批次工作的進度（已處理到的最大 id），增量工作下次從這裡接著做"""
+    __tablename__ = 'job_watermarks'
+    name = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
 class DiscountCode(db.Model):
     __tablename__ = "discount_codes"
     id = db.Column(db.Integer, primary_key=True)
@@ -394,6 +552,13 @@ class UserDiscountCode(db.Model):
     discount_code_id = db.Column(db.Integer, db.ForeignKey('discount_codes.id'), nullable=False)
     used_count = db.Column(db.Integer, default=0)
     last_used_at = db.Column(db.DateTime, default=datetime.now)
+    __table_args__ = (
+        # 每個會員 / 訪客對同一個折扣碼只有一列，使用次數用 upsert 累加
+        db.Index('uq_user_discount_codes_user', 'user_id', 'discount_code_id',
+                 unique=True, postgresql_where=db.text('user_id IS NOT NULL')),
+        db.Index('uq_user_discount_codes_guest', 'guest_id', 'discount_code_id',
+                 unique=True, postgresql_where=db.text('guest_id IS NOT NULL')),
+    )
 
 class OrderShipping(db.Model):
     __tablename__ = 'order_shipping'
@@ -415,3 +580,66 @@ class OrderShipping(db.Model):
             "recipient_phone": self.recipient_phone,
             "store_name": self.store_name
         }
+
+class NotificationJob(db.Model):
+    """
+    通知工作（email / LINE 推播），跟訂單寫在同一個交易裡，由 notification_worker 取出執行
+    status：pending（等待執行 / 等待重試）、running（worker 執行中）
+    成功就刪除；超過 max_attempts 次失敗就搬到 notification_dead_letters
+    """
+    __tablename__ = 'notification_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)        # 例如 'order_created_email'
+    payload = db.Column(JSONB, nullable=False, default=dict)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.now)  # 下次可執行時間（重試會往後延）
+    locked_at = db.Column(db.DateTime, nullable=True)      # worker 取走的時間，逾時視為 worker 掛掉可再被取走
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_notification_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+class NotificationDeadLetter(db.Model):
+    __tablename__ = 'notification_dead_letters'
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, nullable=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(JSONB, nullable=False, default=dict)
+    attempts = db.Column(db.Integer, nullable=False)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)                    # 原始工作建立時間
+    failed_at = db.Column(db.DateTime, default=datetime.now)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "payload": self.payload,
+            "attempts": self.attempts,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "failed_at": self.failed_at.isoformat() if self.failed_at else None,
+        }
+
+class EmailOutbox(db.Model):
+    """
+    寄信紀錄（outbox）：每封信一筆，dedupe_key 唯一
+    同一個通知重跑（worker 重試、重複排程）時，已寄出的不會再寄；失敗的保留錯誤訊息，下次重試再寄
+    status：pending / sent / failed
+    """
+    __tablename__ = 'email_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    dedupe_key = db.Column(db.String(320), nullable=False, unique=True)  # 例如 'order_created:123'
+    to_email = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    sent_at = db.Column(db.DateTime)
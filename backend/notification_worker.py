@@ -0,0 +1,53 @@
+# backend/notification_worker.py
+# 通知 worker：從 notification_jobs 取工作，寄送 email / LINE 推播（失敗會重試，超過次數搬到 notification_dead_letters）
+#   python notification_worker.py                 # 常駐，沒工作時每 NOTIFY_POLL_INTERVAL 秒查一次
+#   python notification_worker.py --once          # 跑到佇列清空就結束（可交給 cron）
+#   python notification_worker.py --requeue-dead  # 把 dead letter 全部放回佇列
+# 可以同時開多個 worker，取工作用 FOR UPDATE SKIP LOCKED，不會重複寄送
+import argparse
+import signal
+import time
+from app import create_app
+from models import db
+from service.notification_service import NotificationService
+
+stopping = False
+
+def _stop(signum, frame):
+    global stopping
+    stopping = True
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--once", action="store_true")
+    parser.add_argument("--requeue-dead", action="store_true")
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    app = create_app()
+    with app.app_context():
+        if args.requeue_dead:
+            print(f"✅ 已放回 {NotificationService.requeue_dead_letters()} 筆 dead letter")
+            return
+        poll_interval = app.config.get("NOTIFY_POLL_INTERVAL", 2)
+        # 目前這批做完才檢查 stopping，收到 SIGTERM 不會中斷寄到一半的工作
+        while not stopping:
+            try:
+                count = NotificationService.run_pending()
+            except Exception as e:
+                db.session.rollback()
+                print(f"[notify] worker 取工作失敗: {e}")
+                count = 0
+            finally:
+                db.session.remove()
+            if count:
+                print(f"✅ 已處理 {count} 筆通知")
+                continue
+            if args.once:
+                break
+            time.sleep(poll_interval)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+# backend/rebuild_sales_stats.py
+# 依 order_items 重算熱賣排行榜（product_sales_stats / product_sales_daily）
+# 平常由結帳即時累加，升級時由 migration v0005 回填；只有匯入舊訂單、或排行榜跟訂單對不上時才需要重建
+#   python rebuild_sales_stats.py                        # 全部重算
+#   python rebuild_sales_stats.py --prune                # 只清掉超出最大統計視窗的每日銷量（可交給 cron 每天跑）
+#   python rebuild_sales_stats.py --prune --loop 86400   # 常駐，每天清一次（Dockerfile / docker-compose 預設啟動）
+import sys
+import time
+import traceback
+from app import create_app
+from models import db
+from service.sales_rank_service import SalesRankService
+
+def main():
+    app = create_app()
+    args = sys.argv[1:]
+    with app.app_context():
+        if "--prune" not in args:
+            count = SalesRankService.rebuild()
+            print(f"✅ 已重建 {count} 個商品的銷量排行")
+            return
+        interval = int(args[args.index("--loop") + 1]) if "--loop" in args else None
+        while True:
+            try:
+                count = SalesRankService.prune()
+                print(f"✅ 已清除 {count} 筆過期的每日銷量")
+            except Exception as e:
+                if not interval:
+                    raise
+                # 常駐模式：這一輪失敗下一輪再清，過期的每日銷量不影響視窗排行的結果
+                db.session.rollback()
+                traceback.print_exc()
+                print("清除過期每日銷量失敗:", e, file=sys.stderr)
+            finally:
+                db.session.remove()
+            if not interval:
+                break
+            time.sleep(interval)
+
+if __name__ == "__main__":
+    main()
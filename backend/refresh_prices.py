@@ -0,0 +1,44 @@
+# backend/refresh_prices.py
+# 補算商品有效售價投影（product_prices）：特價窗口開始/結束、或尚未建立投影的商品
+#   python refresh_prices.py              # 跑一輪（可交給 cron）
+#   python refresh_prices.py --loop 60    # 常駐，每 60 秒跑一輪（Dockerfile / docker-compose 預設啟動）
+import sys
+import time
+import traceback
+from app import create_app
+from models import db
+from service.price_service import PriceService
+
+def refresh_until_done():
+    total = 0
+    while True:
+        count = PriceService.refresh_due()
+        total += count
+        if count == 0:
+            return total
+
+def main():
+    app = create_app()
+    interval = None
+    if len(sys.argv) >= 3 and sys.argv[1] == "--loop":
+        interval = int(sys.argv[2])
+    with app.app_context():
+        while True:
+            try:
+                total = refresh_until_done()
+                print(f"✅ 已更新 {total} 筆商品有效售價")
+            except Exception as e:
+                if not interval:
+                    raise
+                # 常駐模式：這一輪失敗下一輪再試（到期的投影還在，下一輪會再撈到）
+                db.session.rollback()
+                traceback.print_exc()
+                print("商品有效售價更新失敗:", e, file=sys.stderr)
+            finally:
+                db.session.remove()
+            if not interval:
+                break
+            time.sleep(interval)
+
+if __name__ == "__main__":
+    main()
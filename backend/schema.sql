@@ -1,3 +1,4 @@
+-- 參考用的完整 schema；實際的資料庫由 migrations/ 建立與升級（python migrate.py upgrade）
 CREATE TABLE categories (
     id SERIAL PRIMARY KEY,
     name VARCHAR(100) UNIQUE NOT NULL,
@@ -12,8 +13,19 @@ CREATE TABLE products (
     category_id INTEGER REFERENCES categories(id),
     images JSONB,
     is_active BOOLEAN DEFAULT TRUE,
+    -- 全文檢索文件（標題權重 A、描述權重 B）
+    search_vector TSVECTOR GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'B')
+    ) STORED,
     CONSTRAINT unique_product_title_category UNIQUE (title, category_id)
 );
+CREATE INDEX ix_products_search ON products USING gin (search_vector);
+CREATE INDEX ix_products_title_id ON products (title, id);
+-- 選用：有 pg_trgm 時支援 ILIKE '%kw%'（中文子字串）走索引
+-- CREATE EXTENSION IF NOT EXISTS pg_trgm;
+-- CREATE INDEX ix_products_title_trgm ON products USING gin (title gin_trgm_ops);
+-- CREATE INDEX ix_products_description_trgm ON products USING gin (description gin_trgm_ops);
 
 CREATE TABLE users (
     id SERIAL PRIMARY KEY,
@@ -24,8 +36,14 @@ CREATE TABLE users (
     address TEXT,
     phone VARCHAR(50),
     created_at TIMESTAMP,
-    role VARCHAR(20) DEFAULT 'user'
+    role VARCHAR(20) DEFAULT 'user',
+    line_user_id VARCHAR(50),
+    line_display_name VARCHAR(50),
+    line_picture_url VARCHAR(255),
+    oauth_provider VARCHAR(50),
+    google_sub VARCHAR(255) UNIQUE
 );
+CREATE INDEX ix_users_line_user_id ON users (line_user_id);
 
 CREATE TYPE order_status_enum AS ENUM (
     'pending', 'paid', 'processing', 'shipped',
@@ -42,6 +60,9 @@ CREATE TABLE orders (
     status order_status_enum NOT NULL DEFAULT 'pending',
     discount_code_id INTEGER REFERENCES discount_codes(id)
 );
+CREATE INDEX ix_orders_order_date_id ON orders (order_date, id);
+CREATE INDEX ix_orders_user_id_order_date_id ON orders (user_id, order_date, id);
+CREATE INDEX ix_orders_guest_id_order_date_id ON orders (guest_id, order_date, id);
 
 CREATE TABLE order_items (
     id SERIAL PRIMARY KEY,
@@ -59,8 +80,11 @@ CREATE TABLE carts (
     user_id INTEGER REFERENCES users(id),
     guest_id VARCHAR(64) NULL,
     created_at TIMESTAMP,
-    status cart_status_enum NOT NULL DEFAULT 'active'
+    status cart_status_enum NOT NULL DEFAULT 'active',
+    version INTEGER NOT NULL DEFAULT 0
 );
+CREATE UNIQUE INDEX uq_carts_active_user ON carts (user_id) WHERE status = 'active' AND user_id IS NOT NULL;
+CREATE UNIQUE INDEX uq_carts_active_guest ON carts (guest_id) WHERE status = 'active' AND guest_id IS NOT NULL;
 
 CREATE TABLE cart_items (
     id SERIAL PRIMARY KEY,
@@ -69,6 +93,7 @@ CREATE TABLE cart_items (
     quantity INTEGER NOT NULL DEFAULT 1,
     CONSTRAINT unique_cart_product UNIQUE (cart_id, product_id)
 );
+CREATE INDEX ix_cart_items_product_id ON cart_items (product_id);
 
 CREATE TABLE audit_logs (
     id SERIAL PRIMARY KEY,
@@ -99,6 +124,52 @@ CREATE TABLE products_on_sale (
     description TEXT
 );
 
+-- 商品有效售價投影（特價已套用），由 PriceService 維護
+CREATE TABLE product_prices (
+    product_id INTEGER PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+    final_price NUMERIC NOT NULL,
+    sale_id INTEGER REFERENCES products_on_sale(id) ON DELETE SET NULL,
+    valid_until TIMESTAMP,
+    refreshed_at TIMESTAMP
+);
+CREATE INDEX ix_product_prices_valid_until ON product_prices (valid_until);
+
+CREATE TABLE product_sales_stats (
+    product_id INTEGER PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+    total_sold INTEGER NOT NULL DEFAULT 0,
+    order_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP
+);
+CREATE INDEX ix_product_sales_stats_total_sold ON product_sales_stats (total_sold, product_id);
+
+CREATE TABLE product_sales_daily (
+    product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+    day DATE,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (product_id, day)
+);
+CREATE INDEX ix_product_sales_daily_day ON product_sales_daily (day, product_id);
+
+CREATE TABLE product_copurchases (
+    product_id INTEGER,
+    other_product_id INTEGER,
+    users INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (product_id, other_product_id)
+);
+
+CREATE TABLE product_neighbors (
+    product_id INTEGER,
+    neighbor_id INTEGER,
+    score INTEGER NOT NULL,
+    PRIMARY KEY (product_id, neighbor_id)
+);
+
+CREATE TABLE job_watermarks (
+    name VARCHAR(50) PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP
+);
+
 CREATE TABLE discount_codes (
     id SERIAL PRIMARY KEY,
     code VARCHAR(50) UNIQUE NOT NULL,
@@ -117,12 +188,15 @@ CREATE TABLE discount_codes (
 
 CREATE TABLE user_discount_codes (
     id SERIAL PRIMARY KEY,
-    user_id INTEGER REFERENCES users(id) NOT NULL,
+    user_id INTEGER REFERENCES users(id) NULL,
     guest_id VARCHAR(64) NULL,
     discount_code_id INTEGER REFERENCES discount_codes(id) NOT NULL,
     used_count INTEGER DEFAULT 0,
     last_used_at TIMESTAMP DEFAULT now()
 );
+-- 每個會員 / 訪客對同一個折扣碼只有一列（使用次數用 upsert 累加）
+CREATE UNIQUE INDEX uq_user_discount_codes_user ON user_discount_codes (user_id, discount_code_id) WHERE user_id IS NOT NULL;
+CREATE UNIQUE INDEX uq_user_discount_codes_guest ON user_discount_codes (guest_id, discount_code_id) WHERE guest_id IS NOT NULL;
 CREATE TABLE chat_messages (
     id SERIAL PRIMARY KEY,
     user_id INTEGER NOT NULL REFERENCES users(id),
@@ -130,3 +204,41 @@ CREATE TABLE chat_messages (
     message TEXT NOT NULL,
     created_at TIMESTAMP DEFAULT NOW()
 );
+
+CREATE TABLE notification_jobs (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',   -- pending / running
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    locked_at TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX ix_notification_jobs_status_run_at ON notification_jobs (status, run_at);
+
+CREATE TABLE notification_dead_letters (
+    id SERIAL PRIMARY KEY,
+    job_id INTEGER,
+    kind VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    attempts INTEGER NOT NULL,
+    error TEXT,
+    created_at TIMESTAMP,
+    failed_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE email_outbox (
+    id SERIAL PRIMARY KEY,
+    dedupe_key VARCHAR(320) NOT NULL UNIQUE,
+    to_email VARCHAR(255) NOT NULL,
+    subject VARCHAR(255) NOT NULL,
+    html TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',   -- pending / sent / failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
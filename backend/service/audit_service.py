@@ -1,18 +1,57 @@
 from models import db, AuditLog
+from flask import current_app
+from datetime import datetime
+from sqlalchemy import insert
+from service.unit_of_work import maybe_commit, in_unit_of_work
+from service.audit_writer import get_audit_writer
 class AuditService:
+    """
+    寫入操作日誌
+    - unit_of_work 內：日誌跟著交易一起 commit / rollback
+    - AUDIT_ASYNC 開啟時：放進背景 writer 批次寫入，請求不必為日誌多 commit；queue 滿了改成同步寫入
+    - 其他情況：同步寫入並 commit
+    """
+    @staticmethod
+    def _build_row(user_id=None, guest_id=None, action=None, target_type=None, target_id=None, description=None):
+        return {
+            "user_id": user_id if isinstance(user_id, int) else None,
+            "guest_id": guest_id if isinstance(guest_id, str) else None,
+            "action": action,
+            "target_type": target_type,
+            "target_id": target_id,
+            "description": description,
+        }
+
+    @staticmethod
+    def _enqueue(rows):
+        """非同步模式下放進 writer，回傳沒放進去（要同步寫）的 rows"""
+        if in_unit_of_work() or not current_app.config.get("AUDIT_ASYNC"):
+            return rows
+        writer = get_audit_writer(current_app.config)
+        now = datetime.now()
+        return [row for row in rows if not writer.enqueue({**row, "created_at": now})]
+
     @staticmethod
     def log(user_id=None, guest_id=None, action=None, target_type=None, target_id=None, description=None):
-        if user_id is not None and not isinstance(user_id, int):
-            user_id = None
-        if guest_id is not None and not isinstance(guest_id, str):
-            guest_id = None
-        log = AuditLog(
-            user_id=user_id,
-            guest_id=guest_id,
-            action=action,
-            target_type=target_type,
-            target_id=target_id,
-            description=description
-        )
-        db.session.add(log)
-        db.session.commit()
+        row = AuditService._build_row(user_id, guest_id, action, target_type, target_id, description)
+        if not AuditService._enqueue([row]):
+            return
+        db.session.add(AuditLog(**row))
+        maybe_commit()
+
+    @staticmethod
+    def log_many(entries):
+        """
+        一次寫入多筆日誌（單一 INSERT），entries 為 log() 參數組成的 dict list
+        """
+        rows = AuditService._enqueue([AuditService._build_row(**entry) for entry in entries])
+        if not rows:
+            return
+        db.session.execute(insert(AuditLog), rows)
+        maybe_commit()
+
+    @staticmethod
+    def flush():
+        """等背景 writer 把已排隊的日誌寫完（測試/離線腳本用）"""
+        if current_app.config.get("AUDIT_ASYNC"):
+            get_audit_writer(current_app.config).flush()
@@ -0,0 +1,156 @@
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+from sqlalchemy import insert
+from models import db, AuditLog
+
+_WAKE_UP = object()
+
+class AuditWriter:
+    """
+    非同步日誌寫入：AuditService.log 把日誌放進有上限的 queue，背景執行緒累積到 batch_size 筆
+    或等滿 flush_interval 秒就用一個多列 INSERT 寫入，請求不用再為日誌多 commit 一次
+    - 背壓：queue 滿了等 put_timeout 秒仍放不進去，enqueue 回傳 False，由呼叫端改成同步寫入（不丟日誌）
+    - 關閉：close() 會把 queue 內剩下的日誌寫完；process 結束時由 atexit 呼叫
+    """
+
+    def __init__(self, engine, batch_size=200, flush_interval=1.0, max_queue=10000, put_timeout=0.05, max_retries=3):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stopping = threading.Event()
+        self._thread = None
+        # 統計
+        self.enqueued = 0
+        self.written = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def enqueue(self, row):
+        if self._stopping.is_set():
+            return False
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def flush(self):
+        """等 queue 內目前的日誌都寫入為止"""
+        self._queue.join()
+
+    def close(self):
+        self._stopping.set()
+        try:
+            self._queue.put_nowait(_WAKE_UP)  # 叫醒等待中的執行緒，不必等滿 flush_interval
+        except queue.Full:
+            pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # 執行緒停止後還留在 queue 的（例如執行緒從沒啟動），直接寫掉
+        self._drain_remaining()
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if first is _WAKE_UP:
+                self._queue.task_done()
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stopping.is_set():
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # 停止中：把剩下的也一起帶走
+            while self._stopping.is_set() and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [row for row in batch if row is not _WAKE_UP]
+            if rows:
+                self._write(rows)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _drain_remaining(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        rows = [row for row in batch if row is not _WAKE_UP]
+        for start in range(0, len(rows), self.batch_size):
+            self._write(rows[start:start + self.batch_size])
+        for _ in batch:
+            self._queue.task_done()
+
+    def _write(self, batch):
+        for attempt in range(self.max_retries):
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(insert(AuditLog.__table__), batch)
+                self.written += len(batch)
+                return
+            except Exception as e:
+                print(f"[audit-writer] 寫入 {len(batch)} 筆日誌失敗（第 {attempt + 1} 次）: {e}", file=sys.stderr)
+                time.sleep(min(0.1 * 2 ** attempt, 2))
+        self.dropped += len(batch)
+        print(f"[audit-writer] 放棄 {len(batch)} 筆日誌", file=sys.stderr)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_audit_writer(config):
+    """
+    取得目前 process 的 writer（第一次使用才啟動）
+    gunicorn fork 出 worker 後 pid 不同，會在 worker 內重新建立，不沿用 master 的執行緒與 queue
+    """
+    global _writer
+    engine = db.engine
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid() or _writer.engine is not engine:
+            if _writer is not None and _writer.pid == os.getpid():
+                _writer.close()
+            _writer = AuditWriter(
+                engine,
+                batch_size=config.get("AUDIT_BATCH_SIZE", 200),
+                flush_interval=config.get("AUDIT_FLUSH_INTERVAL", 1.0),
+                max_queue=config.get("AUDIT_QUEUE_SIZE", 10000),
+            ).start()
+        return _writer
+
+def shutdown_audit_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is not None and _writer.pid == os.getpid():
+            _writer.close()
+        _writer = None
+
+atexit.register(shutdown_audit_writer)
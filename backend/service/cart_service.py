@@ -1,10 +1,18 @@
-from models import db, Cart, CartItem, Product, Order, OrderItem, User
+import hashlib
+import json
+from models import db, Cart, CartItem, Product
 from datetime import datetime
+from cache import cache, set_tagged, product_tag, record_hit
 from exceptions import NotFoundError
 from service.audit_service import AuditService
 from service.discount_service import DiscountService
 from service.order_service import OrderService
-from utils.notify_util import send_email_notify_order_created, send_line_notify_order_created
+from service.notification_service import NotificationService
+from service.price_service import PriceService
+from service.recommendation_service import RecommendationService, CART_KINDS
+from service.sales_rank_service import SalesRankService
+from service.unit_of_work import unit_of_work
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import joinedload
 
 class CartService:
@@ -18,29 +26,25 @@ class CartService:
             raise  ValueError("user_id 或 guest_id 必須至少有一個")
         if user_id and  guest_id:
             raise  ValueError("user_id 或 guest_id 只能傳入一個")
-        filter_args = {"status": "active"}
-        if user_id:
-            filter_args["user_id"] = user_id
-        else: 
-            filter_args["guest_id"] = guest_id
-       
-
         cart = (
-            Cart.query
+            CartService._active_cart_query(user_id, guest_id)
             .options(joinedload(Cart.cart_items).joinedload(CartItem.product))
-            .filter_by(**filter_args)
-            .order_by(Cart.created_at.desc())
             .first()
         )
         if not cart:
             return None
-        # 寫入購物車商品明細
+        return CartService._serialize_cart(cart)
+
+    @staticmethod
+    def _serialize_cart(cart):
+        # 寫入購物車商品明細（特價一次批次查詢）
+        sales_map = PriceService.get_sales_map([item.product_id for item in cart.cart_items])
         items = []
         for item in cart.cart_items:
             product = item.product
             if not product or not product.is_active:
                 continue
-            final_price = product.get_final_price() if product else 0
+            final_price = product.get_final_price(sales_map) if product else 0
             items.append({
                 "product_id": item.product_id,
                 "title": product.title if product else None,
@@ -53,6 +57,92 @@ class CartService:
         res["items"] = items
         return res
     
+    SNAPSHOT_CACHE_TIMEOUT = 300
+
+    @staticmethod
+    def get_cart_snapshot(user_id=None, guest_id=None):
+        """
+        get_cart 的快取版本，回傳 (購物車資料, etag)；沒有購物車回傳 (None, None)
+        - 先只查購物車 id / version（不 join 明細、商品），快取中同版本的 snapshot 直接回傳
+        - 購物車內容變動時 version 加一；商品改價 / 特價 / 上下架時透過 product:<id> 標籤失效；
+          TTL 不超過明細商品下一次特價開始 / 結束
+        - etag 是內容的 hash，前端帶 If-None-Match 且沒變就回 304
+        """
+        if (not user_id) and (not guest_id):
+            raise  ValueError("user_id 或 guest_id 必須至少有一個")
+        if user_id and  guest_id:
+            raise  ValueError("user_id 或 guest_id 只能傳入一個")
+        head = CartService._active_cart_query(user_id, guest_id).with_entities(Cart.id, Cart.version).first()
+        if not head:
+            return None, None
+        key = f"carts:snapshot:{head.id}"
+        snapshot = cache.get(key)
+        fresh = snapshot is not None and snapshot["version"] == head.version
+        record_hit("cart_snapshot", fresh)
+        if fresh:
+            return snapshot["data"], snapshot["etag"]
+
+        now = datetime.now()
+        cart = (
+            Cart.query
+            .options(joinedload(Cart.cart_items).joinedload(CartItem.product))
+            .filter_by(id=head.id)
+            .first()
+        )
+        if not cart:
+            return None, None
+        data = CartService._serialize_cart(cart)
+        etag = hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        # 版本用這次載入的（跟上面查到的之間可能又被改過）
+        snapshot = {"version": cart.version, "etag": etag, "data": data}
+        # 已下架而沒顯示的商品也要掛標籤：重新上架時 snapshot 才會失效
+        product_ids = [item.product_id for item in cart.cart_items]
+        timeout = CartService.SNAPSHOT_CACHE_TIMEOUT
+        next_change = PriceService.next_change_many(product_ids, now=now)
+        if next_change is not None:
+            timeout = max(1, min(timeout, int((next_change - now).total_seconds())))
+        set_tagged(key, snapshot, [product_tag(pid) for pid in product_ids], timeout=timeout)
+        return data, etag
+
+    @staticmethod
+    def _touch(cart):
+        """購物車內容變動：version 加一（在資料庫端加，同時修改不會少算），快取的 snapshot 因此過期"""
+        cart.version = Cart.version + 1
+
+    @staticmethod
+    def _active_cart_query(user_id=None, guest_id=None):
+        """
+        目前 active 購物車的查詢（未執行）：每人只有一台 active 購物車，不必排序，直接走 uq_carts_active_user / guest
+        購物車的查詢都從這裡建，test_query_plans 也用它檢查執行計畫
+        """
+        owner = Cart.user_id if user_id else Cart.guest_id
+        return Cart.query.filter(owner == (user_id or guest_id), Cart.status == 'active')
+
+    @staticmethod
+    def _cart_item_query(cart_id, product_id):
+        """購物車內某個商品的明細（未執行）"""
+        return CartItem.query.filter_by(cart_id=cart_id, product_id=product_id)
+
+    @staticmethod
+    def _get_or_create_active_cart(user_id=None, guest_id=None):
+        """
+        目前 active 的購物車，沒有就新建並 commit
+        每人只能有一台 active 購物車（uq_carts_active_user / guest）：同時第一次加入購物車的請求
+        用 INSERT ... ON CONFLICT DO NOTHING 建立，沒搶到的再查一次拿到同一台
+        """
+        owner = Cart.user_id if user_id else Cart.guest_id
+        query = CartService._active_cart_query(user_id, guest_id)
+        cart = query.first()
+        if cart:
+            return cart
+        db.session.execute(
+            insert(Cart)
+            .values(user_id=user_id, guest_id=guest_id, created_at=datetime.now(), status='active', version=0)
+            .on_conflict_do_nothing(index_elements=[owner], index_where=(Cart.status == 'active') & owner.isnot(None))
+        )
+        db.session.commit()
+        return query.one()
+
     @staticmethod
     def add_to_cart(user_id=None, guest_id=None, product_id=None, quantity=1):
         """
@@ -65,19 +155,9 @@ class CartService:
             raise  ValueError("user_id 或 guest_id 必須至少有一個")
         if user_id and  guest_id:
             raise  ValueError("user_id 或 guest_id 只能傳入一個")
-        filter_args = {"status": "active"}
-        if user_id:
-            filter_args["user_id"] = user_id
-        else: 
-            filter_args["guest_id"] = guest_id
-       
 
         # 取得現有購物車或新建
-        cart = Cart.query.filter_by(**filter_args).order_by(Cart.created_at.desc()).first()
-        if not cart:
-            cart = Cart(user_id=user_id, guest_id=guest_id, created_at=datetime.now(), status='active')
-            db.session.add(cart)
-            db.session.commit()
+        cart = CartService._get_or_create_active_cart(user_id, guest_id)
 
         # 商品驗證
         product = Product.get_active_by_product_id(product_id)
@@ -85,12 +165,13 @@ class CartService:
             raise NotFoundError("Product not found")
 
         # 查詢商品是否已在購物車
-        cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
+        cart_item = CartService._cart_item_query(cart.id, product_id).first()
         if cart_item:
             cart_item.quantity += quantity
         else:
             cart_item = CartItem(cart_id=cart.id, product_id=product_id, quantity=quantity)
             db.session.add(cart_item)
+        CartService._touch(cart)
         db.session.commit()
         AuditService.log(
             user_id=user_id,
@@ -100,28 +181,23 @@ class CartService:
             target_id=cart_item.cart_id,
             description=f"add prodcut{product_id} quantity: {quantity} to cart{cart_item.cart_id}"
         )
+        RecommendationService.mark_stale(user_id, CART_KINDS)
         return cart_item
 
     @staticmethod
     def remove_from_cart(user_id=None, guest_id=None, product_id=None):
-        filter_args = {"status": "active"}
         if (not user_id) and (not guest_id):
             raise  ValueError("user_id 或 guest_id 必須至少有一個")
         if user_id and  guest_id:
             raise  ValueError("user_id 或 guest_id 只能傳入一個")
-        filter_args = {"status": "active"}
-        if user_id:
-            filter_args["user_id"] = user_id
-        else: 
-            filter_args["guest_id"] = guest_id
-       
-        cart = Cart.query.filter_by(**filter_args).order_by(Cart.created_at.desc()).first()
+        cart = CartService._active_cart_query(user_id, guest_id).first()
         if not cart:
             raise NotFoundError("No active cart found")
-        cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
+        cart_item = CartService._cart_item_query(cart.id, product_id).first()
         if not cart_item:
             raise ValueError("Product not in cart")
         db.session.delete(cart_item)
+        CartService._touch(cart)
         db.session.commit()
         AuditService.log(
             user_id=user_id,
@@ -131,6 +207,7 @@ class CartService:
             target_id=cart_item.id,
             description=f"Delete product_id={product_id} from cart_id={cart_item.cart_id}"
         )
+        RecommendationService.mark_stale(user_id, CART_KINDS)
         return cart_item
 
     @staticmethod
@@ -141,23 +218,17 @@ class CartService:
             raise  ValueError("user_id 或 guest_id 必須至少有一個")
         if user_id and  guest_id:
             raise  ValueError("user_id 或 guest_id 只能傳入一個")
-        filter_args = {"status": "active"}
-        if user_id:
-            filter_args["user_id"] = user_id
-        else: 
-            filter_args["guest_id"] = guest_id
-       
-        
-        cart = Cart.query.filter_by(**filter_args).order_by(Cart.created_at.desc()).first()
+        cart = CartService._active_cart_query(user_id, guest_id).first()
         if not cart:
             raise NotFoundError("No active cart found")
-        cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
+        cart_item = CartService._cart_item_query(cart.id, product_id).first()
         if not cart_item:
             raise ValueError("Product not in cart")
         old_qty = cart_item.quantity
         if old_qty == quantity:
             raise ValueError(f"quantity is already {quantity}")
         cart_item.quantity = quantity
+        CartService._touch(cart)
         db.session.commit()
         AuditService.log(
             user_id=user_id,
@@ -167,6 +238,7 @@ class CartService:
             target_id=cart_item.id,
             description=f"product_id={product_id}, cart_id={cart_item.cart_id}, qty {old_qty} -> {quantity}"
         )
+        RecommendationService.mark_stale(user_id, CART_KINDS)
         return cart_item, old_qty
 
 
@@ -180,107 +252,110 @@ class CartService:
             raise  ValueError("user_id 或 guest_id 只能傳入一個")
         
         
-        # 1. 查購物車（支援 user_id 或 guest_id）
-        cart = CartService._get_active_cart(user_id=user_id, guest_id=guest_id)
-        # 2. 驗證商品數量
-        CartService._validate_cart_items(cart, items_to_checkout)
-
-        # 3. 計算金額
-        total = CartService._caculate_items_to_checkout(items_to_checkout)
-
-        discount_amount = 0
-        discount_obj = None
-
-        # 4. 折扣碼驗證
-        if discount_code:
-            ok, msg, dc, discounted_total, discount_amount, rule_msg, used_coupon  = DiscountService.apply_discount_code(
-                user_id =user_id ,
-                guest_id=guest_id, 
-                cart=cart, 
-                code=discount_code, 
-                items_to_checkout=items_to_checkout
-            )
-            if not ok:
-                raise ValueError(f"折扣碼不可用: {msg}")
-            total = discounted_total
-            discount_obj = dc
-        else:
-            used_coupon = False  # 無折扣碼
+        # 整個結帳（訂單、明細、購物車、折扣碼、寄送資訊、日誌）同一個交易，最後只 commit 一次；失敗全部 rollback
+        with unit_of_work():
+            # 1. 查購物車（支援 user_id 或 guest_id）：購物車、明細、商品一次載入，之後都用這份 snapshot
+            cart = CartService._get_active_cart(user_id=user_id, guest_id=guest_id)
+            cart_items = {ci.product_id: ci for ci in cart.cart_items}
+            # 2. 驗證商品數量
+            CartService._validate_cart_items(cart, items_to_checkout, cart_items)
 
-        # 5. 建立訂單（支援會員/訪客）
-        order = OrderService._create_order(
-            user_id =user_id,
-            guest_id=guest_id,            # 訪客才寫入(guestemail = recipient_email !)
-            guest_email=shipping_info.get("recipient_email") if (shipping_info and guest_id) else None,
-        )
-        # 6. 寫入訂單商品 
-        CartService._add_items_to_checkout_to_order_items(items_to_checkout, order, user_id, guest_id, cart)
-        # 7. 寫入訂單金額與折扣碼資訊
-        order.total = total 
-        order.discount_code_id = discount_obj.id if discount_obj else None
-        order.discount_amount = float(discount_amount) if discount_obj else None
-
-        # 8. 寫入 shipping info
-        if shipping_info:
-            OrderService.set_shipping_info(
-                order.id,
-                shipping_info.get("shipping_method"),
-                shipping_info.get("recipient_name"),
-                shipping_info.get("recipient_phone"),
-                shipping_info.get("store_name"),
-                user_id or guest_id
+            # 3. 計算金額（特價一次批次查詢）
+            sales_map = PriceService.get_sales_map(cart_items.keys())
+            total = CartService._caculate_items_to_checkout(items_to_checkout, cart_items, sales_map)
+
+            discount_amount = 0
+            discount_obj = None
+
+            # 4. 折扣碼驗證
+            if discount_code:
+                ok, msg, dc, discounted_total, discount_amount, rule_msg, used_coupon  = DiscountService.apply_discount_code(
+                    user_id =user_id ,
+                    guest_id=guest_id, 
+                    cart=cart, 
+                    code=discount_code, 
+                    items_to_checkout=items_to_checkout,
+                    sales_map=sales_map
+                )
+                if not ok:
+                    raise ValueError(f"折扣碼不可用: {msg}")
+                total = discounted_total
+                discount_obj = dc
+            else:
+                used_coupon = False  # 無折扣碼
+
+            # 5. 建立訂單（支援會員/訪客）
+            order = OrderService._create_order(
+                user_id =user_id,
+                guest_id=guest_id,            # 訪客才寫入(guestemail = recipient_email !)
+                guest_email=shipping_info.get("recipient_email") if (shipping_info and guest_id) else None,
             )
+            # 6. 寫入訂單商品 
+            CartService._add_items_to_checkout_to_order_items(items_to_checkout, order, user_id, guest_id, cart, cart_items, sales_map)
+            sold_category_ids = {cart_items[item["product_id"]].product.category_id for item in items_to_checkout}
+            # 7. 寫入訂單金額與折扣碼資訊
+            order.total = total 
+            order.discount_code_id = discount_obj.id if discount_obj else None
+            order.discount_amount = float(discount_amount) if discount_obj else None
 
-        # 9. 記錄日誌
-        order_items_str = ", ".join([f"{item['product_id']} x {item['quantity']}" for item in items_to_checkout])
-        AuditService.log(
-            user_id=user_id,
-            guest_id=guest_id,
-            action='add_order_items',
-            target_type='order',
-            target_id=order.id,
-            description=f"Order {order.id} add items: {order_items_str}"
-        )
+            # 8. 寫入 shipping info
+            if shipping_info:
+                OrderService.set_shipping_info(
+                    order.id,
+                    shipping_info.get("shipping_method"),
+                    shipping_info.get("recipient_name"),
+                    shipping_info.get("recipient_phone"),
+                    shipping_info.get("store_name"),
+                    user_id or guest_id
+                )
 
-        # 10. consume 折扣碼
-        if discount_code and used_coupon:
-            DiscountService.consume_discount_code(user_id=user_id , guest_id=guest_id, code=discount_code)
+            # 9. 記錄日誌
+            order_items_str = ", ".join([f"{item['product_id']} x {item['quantity']}" for item in items_to_checkout])
             AuditService.log(
                 user_id=user_id,
                 guest_id=guest_id,
-                action='use',
-                target_type='discount_code',
-                target_id=discount_obj.id,
-                description=f"user {user_id or guest_id} use discount_code {discount_obj.id}"
+                action='add_order_items',
+                target_type='order',
+                target_id=order.id,
+                description=f"Order {order.id} add items: {order_items_str}"
             )
 
-        message = CartService._update_cart_status_if_empty(user_id=user_id, guest_id=guest_id, cart=cart)
-
-        db.session.commit()
+            message = CartService._update_cart_status_if_empty(user_id=user_id, guest_id=guest_id, cart=cart)
+            CartService._touch(cart)
 
-        # 日誌寫入
-        AuditService.log(
-            user_id=user_id,
-            guest_id=guest_id,
-            action='checkout',  # 建議用 'checkout'
-            target_type='order',
-            target_id = order.id,
-            description = f"Checkout order_id={order.id}, total={total}, items={items_to_checkout}"
-        )
+            # 日誌寫入
+            AuditService.log(
+                user_id=user_id,
+                guest_id=guest_id,
+                action='checkout',  # 建議用 'checkout'
+                target_type='order',
+                target_id = order.id,
+                description = f"Checkout order_id={order.id}, total={total}, items={items_to_checkout}"
+            )
+            # 通知（email / LINE）排進佇列，跟訂單一起 commit，由 notification worker 寄送
+            NotificationService.enqueue_order_created(order)
+            order_id = order.id
 
-        order_items = OrderItem.get_by_order_id(order_id=order.id)
-        # 會員/訪客查收件人
-        user = User.get_by_user_id(user_id) if user_id else None
+            # 10. consume 折扣碼：條件式更新，已達上限丟 ValueError 整筆 rollback
+            # 放在交易最後：搶購時折扣碼那一列的鎖只持有到 commit
+            if discount_code and used_coupon:
+                DiscountService.consume_discount_code(user_id=user_id, guest_id=guest_id, code=discount_code, dc=discount_obj)
+                AuditService.log(
+                    user_id=user_id,
+                    guest_id=guest_id,
+                    action='use',
+                    target_type='discount_code',
+                    target_id=discount_obj.id,
+                    description=f"user {user_id or guest_id} use discount_code {discount_obj.id}"
+                )
 
-        # ===== email訪客用戶通知  ======
-        send_email_notify_order_created(order)
-        # ===== 用戶line 訊息通知  ======
-        if user_id:
-            send_line_notify_order_created(user, order, order_items)
-        
+        # 訂單明細筆數變了，賣出商品所屬分類的熱門排行要重算
+        SalesRankService.invalidate_popular(sold_category_ids)
+        # 買過的商品、購物車內容都變了，該會員的推薦結果全部過期
+        RecommendationService.mark_stale(user_id)
         return {
             "message": message,
-            "order_id": order.id,
+            "order_id": order_id,
             "total": float(total),
             "discount_amount": float(discount_amount) if discount_code else 0,
             "discount_code": discount_code if discount_code else None
@@ -288,17 +363,11 @@ class CartService:
 
     @staticmethod
     def _get_active_cart(user_id=None, guest_id=None):
-        filter_args = {"status": "active"}
-        if user_id:
-            filter_args["user_id"] = user_id
-        elif guest_id:
-            filter_args["guest_id"] = guest_id
-        else:
+        if (not user_id) and (not guest_id):
             raise ValueError("user_id 或 guest_id 必須至少有一個")
-        cart = (Cart.query.options(
+        cart = (CartService._active_cart_query(user_id, guest_id).options(
                     joinedload(Cart.cart_items).joinedload(CartItem.product)
-                ).filter_by(**filter_args)
-                .order_by(Cart.created_at.desc())
+                )
                 .first()
                 )
         if not cart:
@@ -306,27 +375,30 @@ class CartService:
         return cart
 
     @staticmethod
-    def _validate_cart_items(cart, items_to_checkout):
+    def _validate_cart_items(cart, items_to_checkout, cart_items=None):
+        # cart_items: {product_id: CartItem}，用已載入的購物車明細比對，不再逐筆查詢
+        if cart_items is None:
+            cart_items = {ci.product_id: ci for ci in cart.cart_items}
         for item in items_to_checkout:
             product_id = item.get("product_id")
             quantity = item.get("quantity", 1)
-            cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
+            cart_item = cart_items.get(product_id)
             if not cart_item or quantity > cart_item.quantity:
                 raise ValueError(f"Product {product_id} quantity not enough in cart")
-    # 處理購物車內的結帳商品
+    # 處理購物車內的結帳商品，回傳要寫入的日誌（由呼叫端一次批次寫入）
     @staticmethod
-    def _handle_cart_item_on_checkout(user_id, guest_id, cart, product_id, quantity):
-        cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
+    def _handle_cart_item_on_checkout(user_id, guest_id, cart, cart_item, quantity):
+        product_id = cart_item.product_id
         old_quantity = cart_item.quantity
         if old_quantity == quantity:
-            db.session.delete(cart_item)
+            cart.cart_items.remove(cart_item)  # delete-orphan，flush 時刪除
             action = "remove_from_cart_on_checkout"
             desc = f"Removed product_id={product_id} from cart_id={cart.id} during checkout (qty={quantity})"
         else:
             cart_item.quantity -= quantity
             action = "update_cart_item_on_checkout"
             desc = f"Decreased product_id={product_id} in cart_id={cart.id} from {old_quantity} to {cart_item.quantity} during checkout"
-        AuditService.log(
+        return dict(
             user_id=user_id,
             guest_id=guest_id,
             action=action,
@@ -352,25 +424,31 @@ class CartService:
             return "partial checkout success"
 
     @staticmethod
-    def _caculate_items_to_checkout(items_to_checkout):
+    def _caculate_items_to_checkout(items_to_checkout, cart_items, sales_map):
         total = 0
         for item in items_to_checkout:
-            product_id = item.get("product_id")
+            cart_item = cart_items.get(item.get("product_id"))
             quantity = item.get("quantity", 1)
-            product = Product.get_by_product_id(product_id)
-            price = product.get_final_price() if product else 0
+            product = cart_item.product if cart_item else None
+            price = product.get_final_price(sales_map) if product else 0
             total += price * quantity
         return total
     
     @staticmethod
-    def _add_items_to_checkout_to_order_items(items_to_checkout,order,user_id, guest_id,cart):
+    def _add_items_to_checkout_to_order_items(items_to_checkout, order, user_id, guest_id, cart, cart_items, sales_map):
+        """訂單明細一次 bulk insert（同時累加熱賣排行）；購物車明細扣數量/刪除在 commit 時一起 flush，日誌一次寫入"""
         if not order :
             raise ValueError("order is required when _add_items_to_checkout_to_order_items")
+        rows = []
+        logs = []
         for item in items_to_checkout:
             product_id = item.get("product_id")
             quantity = item.get("quantity", 1)
-            product = Product.get_by_product_id(product_id)
-            price = product.get_final_price() if product else 0
-            OrderService._add_order_item(order.id, product_id, quantity, price)
-            CartService._handle_cart_item_on_checkout(user_id, guest_id, cart, product_id, quantity)
-        
\ No newline at end of file
+            cart_item = cart_items[product_id]
+            product = cart_item.product
+            price = product.get_final_price(sales_map) if product else 0
+            rows.append({"order_id": order.id, "product_id": product_id, "quantity": quantity, "price": price})
+            logs.append(CartService._handle_cart_item_on_checkout(user_id, guest_id, cart, cart_item, quantity))
+        OrderService._add_order_items(rows)
+        SalesRankService.record(rows, order.order_date)
+        AuditService.log_many(logs)
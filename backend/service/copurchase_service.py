@@ -0,0 +1,297 @@
+import io
+from itertools import chain
+import numpy as np
+from scipy import sparse
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, or_, select, text
+from sqlalchemy.dialects.postgresql import insert
+from models import db, Order, OrderItem, Product, ProductNeighbor, JobWatermark
+
+WATERMARK = "copurchase"
+
+class CopurchaseService:
+    """
+    離線協同過濾（item-item 共同購買）
+    - 會員 × 商品的購買矩陣 B（0/1，scipy sparse），共現矩陣 C = Bᵀ·B：C[i][j] = 同時買過 i、j 的會員數
+    - C 的非零項存在 product_copurchases；每個商品前 K 名存在 product_neighbors，線上推薦只查這張表再合併
+    - 增量：只取有新訂單明細的會員，ΔC = Baᵀ·Ba − Bbᵀ·Bb（a = 含新明細、b = 不含），累加後重算受影響商品的前 K 名
+    - 進度記在 job_watermarks；rebuild 全部重算（首次上線、刪除訂單後、或定期校正）
+    """
+
+    # ---- 線上 ----
+    @staticmethod
+    def recommend(product_ids, limit=5, user_id=None):
+        """
+        合併購物車各商品的鄰居分數（同分 id 大的在前），排除購物車內與已下架商品
+        模型還沒建過（新部署、剛升級，批次還沒跑）時改用即時彙總訂單，不會回傳空的推薦
+        """
+        product_ids = set(product_ids)
+        if not product_ids or limit <= 0:
+            return []
+        if not CopurchaseService._model_ready():
+            return CopurchaseService._recommend_live(product_ids, user_id, limit)
+        scores = {}
+        for neighbor_id, score in (
+            db.session.query(ProductNeighbor.neighbor_id, ProductNeighbor.score)
+            .filter(ProductNeighbor.product_id.in_(product_ids))
+        ):
+            if neighbor_id not in product_ids:
+                scores[neighbor_id] = scores.get(neighbor_id, 0) + score
+        if not scores:
+            return []
+        ranked = sorted(scores, key=lambda pid: (-scores[pid], -pid))
+        active = {
+            p.id: p for p in Product.query.filter(Product.id.in_(ranked), Product.is_active == True).all()
+        }
+        return [active[pid] for pid in ranked if pid in active][:limit]
+
+    @staticmethod
+    def _model_ready():
+        """批次處理過訂單明細（進度 > 0）才算建好；建好後不會再變回沒建，結果記在 app 上不必每次查"""
+        app = current_app._get_current_object()
+        if app.extensions.get("copurchase_ready"):
+            return True
+        ready = bool(db.session.query(JobWatermark.last_id).filter_by(name=WATERMARK).scalar())
+        if ready:
+            app.extensions["copurchase_ready"] = True
+        return ready
+
+    @staticmethod
+    def _recommend_live(product_ids, user_id, limit):
+        """即時版：買過購物車內商品的其他會員，還買過哪些商品（依訂單明細筆數，同數 id 大的在前）"""
+        buyers = (
+            select(Order.user_id)
+            .join(OrderItem, OrderItem.order_id == Order.id)
+            .where(OrderItem.product_id.in_(product_ids), Order.user_id.isnot(None))
+        )
+        if user_id:
+            buyers = buyers.where(Order.user_id != user_id)
+        count = func.count(OrderItem.id)
+        return (
+            db.session.query(Product)
+            .join(OrderItem, OrderItem.product_id == Product.id)
+            .join(Order, Order.id == OrderItem.order_id)
+            .filter(Order.user_id.in_(buyers.distinct()), ~Product.id.in_(product_ids), Product.is_active == True)
+            .group_by(Product.id)
+            .order_by(count.desc(), Product.id.desc())
+            .limit(limit)
+            .all()
+        )
+
+    # ---- 批次 ----
+    @staticmethod
+    def update(top_k=None, settle_seconds=None):
+        """處理上次之後的新訂單明細，回傳本次處理的會員訂單明細筆數"""
+        top_k, settle_seconds = CopurchaseService._settings(top_k, settle_seconds)
+        watermark = CopurchaseService._lock_watermark()
+        last_id = watermark.last_id
+        upper = CopurchaseService._settled_max_id(last_id, settle_seconds)
+        if upper <= last_id:
+            db.session.commit()
+            return 0
+
+        buyers = (
+            select(Order.user_id)
+            .join(OrderItem, OrderItem.order_id == Order.id)
+            .where(OrderItem.id > last_id, OrderItem.id <= upper, Order.user_id.isnot(None))
+            .distinct()
+        )
+        rows = CopurchaseService._fetch_array(
+            select(Order.user_id, OrderItem.product_id, OrderItem.id)
+            .join(Order, Order.id == OrderItem.order_id)
+            .where(Order.user_id.in_(buyers), OrderItem.product_id.isnot(None), OrderItem.id <= upper)
+        )
+        before = rows[:, 2] <= last_id
+        processed = int(len(rows) - before.sum())
+        if len(rows):
+            products, after_matrix = CopurchaseService._purchase_matrix(rows[:, 0], rows[:, 1])
+            _, before_matrix = CopurchaseService._purchase_matrix(rows[:, 0], rows[:, 1], mask=before)
+            delta = CopurchaseService._cooccurrence(after_matrix) - CopurchaseService._cooccurrence(before_matrix)
+            delta.eliminate_zeros()
+            delta = delta.tocoo()
+            if delta.nnz:
+                CopurchaseService._add_pairs(top_k, products[delta.row], products[delta.col], delta.data)
+
+        watermark.last_id = upper
+        watermark.updated_at = datetime.now()
+        db.session.commit()
+        return processed
+
+    @staticmethod
+    def rebuild(top_k=None, settle_seconds=None):
+        """依全部訂單明細重算共現矩陣與前 K 名，回傳寫入的鄰居筆數"""
+        top_k, settle_seconds = CopurchaseService._settings(top_k, settle_seconds)
+        watermark = CopurchaseService._lock_watermark()
+        upper = CopurchaseService._settled_max_id(0, settle_seconds)
+        rows = CopurchaseService._fetch_array(
+            select(Order.user_id, OrderItem.product_id)
+            .join(Order, Order.id == OrderItem.order_id)
+            .where(Order.user_id.isnot(None), OrderItem.product_id.isnot(None), OrderItem.id <= upper)
+        )
+
+        # product_copurchases 線上不會讀，直接 TRUNCATE；product_neighbors 用 DELETE，重建期間線上推薦照常讀舊資料
+        db.session.execute(text("TRUNCATE product_copurchases"))
+        db.session.execute(ProductNeighbor.__table__.delete())
+        count = 0
+        if len(rows):
+            products, matrix = CopurchaseService._purchase_matrix(rows[:, 0], rows[:, 1])
+            pairs = CopurchaseService._cooccurrence(matrix)
+            coo = pairs.tocoo()
+            CopurchaseService._copy(
+                "product_copurchases", ("product_id", "other_product_id", "users"),
+                products[coo.row], products[coo.col], coo.data,
+            )
+            top_rows, top_columns, top_scores = CopurchaseService._top_k(pairs, top_k)
+            CopurchaseService._copy(
+                "product_neighbors", ("product_id", "neighbor_id", "score"),
+                products[top_rows], products[top_columns], top_scores,
+            )
+            count = len(top_rows)
+
+        watermark.last_id = upper
+        watermark.updated_at = datetime.now()
+        db.session.commit()
+        return count
+
+    @staticmethod
+    def _settings(top_k, settle_seconds):
+        config = current_app.config
+        return (
+            top_k or config.get("COPURCHASE_TOP_K", 20),
+            config.get("COPURCHASE_SETTLE_SECONDS", 300) if settle_seconds is None else settle_seconds,
+        )
+
+    @staticmethod
+    def _lock_watermark():
+        """鎖住進度列（FOR UPDATE），同時跑兩個批次時第二個會等第一個做完，不會重複累加"""
+        db.session.execute(
+            insert(JobWatermark).values(name=WATERMARK, last_id=0).on_conflict_do_nothing(index_elements=["name"])
+        )
+        return (
+            JobWatermark.query.filter_by(name=WATERMARK)
+            .populate_existing().with_for_update().one()
+        )
+
+    @staticmethod
+    def _settled_max_id(last_id, settle_seconds):
+        """
+        這次處理到的明細 id 上限：只看下單超過 settle_seconds 秒的明細
+        id 在結帳交易中配發，比它小的 id 只可能屬於更早開始的交易，超過 settle_seconds 還沒 commit 的結帳不存在
+        """
+        cutoff = datetime.now() - timedelta(seconds=settle_seconds)
+        upper = (
+            db.session.query(func.max(OrderItem.id))
+            .join(Order, Order.id == OrderItem.order_id)
+            .filter(OrderItem.id > last_id, or_(Order.order_date.is_(None), Order.order_date <= cutoff))
+            .scalar()
+        )
+        return upper or last_id
+
+    @staticmethod
+    def _fetch_array(statement):
+        """整數欄位的查詢結果直接轉成 numpy 陣列（n × 欄位數），不逐列轉換 Row 物件"""
+        result = db.session.execute(statement)
+        width = len(result.keys())
+        rows = result.all()
+        return np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=len(rows) * width).reshape(-1, width)
+
+    @staticmethod
+    def _purchase_matrix(user_ids, product_ids, mask=None):
+        """會員 × 商品 0/1 稀疏矩陣；欄位對應 np.unique(product_ids)（回傳值第一個）"""
+        products, columns = np.unique(product_ids, return_inverse=True)
+        users, rows = np.unique(user_ids, return_inverse=True)
+        if mask is not None:
+            rows, columns = rows[mask], columns[mask]
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=(len(users), len(products))
+        )
+        matrix.data[:] = 1  # 同一會員重複購買只算一次
+        return products, matrix
+
+    @staticmethod
+    def _cooccurrence(matrix):
+        """C = Bᵀ·B，去掉對角線（商品自己）"""
+        pairs = (matrix.T @ matrix).tocoo()
+        keep = pairs.row != pairs.col
+        return sparse.csr_matrix((pairs.data[keep], (pairs.row[keep], pairs.col[keep])), shape=pairs.shape)
+
+    @staticmethod
+    def _top_k(pairs, top_k):
+        """每一列取分數最高的 top_k 個（同分欄位對應的商品 id 大的在前；欄位依 id 排序，所以就是欄位大的在前）"""
+        rows, columns, scores = [], [], []
+        for row in range(pairs.shape[0]):
+            start, end = pairs.indptr[row], pairs.indptr[row + 1]
+            if start == end:
+                continue
+            row_columns, row_scores = pairs.indices[start:end], pairs.data[start:end]
+            order = np.lexsort((-row_columns, -row_scores))[:top_k]
+            rows.append(np.full(len(order), row))
+            columns.append(row_columns[order])
+            scores.append(row_scores[order])
+        if not rows:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(rows), np.concatenate(columns), np.concatenate(scores)
+
+    @staticmethod
+    def _copy(table, columns, *values):
+        """用 COPY 把整數欄位寫進 table（同一個交易）"""
+        if not len(values[0]):
+            return
+        lines = "\t".join(["{}"] * len(columns)) + "\n"
+        buffer = io.StringIO("".join(map(lines.format, *(v.tolist() for v in values))))
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+    @staticmethod
+    def _add_pairs(top_k, product_ids, other_ids, counts):
+        """
+        ΔC 累加進 product_copurchases，並更新受影響商品的前 K 名
+        共現次數只增不減：原本不在前 K 名、這次也沒增加的組合不可能擠進前 K 名，
+        所以新的前 K 名只需要從「舊的前 K 名 + 這次有增加的組合」中挑，不必重掃整列
+        """
+        db.session.execute(text(
+            "CREATE TEMP TABLE copurchase_delta (product_id INTEGER, other_product_id INTEGER, users INTEGER) "
+            "ON COMMIT DROP"
+        ))
+        CopurchaseService._copy(
+            "copurchase_delta", ("product_id", "other_product_id", "users"), product_ids, other_ids, counts
+        )
+        db.session.execute(text("ANALYZE copurchase_delta"))  # 暫存表不會自動 analyze，沒統計資料 planner 會選錯 join
+        # 候選 = 這次有增加的組合（upsert RETURNING 的新次數）+ 舊的前 K 名中這次沒變的
+        db.session.execute(text("""
+            CREATE TEMP TABLE neighbor_candidates (product_id INTEGER, neighbor_id INTEGER, score INTEGER)
+            ON COMMIT DROP
+        """))
+        db.session.execute(text("""
+            WITH updated AS (
+                INSERT INTO product_copurchases (product_id, other_product_id, users)
+                SELECT product_id, other_product_id, users FROM copurchase_delta
+                ON CONFLICT (product_id, other_product_id)
+                DO UPDATE SET users = product_copurchases.users + EXCLUDED.users
+                RETURNING product_id, other_product_id, users
+            )
+            INSERT INTO neighbor_candidates SELECT * FROM updated
+        """))
+        db.session.execute(text("""
+            INSERT INTO neighbor_candidates
+            SELECT n.product_id, n.neighbor_id, n.score FROM product_neighbors n
+            WHERE n.product_id IN (SELECT product_id FROM copurchase_delta)
+              AND NOT EXISTS (
+                  SELECT 1 FROM copurchase_delta d
+                  WHERE d.product_id = n.product_id AND d.other_product_id = n.neighbor_id
+              )
+        """))
+        db.session.execute(text(
+            "DELETE FROM product_neighbors WHERE product_id IN (SELECT product_id FROM copurchase_delta)"
+        ))
+        db.session.execute(text("""
+            INSERT INTO product_neighbors (product_id, neighbor_id, score)
+            SELECT product_id, neighbor_id, score FROM (
+                SELECT product_id, neighbor_id, score,
+                       row_number() OVER (PARTITION BY product_id ORDER BY score DESC, neighbor_id DESC) AS rank
+                FROM neighbor_candidates
+            ) ranked
+            WHERE rank <= :k
+        """), {"k": top_k})
+        db.session.execute(text("DROP TABLE copurchase_delta, neighbor_candidates"))
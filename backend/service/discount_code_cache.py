@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from models import db, DiscountCode
+
+class DiscountCodeCache:
+    """
+    折扣碼定義的 process 內 LRU 快取（code → 欄位值），前端反覆套用折扣碼時不必每次用 code 查 discount_codes
+    - 只快取上架中（is_active）的折扣碼；查不到的 code 也快取（負向快取），亂猜 / 暴力嘗試不會打到資料庫
+      負向快取是另一個 LRU，大量亂猜只會擠掉其他不存在的 code，不會把真的折扣碼擠出去
+    - 新增、停用折扣碼時呼叫 invalidate；其他 gunicorn worker 的快取最多 ttl（負向 negative_ttl）秒後過期
+      （結帳扣次數的 UPDATE 本身會檢查 is_active，其他 worker 還沒過期也用不掉已停用的折扣碼）
+    """
+
+    def __init__(self, max_size=1000, ttl=60, negative_size=10000, negative_ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_size = negative_size
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._negative = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0  # invalidate 一次加一；查詢期間被 invalidate 過的結果不寫進快取
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, codes):
+        """回傳 {code: 欄位 dict}（只含上架中的折扣碼）"""
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            for code in codes:
+                entry = self._entries.get(code)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(code)
+                    self.hits += 1
+                    found[code] = entry[0]
+                    continue
+                entry = self._negative.get(code)
+                if entry is not None and entry[1] > now:
+                    self._negative.move_to_end(code)
+                    self.hits += 1
+                    continue
+                self.misses += 1
+                missing.append(code)
+            generation = self._generation
+        if not missing:
+            return found
+
+        loaded = {
+            dc.code: {column.key: getattr(dc, column.key) for column in DiscountCode.__table__.columns}
+            for dc in DiscountCode.query.filter(DiscountCode.code.in_(missing), DiscountCode.is_active == True)
+        }
+        found.update(loaded)
+        with self._lock:
+            if generation != self._generation:
+                return found
+            for code in missing:
+                if code in loaded:
+                    self._negative.pop(code, None)
+                    self._store(self._entries, code, (loaded[code], now + self.ttl), self.max_size)
+                else:
+                    self._entries.pop(code, None)
+                    self._store(self._negative, code, (None, now + self.negative_ttl), self.negative_size)
+        return found
+
+    @staticmethod
+    def _store(entries, code, entry, max_size):
+        entries[code] = entry
+        entries.move_to_end(code)
+        while len(entries) > max_size:
+            entries.popitem(last=False)
+
+    def invalidate(self, code=None):
+        with self._lock:
+            self._generation += 1
+            if code is None:
+                self._entries.clear()
+                self._negative.clear()
+            else:
+                self._entries.pop(code, None)
+                self._negative.pop(code, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "negative_size": len(self._negative),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+_cache_lock = threading.Lock()
+
+def get_discount_code_cache(app=None):
+    """每個 app（process）一個快取"""
+    from flask import current_app
+    app = app or current_app._get_current_object()
+    with _cache_lock:
+        code_cache = app.extensions.get("discount_code_cache")
+        if code_cache is None:
+            code_cache = app.extensions["discount_code_cache"] = DiscountCodeCache(
+                max_size=app.config.get("DISCOUNT_CODE_CACHE_SIZE", 1000),
+                ttl=app.config.get("DISCOUNT_CODE_CACHE_TTL", 60),
+                negative_size=app.config.get("DISCOUNT_CODE_NEGATIVE_CACHE_SIZE", 10000),
+                negative_ttl=app.config.get("DISCOUNT_CODE_NEGATIVE_CACHE_TTL", 30),
+            )
+        return code_cache
+
+def load_active_discount_codes(codes):
+    """
+    {code: DiscountCode}（上架中），定義來自快取，不查資料庫直接放進目前的 session（merge load=False）
+    used_count 變動頻繁：有總次數限制的折扣碼另外依主鍵重讀一次（一個查詢），其他的 used_count 只是顯示用的快取值
+    """
+    definitions = get_discount_code_cache().get_many(codes)
+    found = {}
+    for code, fields in definitions.items():
+        dc = DiscountCode(**fields)
+        make_transient_to_detached(dc)
+        found[code] = db.session.merge(dc, load=False)
+    limited = {dc.id: dc for dc in found.values() if dc.usage_limit}
+    if limited:
+        for discount_code_id, used_count in (
+            db.session.query(DiscountCode.id, DiscountCode.used_count).filter(DiscountCode.id.in_(limited))
+        ):
+            set_committed_value(limited[discount_code_id], "used_count", used_count)
+    return found
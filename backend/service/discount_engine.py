@@ -0,0 +1,214 @@
+import numpy as np
+from datetime import datetime
+from models import UserDiscountCode, Product
+from service.discount_code_cache import load_active_discount_codes
+from service.price_service import PriceService
+
+NOT_FOUND = (False, "折扣碼不存在或已停用", None, None, None, "", False)
+OUT_OF_PERIOD = (False, "折扣碼不在有效期限", None, None, None, "", False)
+NO_ITEMS = (False, "沒有任何商品可計算折扣", None, None, None, "", False)
+
+class DiscountEngine:
+    """
+    折扣碼批次試算：同一份購物車一次試算多個折扣碼（例如自動挑最划算的折扣碼）
+    - 預先載入：候選折扣碼（DiscountCodeCache）、該會員 / 訪客的使用次數、本次結帳商品的特價各只查一次
+    - 試算：各折扣碼的單價、總額以 numpy 陣列（折扣碼 × 商品）一次算完
+    - 結果跟原本逐一試算相同：加總依商品順序逐項累加，四捨五入用 Python round（numpy 的 round 在 .xx5 附近結果不同）
+    回傳值同 DiscountService.apply_discount_code：(success, message, 折扣碼, 折扣後金額, 折扣金額, 規則說明, used_coupon)
+    """
+
+    @staticmethod
+    def evaluate(codes, cart, user_id=None, guest_id=None, items_to_checkout=None, sales_map=None):
+        """回傳 {code: 試算結果}"""
+        if (not user_id) and (not guest_id):
+            raise ValueError("user_id 或 guest_id 必須至少有一個")
+        if user_id and guest_id:
+            raise ValueError("user_id 或 guest_id 只能傳入一個")
+        codes = list(dict.fromkeys(codes))
+        if not codes:
+            return {}
+        # 折扣碼定義走 process 內快取（含查不到的 code），只有總次數限制需要重讀 used_count
+        found = load_active_discount_codes(codes)
+        now = datetime.now()
+        results = {}
+        candidates = []
+        for code in codes:
+            dc = found.get(code)
+            if not dc:
+                results[code] = NOT_FOUND
+            elif dc.valid_from > now or dc.valid_to < now:
+                results[code] = OUT_OF_PERIOD
+            else:
+                candidates.append(dc)
+        if not candidates:
+            return results
+
+        items = DiscountEngine._build_items(cart, items_to_checkout)
+        if not items:
+            results.update((dc.code, NO_ITEMS) for dc in candidates)
+            return results
+        # 本次結帳商品的特價一次查好（結帳流程已查過就沿用）
+        if sales_map is None:
+            sales_map = PriceService.get_sales_map([product_id for product_id, _, _ in items])
+        prices = DiscountEngine._prices(items, sales_map)
+        usage = DiscountEngine._usage(candidates, user_id, guest_id)
+
+        site_wide = [dc for dc in candidates if not dc.product_id]
+        specified = [dc for dc in candidates if dc.product_id]
+        # 先算金額（成功的訊息先填 None），再依序檢查滿額、次數限制
+        evaluated = DiscountEngine._evaluate_site_wide(site_wide, prices)
+        evaluated.update(DiscountEngine._evaluate_specified(specified, items, prices))
+
+        for dc in candidates:
+            result = evaluated[dc.code]
+            if not result[0]:
+                results[dc.code] = result
+                continue
+            _, _, _, discounted_total, discount_amount, rule_msg, used_coupon = result
+            # 檢查滿額、次數限制
+            if dc.min_spend and discounted_total < dc.min_spend:
+                results[dc.code] = (False, f"未達最低消費金額 {dc.min_spend}", None, None, None, rule_msg, used_coupon)
+            elif dc.usage_limit and dc.used_count >= dc.usage_limit:
+                results[dc.code] = (False, "折扣碼已達總使用上限", None, None, None, rule_msg, used_coupon)
+            elif dc.per_user_limit and usage.get(dc.id, 0) >= dc.per_user_limit:
+                results[dc.code] = (False, "您已達本折扣碼可用次數上限", None, None, None, rule_msg, used_coupon)
+            else:
+                results[dc.code] = (True, "折扣碼可用", dc, discounted_total, discount_amount, rule_msg, used_coupon)
+        return results
+
+    @staticmethod
+    def pick_best(codes, cart, user_id=None, guest_id=None, items_to_checkout=None, sales_map=None):
+        """
+        可用的折扣碼中折扣後金額最低的一個（同金額取 codes 中排前面的）
+        回傳 (code, 試算結果)；都不能用回傳 (None, None)
+        """
+        results = DiscountEngine.evaluate(codes, cart, user_id, guest_id, items_to_checkout, sales_map)
+        best = None
+        for code, result in results.items():
+            if result[0] and (best is None or result[3] < results[best][3]):
+                best = code
+        return (best, results[best]) if best is not None else (None, None)
+
+    @staticmethod
+    def _build_items(cart, items_to_checkout):
+        """本次要結帳的商品 [(product_id, product, quantity)]（可以只結帳部分商品）"""
+        if not items_to_checkout:
+            return [(ci.product_id, ci.product, ci.quantity) for ci in cart.cart_items]
+        cart_items = {ci.product_id: ci for ci in cart.cart_items}
+        items = []
+        for checkout_item in items_to_checkout:
+            ci = cart_items.get(checkout_item["product_id"])
+            if ci:
+                items.append((ci.product_id, ci.product, checkout_item.get("quantity", ci.quantity)))
+        return items
+
+    @staticmethod
+    def _prices(items, sales_map):
+        """各商品的原價、售價（特價後）、數量，以及售價小計（逐項四捨五入）與全站折扣碼用的未四捨五入小計"""
+        original = np.array([float(product.price) for _, product, _ in items])
+        final = np.array([float(product.get_final_price(sales_map)) for _, product, _ in items])
+        quantity = np.array([quantity for _, _, quantity in items])
+        line_totals = (final * quantity).tolist()
+        return {
+            "product_ids": np.array([product_id for product_id, _, _ in items]),
+            "original": original,
+            "final": final,
+            "quantity": quantity,
+            "subtotal": sum(line_totals),
+            "rounded_lines": [round(v, 2) for v in line_totals],
+        }
+
+    @staticmethod
+    def _usage(candidates, user_id, guest_id):
+        """{discount_code_id: 該會員 / 訪客已使用次數}（只查有每人次數限制的折扣碼）"""
+        limited = [dc.id for dc in candidates if dc.per_user_limit]
+        if not limited:
+            return {}
+        query = UserDiscountCode.query.filter(UserDiscountCode.discount_code_id.in_(limited))
+        if user_id:
+            query = query.filter(UserDiscountCode.user_id == user_id)
+        else:
+            query = query.filter(UserDiscountCode.guest_id == guest_id)
+        usage = {}
+        for row in query.order_by(UserDiscountCode.id):
+            usage.setdefault(row.discount_code_id, row.used_count)
+        return usage
+
+    @staticmethod
+    def _rates(codes):
+        """折扣比例、折抵金額陣列，以及各自是否有設定（0 / None 視為沒設定）"""
+        discount = np.array([dc.discount or 0.0 for dc in codes], dtype=float)
+        amount = np.array([dc.amount or 0.0 for dc in codes], dtype=float)
+        return discount, amount, discount != 0, (discount == 0) & (amount != 0)
+
+    @staticmethod
+    def _evaluate_site_wide(codes, prices):
+        """全站折扣碼：對所有商品加總後再折扣"""
+        if not codes:
+            return {}
+        subtotal = prices["subtotal"]
+        discount, amount, by_ratio, by_amount = DiscountEngine._rates(codes)
+        # 百分比折扣（0.8 = 八折）與折抵金額（最多折到 0 元）；兩者都沒有時不折扣
+        totals = np.where(by_ratio, subtotal * discount, np.where(by_amount, np.maximum(subtotal - amount, 0), subtotal))
+        amounts = np.where(by_ratio, subtotal * (1 - discount), np.where(by_amount, np.minimum(subtotal, amount), 0))
+        rule_msg = "此為全站折扣碼，對所有商品加總後再進行折扣"
+        results = {}
+        for dc, ratio, total, discount_amount in zip(codes, by_ratio.tolist(), totals.tolist(), amounts.tolist()):
+            if ratio:
+                total, discount_amount = round(total, 2), round(discount_amount, 2)
+            results[dc.code] = (True, None, dc, total, discount_amount, rule_msg, True)  # 全站折扣碼必然用到
+        return results
+
+    @staticmethod
+    def _evaluate_specified(codes, items, prices):
+        """商品專屬折扣碼：只折指定商品，跟特價不疊加，特價與折扣碼取便宜的"""
+        if not codes:
+            return {}
+        first_index = {}
+        for index, (product_id, _, _) in enumerate(items):
+            first_index.setdefault(product_id, index)
+        results = {}
+        matched = []
+        for dc in codes:
+            if dc.product_id in first_index:
+                matched.append(dc)
+            else:
+                specified_product = Product.get_by_product_id(dc.product_id)
+                results[dc.code] = (False, f"此折扣碼僅適用{specified_product.title}", None, None, None, "", False)
+        if not matched:
+            return results
+
+        target_ids = np.array([dc.product_id for dc in matched])
+        target_index = np.array([first_index[dc.product_id] for dc in matched])
+        original = prices["original"][target_index]
+        sale = prices["final"][target_index]  # 有特價時已是特價價格
+        discount, amount, by_ratio, by_amount = DiscountEngine._rates(matched)
+        # 折扣碼後單價用原價算
+        coupon = np.where(by_ratio, original * discount, np.where(by_amount, np.maximum(original - amount, 0), original))
+        lowest = np.minimum(sale, coupon)
+
+        # 依商品順序重新加總：指定商品用最低單價，其他商品用售價
+        totals = np.zeros(len(matched))
+        amounts = np.zeros(len(matched))
+        for index, (product_id, quantity, rounded_line) in enumerate(
+            zip(prices["product_ids"].tolist(), prices["quantity"].tolist(), prices["rounded_lines"])
+        ):
+            hit = target_ids == product_id
+            line = np.full(len(matched), rounded_line)
+            saved = np.zeros(len(matched))
+            for k in np.flatnonzero(hit).tolist():
+                line[k] = round(float(lowest[k] * quantity), 2)
+                saved[k] = round(float((original[k] - lowest[k]) * quantity), 2)
+            totals += line
+            amounts += saved
+
+        for k, dc in enumerate(matched):
+            title = items[target_index[k]][1].title
+            if sale[k] < coupon[k]:
+                rule_msg, used_coupon = f"商品專屬折扣碼，特價與折扣碼不可疊加，商品{title}特價比折扣碼更優惠，因此折扣碼未被消耗", False
+            elif coupon[k] < sale[k]:
+                rule_msg, used_coupon = f"本次已套用折扣碼優惠（此為商品{title}專屬折扣碼）", True
+            else:
+                rule_msg, used_coupon = f"此為商品{title}專屬折扣碼，僅適用指定商品", False
+            results[dc.code] = (True, None, dc, float(totals[k]), float(amounts[k]), rule_msg, used_coupon)
+        return results
@@ -1,5 +1,11 @@
 from models import db, DiscountCode, UserDiscountCode
+from service.discount_code_cache import get_discount_code_cache
+from service.discount_engine import DiscountEngine
+from service.unit_of_work import maybe_commit
 from datetime import datetime
+from sqlalchemy import func, or_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm.attributes import set_committed_value
 
 class DiscountService:
     @staticmethod
@@ -30,6 +36,7 @@ class DiscountService:
         )
         db.session.add(dc)
         db.session.commit()
+        get_discount_code_cache().invalidate(code)  # 清掉負向快取（建立前有人試過這個 code）
         return dc
 
     # 更多：查詢、驗證、更新、停用，可照你需求加
@@ -39,177 +46,93 @@ class DiscountService:
         return DiscountCode.query.filter_by(code=code).first()
     
     @staticmethod
-    def apply_discount_code(user_id=None, guest_id=None, cart=None, code=None, items_to_checkout=None):
-        if (not user_id) and (not guest_id):
-            raise  ValueError("user_id 或 guest_id 必須至少有一個")
-        if user_id and  guest_id:
-            raise  ValueError("user_id 或 guest_id 只能傳入一個")
+    def apply_discount_code(user_id=None, guest_id=None, cart=None, code=None, items_to_checkout=None, sales_map=None):
         """
         檢查折扣碼是否可用，計算折扣後金額，同時回傳優惠規則描述與本次結帳有無實際採用折扣碼
         :return: (success, message, discount_code物件, 折扣後金額, 折扣金額, 規則說明, used_coupon)
         """
-        from models import Product  # 避免循環 import
-
-        # 查詢折扣碼
-        dc = DiscountCode.query.filter_by(code=code, is_active=True).first()
-        if not dc:
-            return False, "折扣碼不存在或已停用", None, None, None, "", False
-
-        now = datetime.now()
-        # 檢查有效期限
-        if dc.valid_from > now or dc.valid_to < now:
-            return False, "折扣碼不在有效期限", None, None, None, "", False
-        
-        # 查詢該用戶或訪客的折扣碼使用次數
-        user_dc = None
-        if user_id:
-            user_dc = UserDiscountCode.query.filter_by(user_id=user_id, discount_code_id=dc.id).first()
-        elif guest_id:
-            user_dc = UserDiscountCode.query.filter_by(guest_id=guest_id, discount_code_id=dc.id).first()
-        user_usage = user_dc.used_count if user_dc else 0
-
-        # 整理本次要結帳的購物車商品（可以只結帳部分商品）
-        def build_items():
-            # 建立 {product_id: cart_item} 的映射
-            cart_items_dict={}
-            for ci in cart.cart_items:
-                cart_items_dict[ci.product_id]=ci
-
-            result = []
-            if not items_to_checkout:
-                return list(cart.cart_items)
-            for checkout_item in items_to_checkout:
-                ci = cart_items_dict.get(checkout_item["product_id"])
-                if ci:
-                    temp_item = type('obj', (), {})()
-                    temp_item.product = ci.product
-                    temp_item.quantity = checkout_item.get("quantity", ci.quantity)
-                    temp_item.product_id = ci.product_id
-                    result.append(temp_item)
-            return result
-
-
-        items = build_items()
-        if not items:
-            return False, "沒有任何商品可計算折扣", None, None, None, "", False
-
-        specified_product = Product.get_by_product_id(dc.product_id) if dc.product_id else None
-        rule_msg = ""
-        used_coupon = False  # 新增：這次有沒有實際用到折扣碼
-
-        # === 商品專屬折扣碼（僅適用於某個商品，不可疊加特價）
-        if dc.product_id:
-            # 找出是否購物車內有此商品
-            target_item = next((item for item in items if item.product_id == dc.product_id), None)
-            if not target_item:
-                return False, f"此折扣碼僅適用{specified_product.title}", None, None, None, "", False
-
-            original_price = float(target_item.product.price)
-            sale_price = float(target_item.product.get_final_price())  # 如果商品有特價，這裡已是特價價格
-
-            # 計算折扣碼後單價 (用original_price 去算!)
-            if dc.discount:
-                coupon_price = original_price * dc.discount
-            elif dc.amount:
-                coupon_price = max(original_price - dc.amount, 0)
-            else: # 防呆
-                coupon_price = original_price 
-
-            # 比較特價與折扣碼，誰優惠就用誰
-            lowest_unit_price = min(sale_price, coupon_price)
-
-            # 判斷本次是否有用到折扣碼優惠
-            if lowest_unit_price == sale_price and sale_price < coupon_price:
-                # 用特價，沒用到折扣碼
-
-                rule_msg = f"商品專屬折扣碼，特價與折扣碼不可疊加，商品{specified_product.title}特價比折扣碼更優惠，因此折扣碼未被消耗"
-                used_coupon = False
-            elif lowest_unit_price == coupon_price and coupon_price < sale_price:
-                # 用折扣碼
-                rule_msg = f"本次已套用折扣碼優惠（此為商品{specified_product.title}專屬折扣碼）"
-                used_coupon = True
-            else:
-                rule_msg = f"此為商品{specified_product.title}專屬折扣碼，僅適用指定商品"
-                used_coupon = False  # 防呆，其他情境不消耗
-            
-            discounted_total = 0
-            discount_amount = 0
-            # 重新加總所有商品金額
-            for item in items:
-                if item.product_id == dc.product_id:
-                    # 該商品採最低價（特價或折扣碼）
-                    discounted_total += round(lowest_unit_price * item.quantity, 2)
-                    discount_amount += round((original_price - lowest_unit_price) * item.quantity, 2)
-                else:
-                    # 其他商品無折扣碼優惠，直接用 get_final_price
-                    discounted_total += round(float(item.product.get_final_price()) * item.quantity, 2)
-        # === 全站折扣碼 ====
-        else:
-            rule_msg = "此為全站折扣碼，對所有商品加總後再進行折扣"
-            subtotal = sum(float(item.product.get_final_price()) * item.quantity for item in items)
-            #這個折扣碼是「百分比折扣」模式（例如 0.8 表示 8 折）
-            if dc.discount:
-                discount_amount = round(subtotal * (1 - dc.discount), 2) #計算折扣金額。例如 8 折就會是 subtotal * (1 - 0.8) = subtotal * 0.2
-                discounted_total = round(subtotal * dc.discount, 2)      #計算折扣後總金額。例如 1000 元 8 折就是 1000 * 0.8 = 800 元
-            #這個折扣碼是「金額折抵」模式（例如折 100 元）
-            elif dc.amount:
-                discount_amount = min(subtotal, dc.amount)       #如果消費金額不到折抵金額，例如只買 80 元的商品用 100 元折扣碼，最多只能折 80 元
-                discounted_total = max(subtotal - dc.amount, 0)  #折抵後的總金額 = 原本金額扣掉折抵金額，但最低不能低於 0 
-            #這張折扣碼既不是百分比、也不是金額折抵，極少發生但防呆
-            else:
-                discounted_total = subtotal
-                discount_amount = 0
-            used_coupon = True  # 全站折扣碼必然用到
-
-        # 檢查滿額、次數限制
-        if dc.min_spend and discounted_total < dc.min_spend:
-            return False, f"未達最低消費金額 {dc.min_spend}", None, None, None, rule_msg, used_coupon
-        if dc.usage_limit and dc.used_count >= dc.usage_limit:
-            return False, "折扣碼已達總使用上限", None, None, None, rule_msg, used_coupon
-        if dc.per_user_limit and user_usage >= dc.per_user_limit:
-            return False, "您已達本折扣碼可用次數上限", None, None, None, rule_msg, used_coupon
-
-        # 正常可用回傳（最後一個值就是 used_coupon）
-        return True, "折扣碼可用", dc, discounted_total, discount_amount, rule_msg, used_coupon
-
-
+        if (not user_id) and (not guest_id):
+            raise  ValueError("user_id 或 guest_id 必須至少有一個")
+        if user_id and  guest_id:
+            raise  ValueError("user_id 或 guest_id 只能傳入一個")
+        return DiscountEngine.evaluate(
+            [code], cart, user_id=user_id, guest_id=guest_id, items_to_checkout=items_to_checkout, sales_map=sales_map
+        )[code]
 
+    @staticmethod
+    def pick_best_discount_code(codes, user_id=None, guest_id=None, cart=None, items_to_checkout=None, sales_map=None):
+        """從多個折扣碼中挑折扣後金額最低的可用折扣碼，回傳 (code, apply_discount_code 的結果)，都不能用回傳 (None, None)"""
+        return DiscountEngine.pick_best(
+            codes, cart, user_id=user_id, guest_id=guest_id, items_to_checkout=items_to_checkout, sales_map=sales_map
+        )
 
     @staticmethod
-    def consume_discount_code(user_id=None, guest_id=None, code=None):
-        """結帳成功後，折扣碼用掉一次（全局＋該用戶/訪客）"""
+    def consume_discount_code(user_id=None, guest_id=None, code=None, dc=None):
+        """
+        結帳成功後，折扣碼用掉一次（全局＋該用戶/訪客）；兩個計數器都是單一條件式語法，不先讀再寫：
+        - 每人次數：依 (user_id / guest_id, discount_code_id) upsert，已達 per_user_limit 時不更新
+        - 總次數：UPDATE ... WHERE used_count < usage_limit
+        同時結帳的交易在同一列上排隊，輪到時 Postgres 會用最新的值重新檢查 WHERE，不會超過上限
+        任一個已達上限就丟 ValueError，交給結帳的 unit_of_work 整筆 rollback（另一個計數器也一起還原）
+        總次數那一列是搶購時的熱點，放在最後更新，列鎖持有到 commit 為止越短越好
+        """
 
         if (not user_id) and (not guest_id):
             raise  ValueError("user_id 或 guest_id 必須至少有一個")
         if user_id and  guest_id:
             raise  ValueError("user_id 或 guest_id 只能傳入一個")
         
-        dc = DiscountCode.query.filter_by(code=code, is_active=True).first()
+        if dc is None:
+            dc = DiscountCode.query.filter_by(code=code, is_active=True).first()
         if not dc:
             return
-        dc.used_count = (dc.used_count or 0) + 1
 
-        # 查會員/訪客紀錄
-        user_dc = None
-        if user_id:
-            user_dc = UserDiscountCode.query.filter_by(user_id=user_id, discount_code_id=dc.id).first()
-        elif guest_id:
-            user_dc = UserDiscountCode.query.filter_by(guest_id=guest_id, discount_code_id=dc.id).first()
-
-        if not user_dc:
-            user_dc = UserDiscountCode(
-                user_id=user_id if user_id else None,
-                guest_id=guest_id if guest_id else None,
-                discount_code_id=dc.id,
-                used_count=1
+        # 會員/訪客的使用次數
+        owner = UserDiscountCode.user_id if user_id else UserDiscountCode.guest_id
+        now = datetime.now()
+        stmt = insert(UserDiscountCode).values(
+            user_id=user_id if user_id else None,
+            guest_id=guest_id if guest_id else None,
+            discount_code_id=dc.id,
+            used_count=1,
+            last_used_at=now,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[owner, UserDiscountCode.discount_code_id],
+            index_where=owner.isnot(None),
+            set_={
+                "used_count": func.coalesce(UserDiscountCode.used_count, 0) + 1,
+                "last_used_at": stmt.excluded.last_used_at,
+            },
+            where=(func.coalesce(UserDiscountCode.used_count, 0) < dc.per_user_limit) if dc.per_user_limit else None,
+        )
+        if db.session.execute(stmt.returning(UserDiscountCode.id)).first() is None:
+            raise ValueError("折扣碼不可用: 您已達本折扣碼可用次數上限")
+
+        # 總使用次數（usage_limit 為 0 / None 代表不限次數，同 apply_discount_code）
+        used_count = db.session.execute(
+            update(DiscountCode)
+            .where(
+                DiscountCode.id == dc.id,
+                DiscountCode.is_active == True,
+                or_(
+                    DiscountCode.usage_limit.is_(None),
+                    DiscountCode.usage_limit == 0,
+                    func.coalesce(DiscountCode.used_count, 0) < DiscountCode.usage_limit,
+                ),
             )
-            db.session.add(user_dc)
-        else:
-            user_dc.used_count += 1
-            user_dc.last_used_at = datetime.now()
-        db.session.commit()
+            .values(used_count=func.coalesce(DiscountCode.used_count, 0) + 1)
+            .returning(DiscountCode.used_count)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        if used_count is None:
+            raise ValueError("折扣碼不可用: 折扣碼已停用或已達總使用上限")
+        set_committed_value(dc, "used_count", used_count)
+        maybe_commit()
+
     @staticmethod
     def deactivate_discount_code(code):
         code.is_active = False
         db.session.commit()
+        get_discount_code_cache().invalidate(code.code)
         return code
\ No newline at end of file
@@ -0,0 +1,88 @@
+from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert
+from models import db, EmailOutbox
+from utils.send_email import render_email, send_email_batch, EMAIL_BATCH_LIMIT
+
+class EmailService:
+    """
+    寄信一律先寫進 email_outbox 再寄：
+    - 去重：同一個 dedupe_key 只會有一筆，已寄出的不會再寄（worker 重試、重複排程都安全）
+    - 重試：寄送失敗的記下錯誤，下次呼叫同一個 key 會再寄
+    - 批次：內容相同的信合併成一次 SendGrid 請求（每批最多 EMAIL_BATCH_LIMIT 人）
+    """
+
+    @staticmethod
+    def send(dedupe_key, to_email, template, **context):
+        return EmailService.send_batch(template, [(dedupe_key, to_email)], **context)
+
+    @staticmethod
+    def send_batch(template, recipients, **context):
+        """
+        recipients：[(dedupe_key, to_email)] 或 [(dedupe_key, to_email, 個人化 context)]
+        沒有個人化 context 的收件人共用同一次 render 結果
+        回傳這次實際寄出的封數；有任何一批失敗就丟出第一個例外（其他批照樣寄出）
+        """
+        shared = None
+        rows = []
+        for recipient in recipients:
+            dedupe_key, to_email = recipient[0], recipient[1]
+            if len(recipient) > 2:
+                subject, html = render_email(template, **context, **recipient[2])
+            else:
+                shared = shared or render_email(template, **context)
+                subject, html = shared
+            rows.append({"dedupe_key": dedupe_key, "to_email": to_email, "subject": subject, "html": html})
+        EmailService.queue(rows)
+        return EmailService.deliver([row["dedupe_key"] for row in rows])
+
+    @staticmethod
+    def queue(rows):
+        """寫進 outbox，dedupe_key 已存在就略過"""
+        for start in range(0, len(rows), EMAIL_BATCH_LIMIT):
+            db.session.execute(
+                insert(EmailOutbox)
+                .values(rows[start:start + EMAIL_BATCH_LIMIT])
+                .on_conflict_do_nothing(index_elements=["dedupe_key"])
+            )
+        db.session.commit()
+
+    @staticmethod
+    def deliver(dedupe_keys):
+        """寄出還沒寄成功的信；內容相同的合併成一次請求"""
+        pending = (
+            EmailOutbox.query
+            .filter(EmailOutbox.dedupe_key.in_(dedupe_keys), EmailOutbox.status != "sent")
+            .order_by(EmailOutbox.id)
+            .all()
+        )
+        groups = {}
+        for row in pending:
+            groups.setdefault((row.subject, row.html), []).append(row)
+
+        sent = 0
+        errors = []
+        for (subject, html), group in groups.items():
+            for start in range(0, len(group), EMAIL_BATCH_LIMIT):
+                batch = group[start:start + EMAIL_BATCH_LIMIT]
+                ids = [row.id for row in batch]
+                try:
+                    send_email_batch([row.to_email for row in batch], subject, html)
+                except Exception as e:
+                    errors.append(e)
+                    EmailOutbox.query.filter(EmailOutbox.id.in_(ids)).update({
+                        "status": "failed",
+                        "attempts": EmailOutbox.attempts + 1,
+                        "last_error": str(e),
+                    }, synchronize_session=False)
+                else:
+                    sent += len(batch)
+                    EmailOutbox.query.filter(EmailOutbox.id.in_(ids)).update({
+                        "status": "sent",
+                        "attempts": EmailOutbox.attempts + 1,
+                        "sent_at": datetime.now(),
+                        "last_error": None,
+                    }, synchronize_session=False)
+                db.session.commit()
+        if errors:
+            raise errors[0]
+        return sent
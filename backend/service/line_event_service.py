@@ -0,0 +1,171 @@
+import base64
+import hashlib
+import hmac
+import queue
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+from linebot.models import TextSendMessage, FlexSendMessage
+from models import db
+from service.line_user_resolver import get_line_user_resolver
+from utils.line_client import get_line_client, LineApiError
+from utils.line_bot import build_order_detail_flex, build_order_list_flex, build_product_list_flex
+
+# LINE webhook 事件處理
+# webhook 只驗簽、把事件丟進 dispatcher 就回 200；dispatcher 的 worker 執行緒再查資料、回覆訊息
+# 同一個 LINE 用戶的事件固定進同一條 lane（依序處理），不同用戶平行處理
+
+CONTACT_TEXT = (
+    "聯絡客服資訊如下：\n"
+    "\n"
+    "📧 Email：talen3031@gmail.com\n"
+    "\n"
+    "📱 手機：0923956156\n"
+    "\n"
+    "💬 或至官網客服聊天室詢問(需登入)：\n"
+    "https://ecommerce-frontend-production-d012.up.railway.app"
+)
+
+def verify_signature(channel_secret, body, signature):
+    """X-Line-Signature = base64(HMAC-SHA256(channel secret, request body))"""
+    if not channel_secret or not signature:
+        return False
+    digest = hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode("utf-8"), signature)
+
+class LineEventService:
+
+    @staticmethod
+    def handle(event):
+        if event.get("type") != "message" or event.get("message", {}).get("type") != "text":
+            return
+        line_user_id = event["source"]["userId"]
+        messages = LineEventService.build_reply(line_user_id, event["message"]["text"].strip())
+        if messages:
+            LineEventService.respond(event, messages)
+
+    @staticmethod
+    def build_reply(line_user_id, msg):
+        """依指令組出要回覆的訊息（list of linebot message）"""
+        resolved = get_line_user_resolver().resolve(line_user_id)
+        if not resolved:
+            return [TextSendMessage(text="請先到會員中心綁定 LINE 帳號")]
+        user_id, _role = resolved
+        # 推薦商品（個人化，不管有無都給5個）
+        if msg.startswith("推薦商品"):
+            from service.product_service import ProductService
+            from service.recommendation_service import RecommendationService
+            recommend_limit = 5
+            products = RecommendationService.get("user", user_id, recommend_limit)
+            if not products or len(products) < recommend_limit:
+                # 不夠就用熱門/最新補滿
+                products = ProductService.get_top_products(limit=recommend_limit)
+            return [FlexSendMessage(alt_text="推薦商品", contents=build_product_list_flex(products))]
+        # 歷史訂單列表
+        if msg in ("查詢歷史訂單", "查詢訂單", "查詢我的訂單", "我的訂單", "查訂單紀錄"):
+            from service.order_service import OrderService
+            orders = OrderService.get_user_orders(user_id, page=1, per_page=5)
+            if not orders.items:
+                return [TextSendMessage(text="目前沒有訂單紀錄")]
+            return [FlexSendMessage(alt_text="訂單列表", contents=build_order_list_flex(orders.items))]
+        # 單筆訂單明細
+        if msg.startswith("查訂單明細#"):
+            try:
+                from service.order_service import OrderService
+                order_detail = OrderService.get_order_detail(int(msg.split("#")[1]))
+                return [FlexSendMessage(alt_text="訂單明細", contents=build_order_detail_flex(order_detail))]
+            except Exception:
+                return [TextSendMessage(text="查詢訂單明細失敗，請稍後再試")]
+        if msg.startswith("聯絡客服"):
+            return [TextSendMessage(text=CONTACT_TEXT)]
+        return [TextSendMessage(text="你好")]
+
+    @staticmethod
+    def respond(event, messages):
+        """
+        優先用 reply token 回覆（免費、不算推播額度）；token 過期或已用過才改用 push
+        """
+        client = get_line_client()
+        reply_token = event.get("replyToken")
+        if reply_token:
+            try:
+                client.reply(reply_token, messages)
+                return "reply"
+            except LineApiError as e:
+                print(f"LINE reply 失敗，改用 push: {e}", file=sys.stderr)
+        client.push(event["source"]["userId"], messages)
+        return "push"
+
+
+class LineWebhookDispatcher:
+    """
+    in-process worker pool：workers 條 lane，各有一個 queue 與一個執行緒
+    - 同一個 userId 永遠進同一條 lane，事件依收到的順序處理
+    - lane 滿了 submit 回傳 False，由 webhook 改成同步處理（不丟事件）
+    - LINE 重送（webhookEventId 相同）的事件只處理一次
+    """
+
+    def __init__(self, app, workers=4, max_queue=1000, seen_size=10000):
+        self.app = app
+        self._lanes = [queue.Queue(maxsize=max_queue) for _ in range(workers)]
+        self._seen = OrderedDict()
+        self._seen_size = seen_size
+        self._seen_lock = threading.Lock()
+        for index, lane in enumerate(self._lanes):
+            threading.Thread(target=self._run, args=(lane,), name=f"line-webhook-{index}", daemon=True).start()
+
+    def lane_for(self, event):
+        source = event.get("source", {})
+        key = source.get("userId") or source.get("groupId") or source.get("roomId") or ""
+        return self._lanes[int(hashlib.md5(key.encode("utf-8")).hexdigest(), 16) % len(self._lanes)]
+
+    def is_duplicate(self, event):
+        event_id = event.get("webhookEventId")
+        if not event_id:
+            return False
+        with self._seen_lock:
+            if event_id in self._seen:
+                return True
+            self._seen[event_id] = True
+            if len(self._seen) > self._seen_size:
+                self._seen.popitem(last=False)
+        return False
+
+    def submit(self, event):
+        try:
+            self.lane_for(event).put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    def join(self):
+        """等所有 lane 內的事件處理完（測試用）"""
+        for lane in self._lanes:
+            lane.join()
+
+    def _run(self, lane):
+        while True:
+            event = lane.get()
+            with self.app.app_context():
+                try:
+                    LineEventService.handle(event)
+                except Exception as e:
+                    traceback.print_exc()
+                    print("Webhook 事件處理失敗:", e, file=sys.stderr)
+                finally:
+                    db.session.remove()
+            lane.task_done()
+
+_dispatcher_lock = threading.Lock()
+
+def get_line_dispatcher(app):
+    with _dispatcher_lock:
+        dispatcher = app.extensions.get("line_webhook_dispatcher")
+        if dispatcher is None:
+            dispatcher = app.extensions["line_webhook_dispatcher"] = LineWebhookDispatcher(
+                app,
+                workers=app.config.get("LINE_WEBHOOK_WORKERS", 4),
+                max_queue=app.config.get("LINE_WEBHOOK_QUEUE_SIZE", 1000),
+            )
+        return dispatcher
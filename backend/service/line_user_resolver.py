@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+from models import db, User
+
+class LineUserResolver:
+    """
+    LINE userId → (user_id, role) 的 process 內 LRU 快取，webhook 每則訊息不必再查 users
+    - 沒綁定的 LINE userId 也會快取（None），陌生人連發訊息不會每次查 DB
+    - 最多 max_size 筆，超過就淘汰最久沒用到的
+    - 綁定 callback 會呼叫 invalidate；其他 gunicorn worker 的快取最多 ttl 秒後過期
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, line_user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(line_user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(line_user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        row = (
+            db.session.query(User.id, User.role)
+            .filter(User.line_user_id == line_user_id)
+            .order_by(User.id)
+            .first()
+        )
+        value = (row.id, row.role) if row else None
+        with self._lock:
+            self._entries[line_user_id] = (value, now + self.ttl)
+            self._entries.move_to_end(line_user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, line_user_id=None):
+        with self._lock:
+            if line_user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(line_user_id, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+_resolver_lock = threading.Lock()
+
+def get_line_user_resolver(app=None):
+    """每個 app（process）一個 resolver"""
+    from flask import current_app
+    app = app or current_app._get_current_object()
+    with _resolver_lock:
+        resolver = app.extensions.get("line_user_resolver")
+        if resolver is None:
+            resolver = app.extensions["line_user_resolver"] = LineUserResolver(
+                max_size=app.config.get("LINE_USER_CACHE_SIZE", 10000),
+                ttl=app.config.get("LINE_USER_CACHE_TTL", 60),
+            )
+        return resolver
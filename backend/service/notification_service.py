@@ -0,0 +1,322 @@
+import heapq
+import itertools
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import event, or_, and_
+from sqlalchemy.orm import Session, joinedload
+from models import db, NotificationJob, NotificationDeadLetter, Order, OrderItem, Product
+from utils import notify_util
+from utils.line_bot import LINE_MULTICAST_LIMIT
+from utils.send_email import EMAIL_BATCH_LIMIT
+
+# 通知工作佇列：請求只負責把「要寄什麼」寫進佇列，真正呼叫 SendGrid / LINE 交給 worker
+#   NOTIFY_BACKEND = "database"：寫進 notification_jobs，跟訂單同一個交易 commit，由 notification_worker.py 執行
+#   NOTIFY_BACKEND = "memory"  ：本機開發用的 broker 替身，交易 commit 後丟給同 process 的背景執行緒
+# 每種通知（kind）對應一個 handler；handler 丟例外就重試，超過次數搬到 notification_dead_letters
+
+HANDLERS = {}
+
+def notification_handler(kind):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+def _load_order(order_id):
+    return (
+        Order.query
+        .options(joinedload(Order.order_items).joinedload(OrderItem.product), joinedload(Order.user))
+        .filter_by(id=order_id)
+        .first()
+    )
+
+@notification_handler("order_created_email")
+def _order_created_email(payload):
+    order = _load_order(payload["order_id"])
+    if order:
+        notify_util.send_email_notify_order_created(order)
+
+@notification_handler("order_created_line")
+def _order_created_line(payload):
+    order = _load_order(payload["order_id"])
+    if order and order.user and order.user.line_user_id:
+        if notify_util.send_line_notify_order_created(order.user, order, order.order_items) is False:
+            raise RuntimeError(f"LINE 推播失敗 order_id={order.id}")
+
+@notification_handler("order_status_email")
+def _order_status_email(payload):
+    order = _load_order(payload["order_id"])
+    if order:
+        notify_util.send_email_notify_user_order_status(order)
+
+@notification_handler("order_status_line")
+def _order_status_line(payload):
+    order = _load_order(payload["order_id"])
+    if order and order.user and order.user.line_user_id:
+        if notify_util.send_line_notify_user_order_status(order.user, order) is False:
+            raise RuntimeError(f"LINE 推播失敗 order_id={order.id}")
+
+def _sale_args(payload):
+    return (
+        payload["discount"],
+        datetime.fromisoformat(payload["start_date"]),
+        datetime.fromisoformat(payload["end_date"]),
+        payload.get("description"),
+    )
+
+def _chunks(values, size):
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+@notification_handler("product_on_sale")
+def _product_on_sale(payload):
+    """
+    特價通知 fan-out：一次查出收件人，切成批次後各自排成一個工作
+    每批獨立重試，某一批 LINE 失敗不會讓其他批或 email 重寄
+    """
+    emails, line_user_ids = notify_util.find_cart_product_on_sale_recipients(payload["product_id"])
+    for chunk in _chunks(emails, EMAIL_BATCH_LIMIT):
+        NotificationService.enqueue("product_on_sale_email", {**payload, "emails": chunk})
+    for chunk in _chunks(line_user_ids, LINE_MULTICAST_LIMIT):
+        NotificationService.enqueue("product_on_sale_line", {**payload, "line_user_ids": chunk})
+
+@notification_handler("product_on_sale_email")
+def _product_on_sale_email(payload):
+    product = db.session.get(Product, payload["product_id"])
+    if product:
+        notify_util.send_email_notify_users_cart_product_on_sale(
+            payload["emails"], product, *_sale_args(payload), sale_id=payload.get("sale_id")
+        )
+
+@notification_handler("product_on_sale_line")
+def _product_on_sale_line(payload):
+    product = db.session.get(Product, payload["product_id"])
+    if product:
+        if notify_util.send_line_notify_users_cart_product_on_sale(payload["line_user_ids"], product, *_sale_args(payload)) is False:
+            raise RuntimeError(f"LINE multicast 失敗 product_id={product.id}")
+
+
+class NotificationService:
+
+    @staticmethod
+    def enqueue(kind, payload, max_attempts=None):
+        """
+        排一個通知工作，跟著呼叫端的交易 commit（交易 rollback 就不會寄）
+        呼叫端要自己 commit（或在 unit_of_work 內）
+        """
+        if kind not in HANDLERS:
+            raise ValueError(f"unknown notification kind: {kind}")
+        max_attempts = max_attempts or current_app.config.get("NOTIFY_MAX_ATTEMPTS", 5)
+        if current_app.config.get("NOTIFY_BACKEND", "database") == "memory":
+            db.session.info.setdefault("pending_notifications", []).append((kind, payload, max_attempts))
+            return None
+        job = NotificationJob(kind=kind, payload=payload, max_attempts=max_attempts, run_at=datetime.now())
+        db.session.add(job)
+        return job
+
+    @staticmethod
+    def enqueue_order_created(order):
+        NotificationService.enqueue("order_created_email", {"order_id": order.id})
+        if order.user_id:
+            NotificationService.enqueue("order_created_line", {"order_id": order.id})
+
+    @staticmethod
+    def enqueue_order_status(order, email=True, line=True):
+        if email:
+            NotificationService.enqueue("order_status_email", {"order_id": order.id})
+        if line and order.user_id:
+            NotificationService.enqueue("order_status_line", {"order_id": order.id})
+
+    @staticmethod
+    def enqueue_product_on_sale(sale):
+        payload = {
+            "sale_id": sale.id,
+            "product_id": sale.product_id,
+            "discount": sale.discount,
+            "start_date": sale.start_date.isoformat(),
+            "end_date": sale.end_date.isoformat(),
+            "description": sale.description,
+        }
+        NotificationService.enqueue("product_on_sale", payload)
+
+    @staticmethod
+    def execute(kind, payload):
+        handler = HANDLERS.get(kind)
+        if handler is None:
+            raise ValueError(f"unknown notification kind: {kind}")
+        handler(payload)
+
+    @staticmethod
+    def retry_delay(attempts):
+        """指數退避：base, 2*base, 4*base ...（上限 1 小時），加一點隨機避免同時重打"""
+        base = current_app.config.get("NOTIFY_RETRY_BASE_SECONDS", 30)
+        delay = min(base * 2 ** max(attempts - 1, 0), 3600)
+        return delay * random.uniform(1, 1.1)
+
+    @staticmethod
+    def claim(limit):
+        """
+        取出最多 limit 筆可執行的工作並標成 running
+        FOR UPDATE SKIP LOCKED：多個 worker 同時搶不會拿到同一筆，也不會互相等待
+        running 超過 NOTIFY_LOCK_TIMEOUT 秒的視為 worker 掛掉，可再被取走
+        """
+        now = datetime.now()
+        stale = now - timedelta(seconds=current_app.config.get("NOTIFY_LOCK_TIMEOUT", 300))
+        jobs = (
+            NotificationJob.query
+            .filter(or_(
+                and_(NotificationJob.status == "pending", NotificationJob.run_at <= now),
+                and_(NotificationJob.status == "running", NotificationJob.locked_at < stale),
+            ))
+            .order_by(NotificationJob.run_at, NotificationJob.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for job in jobs:
+            job.status = "running"
+            job.locked_at = now
+            job.attempts += 1
+        db.session.commit()
+        return jobs
+
+    @staticmethod
+    def run_pending(limit=None):
+        """worker 跑一輪：取一批工作逐一執行，回傳處理筆數"""
+        limit = limit or current_app.config.get("NOTIFY_BATCH_SIZE", 20)
+        jobs = NotificationService.claim(limit)
+        for job in jobs:
+            job_id, kind, payload = job.id, job.kind, job.payload
+            try:
+                if job.attempts > job.max_attempts:
+                    raise RuntimeError("worker 逾時次數過多")
+                NotificationService.execute(kind, payload)
+            except Exception as e:
+                db.session.rollback()
+                NotificationService._fail(db.session.get(NotificationJob, job_id), e)
+            else:
+                db.session.query(NotificationJob).filter_by(id=job_id).delete()
+            db.session.commit()
+        return len(jobs)
+
+    @staticmethod
+    def _fail(job, error):
+        print(f"[notify] {job.kind} job={job.id} 第 {job.attempts} 次失敗: {error}", file=sys.stderr)
+        if job.attempts >= job.max_attempts:
+            db.session.add(NotificationDeadLetter(
+                job_id=job.id, kind=job.kind, payload=job.payload,
+                attempts=job.attempts, error=str(error), created_at=job.created_at,
+            ))
+            db.session.delete(job)
+            return
+        job.status = "pending"
+        job.locked_at = None
+        job.last_error = str(error)
+        job.run_at = datetime.now() + timedelta(seconds=NotificationService.retry_delay(job.attempts))
+
+    @staticmethod
+    def requeue_dead_letters(ids=None):
+        """把 dead letter 放回佇列重跑（例如修好 SendGrid 金鑰之後）"""
+        query = NotificationDeadLetter.query
+        if ids:
+            query = query.filter(NotificationDeadLetter.id.in_(ids))
+        letters = query.all()
+        for letter in letters:
+            NotificationService.enqueue(letter.kind, letter.payload)
+            db.session.delete(letter)
+        db.session.commit()
+        return len(letters)
+
+
+class MemoryNotificationBroker:
+    """
+    broker 替身（NOTIFY_BACKEND=memory）：同 process 的背景執行緒執行，重試用 heap 依時間排序
+    process 重啟時佇列內的工作會遺失，只適合本機開發；超過重試次數一樣寫進 notification_dead_letters
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._thread = threading.Thread(target=self._run, name="notification-broker", daemon=True)
+        self._thread.start()
+
+    def submit(self, kind, payload, max_attempts, attempts=0, run_at=None, created_at=None):
+        job = {"kind": kind, "payload": payload, "max_attempts": max_attempts,
+               "attempts": attempts, "created_at": created_at or datetime.now()}
+        with self._cond:
+            heapq.heappush(self._heap, (run_at or time.monotonic(), next(self._seq), job))
+            self._cond.notify()
+
+    def join(self, timeout=5):
+        """等目前可執行的工作都跑完（不等尚未到期的重試）"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._inflight or (self._heap and self._heap[0][0] <= time.monotonic()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, job = heapq.heappop(self._heap)
+                self._inflight += 1
+            try:
+                with self.app.app_context():
+                    self._execute(job)
+            finally:
+                with self._cond:
+                    self._inflight -= 1
+                    self._cond.notify_all()
+
+    def _execute(self, job):
+        job["attempts"] += 1
+        try:
+            NotificationService.execute(job["kind"], job["payload"])
+            db.session.commit()  # fan-out 排出的工作在 commit 後才交給 broker
+        except Exception as e:
+            print(f"[notify] {job['kind']} 第 {job['attempts']} 次失敗: {e}", file=sys.stderr)
+            db.session.rollback()
+            if job["attempts"] >= job["max_attempts"]:
+                db.session.add(NotificationDeadLetter(
+                    kind=job["kind"], payload=job["payload"], attempts=job["attempts"],
+                    error=str(e), created_at=job["created_at"],
+                ))
+                db.session.commit()
+            else:
+                run_at = time.monotonic() + NotificationService.retry_delay(job["attempts"])
+                self.submit(job["kind"], job["payload"], job["max_attempts"],
+                            attempts=job["attempts"], run_at=run_at, created_at=job["created_at"])
+        finally:
+            db.session.remove()
+
+
+def get_memory_broker(app):
+    broker = app.extensions.get("notification_broker")
+    if broker is None:
+        broker = app.extensions["notification_broker"] = MemoryNotificationBroker(app)
+    return broker
+
+# memory 模式：交易 commit 之後才把工作交給 broker（rollback 就丟掉），確保 worker 讀得到訂單
+@event.listens_for(Session, "after_commit")
+def _submit_pending_notifications(session):
+    pending = session.info.pop("pending_notifications", None)
+    if pending:
+        app = current_app._get_current_object()
+        broker = get_memory_broker(app)
+        for kind, payload, max_attempts in pending:
+            broker.submit(kind, payload, max_attempts)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_notifications(session):
+    session.info.pop("pending_notifications", None)
@@ -1,9 +1,13 @@
-from models import db, Order,Product,User,OrderShipping,OrderItem
+from models import db, Order,OrderShipping,OrderItem
 from exceptions import NotFoundError,ForbiddenError,DuplicateError
 from service.audit_service import AuditService
-from utils.notify_util import send_email_notify_user_order_status,send_line_notify_user_order_status
+from service.notification_service import NotificationService
 from datetime import datetime
+from service.price_service import PriceService
+from service.unit_of_work import maybe_commit
+from sqlalchemy import insert
 from sqlalchemy.orm import joinedload
+from utils.pagination import keyset_paginate
 
 class OrderService:
     
@@ -27,17 +31,28 @@ class OrderService:
         db.session.add(order_item)
 
     @staticmethod
-    def get_all_orders(page=1, per_page=10):
-        """查詢全部訂單，依日期排序（分頁）"""
-        return Order.query.order_by(Order.order_date.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    def _add_order_items(rows):
+        """批次寫入訂單明細：rows 為 [{order_id, product_id, quantity, price}]，一次 INSERT"""
+        if rows:
+            db.session.execute(insert(OrderItem), rows)
+
+    @staticmethod
+    def get_all_orders(page=1, per_page=10, cursor=None):
+        """查詢全部訂單，依日期排序（分頁；cursor 不是 None 時改用 keyset 分頁）"""
+        if cursor is not None:
+            return keyset_paginate(Order.query, [Order.order_date, Order.id], cursor=cursor, per_page=per_page)
+        return Order.query.order_by(Order.order_date.desc(), Order.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
     @staticmethod
     def get_user_orders(user_id):
         return Order.query.filter_by(user_id=user_id).order_by(Order.order_date.desc()).all()
     
     @staticmethod
-    def get_user_orders(user_id, page=1, per_page=10):
-        """查詢某用戶的全部訂單，依日期排序"""
-        return Order.query.filter_by(user_id=user_id).order_by(Order.order_date.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    def get_user_orders(user_id, page=1, per_page=10, cursor=None):
+        """查詢某用戶的全部訂單，依日期排序（cursor 不是 None 時改用 keyset 分頁）"""
+        query = Order.query.filter_by(user_id=user_id)
+        if cursor is not None:
+            return keyset_paginate(query, [Order.order_date, Order.id], cursor=cursor, per_page=per_page)
+        return query.order_by(Order.order_date.desc(), Order.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
 
     @staticmethod
     def get_order_detail(order_id):
@@ -55,13 +70,14 @@ class OrderService:
             raise NotFoundError("Order not found")
 
         # 這時候每個 item.product 已經在記憶體，不會再查 DB
+        sales_map = PriceService.get_sales_map([item.product_id for item in order.order_items])
         items = []
         for item in order.order_items:
             product = item.product
             items.append({
                 "product_id": product.id,
                 "title": product.title,
-                "price": float(product.get_final_price()),
+                "price": float(product.get_final_price(sales_map)),
                 "quantity": item.quantity,
                 "images": product.images
             })
@@ -98,13 +114,14 @@ class OrderService:
         if not order:
             raise NotFoundError("Order not found")
 
+        sales_map = PriceService.get_sales_map([item.product_id for item in order.order_items])
         items = []
         for item in order.order_items:
             product = item.product
             items.append({
                 "product_id": product.id,
                 "title": product.title,
-                "price": float(product.get_final_price()),
+                "price": float(product.get_final_price(sales_map)),
                 "quantity": item.quantity,
                 "images": product.images
             })
@@ -134,13 +151,9 @@ class OrderService:
         if order.status not in ["pending", "paid"]:
             raise ValueError("Only pending or paid orders can be cancelled")
         order.status = 'cancelled'
+        # email 寄信通知 + line 推播通知（排進佇列，跟狀態一起 commit）
+        NotificationService.enqueue_order_status(order)
         db.session.commit()
-        
-                #email 寄信通知
-        send_email_notify_user_order_status(order)
-        #line 新增推播通知
-        user = User.get_by_user_id(order.user_id)
-        send_line_notify_user_order_status(user, order)
         return order
     
     
@@ -156,9 +169,9 @@ class OrderService:
         if order.status not in ["pending", "paid"]:
             raise ValueError("Only pending or paid orders can be cancelled")
         order.status = 'cancelled'
-        db.session.commit()
         # email 通知
-        send_email_notify_user_order_status(order)
+        NotificationService.enqueue_order_status(order, line=False)
+        db.session.commit()
         AuditService.log(
         guest_id=guest_id,
         action='guest_cancel',
@@ -183,12 +196,10 @@ class OrderService:
         if order.status == status:
             raise ValueError(f"Order is already in status '{status}'")
         order.status = status
-        db.session.commit()
-        #email 寄信通知
-        #send_email_notify_user_order_status(order)
+        #email 寄信通知（目前關閉）
         #line 新增推播通知
-        user = User.get_by_user_id(order.user_id)
-        send_line_notify_user_order_status(user, order)
+        NotificationService.enqueue_order_status(order, email=False)
+        db.session.commit()
         return order
     
     @staticmethod
@@ -233,6 +244,7 @@ class OrderService:
                 store_name=store_name
             )
             db.session.add(shipping)
+            db.session.flush()  # 先取得 shipping.id 給日誌用
         # 日誌
         AuditService.log(
             user_id = operator_user_id if operator_user_id is not None and isinstance(operator_user_id, int) else None, 
@@ -242,7 +254,7 @@ class OrderService:
             target_id=shipping.id,
             description=f"set order_shipping: {shipping.to_dict()}"
         )
-        db.session.commit()
+        maybe_commit()
         return shipping
     
     #admin only
@@ -0,0 +1,174 @@
+from models import db, Product, ProductOnSale, ProductPrice
+from datetime import datetime
+from sqlalchemy import select, case, or_, func
+from sqlalchemy.dialects.postgresql import insert
+from cache import invalidate_tags, product_tag, category_tag
+
+class PriceService:
+    """
+    維護商品有效售價投影（product_prices）
+    - 寫入：新增/修改商品、新增特價後呼叫 refresh；特價窗口開始/結束由 refresh_due 定期補算
+    - 讀取：get_sales_map 一次讀出整批商品目前的特價，投影不存在或過期的才即時計算
+    """
+
+    @staticmethod
+    def refresh(product_ids, now=None):
+        """重新計算指定商品的有效售價並 upsert 進 product_prices"""
+        product_ids = {pid for pid in product_ids if pid is not None}
+        if not product_ids:
+            return 0
+        now = now or datetime.now()
+        prices = dict(
+            db.session.query(Product.id, Product.price).filter(Product.id.in_(product_ids)).all()
+        )
+        if not prices:
+            return 0
+        # 進行中 + 尚未開始的特價（已結束的不會再影響價格）
+        sales = (
+            ProductOnSale.query
+            .filter(ProductOnSale.product_id.in_(prices.keys()), ProductOnSale.end_date >= now)
+            .order_by(ProductOnSale.id)
+            .all()
+        )
+        sales_by_product = {}
+        for sale in sales:
+            sales_by_product.setdefault(sale.product_id, []).append(sale)
+
+        rows = []
+        for product_id, price in prices.items():
+            current_sale = None
+            boundaries = []
+            for sale in sales_by_product.get(product_id, []):
+                if sale.start_date <= now:
+                    if current_sale is None:
+                        current_sale = sale
+                    boundaries.append(sale.end_date)
+                else:
+                    boundaries.append(sale.start_date)
+            final_price = float(price) * current_sale.discount if current_sale else float(price)
+            rows.append({
+                "product_id": product_id,
+                "final_price": final_price,
+                "sale_id": current_sale.id if current_sale else None,
+                "valid_until": min(boundaries) if boundaries else None,
+                "refreshed_at": now,
+            })
+
+        stmt = insert(ProductPrice).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ProductPrice.product_id],
+            set_={
+                "final_price": stmt.excluded.final_price,
+                "sale_id": stmt.excluded.sale_id,
+                "valid_until": stmt.excluded.valid_until,
+                "refreshed_at": stmt.excluded.refreshed_at,
+            }
+        )
+        db.session.execute(stmt)
+        db.session.commit()
+        return len(rows)
+
+    @staticmethod
+    def refresh_due(now=None, batch_size=500):
+        """
+        補算特價窗口已開始/結束（valid_until 已到）以及尚未建立投影的商品，每次最多處理 batch_size 筆
+        由排程/背景程序定期呼叫；回傳本次處理筆數
+        """
+        now = now or datetime.now()
+        due_ids = [
+            pid for (pid,) in db.session.query(ProductPrice.product_id)
+            .filter(ProductPrice.valid_until <= now)
+            .limit(batch_size)
+            .all()
+        ]
+        missing_ids = [
+            pid for (pid,) in db.session.query(Product.id)
+            .outerjoin(ProductPrice, ProductPrice.product_id == Product.id)
+            .filter(ProductPrice.product_id.is_(None))
+            .limit(batch_size)
+            .all()
+        ]
+        count = PriceService.refresh(due_ids + missing_ids, now=now)
+        if due_ids:
+            # 特價開始/結束，快取中的售價與價格篩選結果都要失效
+            tags = {category_tag(None)}
+            for product_id, category_id in (
+                db.session.query(Product.id, Product.category_id).filter(Product.id.in_(due_ids)).all()
+            ):
+                tags.update((product_tag(product_id), category_tag(category_id)))
+            invalidate_tags(*tags)
+        return count
+
+    @staticmethod
+    def get_sales_map(product_ids, now=None):
+        """
+        回傳 {product_id: 目前特價 ProductOnSale}（沒特價的商品不在 dict 內），格式同 ProductOnSale.get_current_by_product_ids
+        投影新鮮的商品只需一次主鍵查詢；投影缺少或過期的商品才退回即時查詢特價
+        """
+        product_ids = {pid for pid in product_ids if pid is not None}
+        if not product_ids:
+            return {}
+        now = now or datetime.now()
+        sales_map = {}
+        fresh_ids = set()
+        for row in ProductPrice.query.filter(ProductPrice.product_id.in_(product_ids)).all():
+            if row.is_fresh(now):
+                fresh_ids.add(row.product_id)
+                if row.sale:
+                    sales_map[row.product_id] = row.sale
+        stale_ids = product_ids - fresh_ids
+        if stale_ids:
+            sales_map.update(ProductOnSale.get_current_by_product_ids(stale_ids, now=now))
+        return sales_map
+
+    @staticmethod
+    def next_change(product_id, now=None):
+        """
+        商品售價下一次可能變動的時間（特價開始/結束），沒有已知的變動回傳 None
+        投影新鮮時直接用 valid_until，否則即時查特價
+        """
+        return PriceService.next_change_many([product_id], now=now)
+
+    @staticmethod
+    def next_change_many(product_ids, now=None):
+        """多個商品中最早的下一次售價變動時間（同 next_change，一次查完）"""
+        product_ids = {pid for pid in product_ids if pid is not None}
+        if not product_ids:
+            return None
+        now = now or datetime.now()
+        boundaries = []
+        stale_ids = set(product_ids)
+        for row in ProductPrice.query.filter(ProductPrice.product_id.in_(product_ids)).all():
+            if row.is_fresh(now):
+                stale_ids.discard(row.product_id)
+                if row.valid_until is not None:
+                    boundaries.append(row.valid_until)
+        if stale_ids:
+            for sale in ProductOnSale.query.filter(ProductOnSale.product_id.in_(stale_ids), ProductOnSale.end_date >= now):
+                boundaries.append(sale.end_date if sale.start_date <= now else sale.start_date)
+        return min(boundaries) if boundaries else None
+
+    @staticmethod
+    def effective_price_expression(now=None):
+        """
+        商品有效售價的 SQL 運算式（需 outerjoin ProductPrice），供價格篩選/排序使用：
+        投影新鮮用投影；否則即時查進行中的特價；都沒有就是原價
+        """
+        now = now or datetime.now()
+        projected = case(
+            (or_(ProductPrice.valid_until.is_(None), ProductPrice.valid_until > now), ProductPrice.final_price),
+            else_=None,
+        )
+        live_sale_price = (
+            select(Product.price * ProductOnSale.discount)
+            .where(
+                ProductOnSale.product_id == Product.id,
+                ProductOnSale.start_date <= now,
+                ProductOnSale.end_date >= now,
+            )
+            .order_by(ProductOnSale.id)
+            .limit(1)
+            .correlate(Product)
+            .scalar_subquery()
+        )
+        return func.coalesce(projected, live_sale_price, Product.price)
@@ -1,28 +1,86 @@
-from models import db, Product,ProductOnSale,OrderItem,Order,Cart,CartItem
+from models import db, Product,ProductOnSale,ProductPrice,OrderItem,Order,Cart,CartItem
 from exceptions import NotFoundError
 from datetime import datetime
-from sqlalchemy import func
-from utils import notify_util
+from service.notification_service import NotificationService
+from service.copurchase_service import CopurchaseService
+from service.price_service import PriceService
+from service.recommendation_service import RecommendationService
+from service.sales_rank_service import SalesRankService
+from service.search_service import ProductSearchService
+from utils.pagination import keyset_paginate
+from cache import cache, invalidate_product, set_tagged, product_tag, record_hit
 class ProductService:
     @staticmethod
-    def search_all_admin(page=1, per_page=10):
+    def to_dict_list(products):
+        """
+        批次序列化商品列表：整頁商品的特價用一次查詢取得（PriceService.get_sales_map），
+        所有列表/推薦 API 都應透過這裡輸出，避免每個商品 lazy load sales
+        """
+        products = list(products)
+        sales_map = PriceService.get_sales_map([p.id for p in products])
+        return [p.to_dict(sales_map=sales_map) for p in products]
+
+    DETAIL_CACHE_TIMEOUT = 300
+
+    @staticmethod
+    def get_product_detail(product_id):
+        """
+        單一上架商品的序列化資料（read-through 快取）
+        TTL 不超過下一次特價開始/結束；商品異動時透過 product:<id> 標籤失效
+        商品不存在或已下架回傳 None
+        """
+        key = f"products:detail:{product_id}"
+        data = cache.get(key)
+        record_hit("product_detail", data is not None)
+        if data is not None:
+            return data
+
+        product = Product.get_active_by_product_id(product_id)
+        if not product:
+            return None
+        now = datetime.now()
+        data = ProductService.to_dict_list([product])[0]
+        timeout = ProductService.DETAIL_CACHE_TIMEOUT
+        next_change = PriceService.next_change(product_id, now=now)
+        if next_change is not None:
+            timeout = max(1, min(timeout, int((next_change - now).total_seconds())))
+        set_tagged(key, data, [product_tag(product_id)], timeout=timeout)
+        return data
+
+    @staticmethod
+    def search_all_admin(page=1, per_page=10, cursor=None):
+        # cursor 不是 None 時改用 keyset 分頁（不算總數）
+        if cursor is not None:
+            return keyset_paginate(Product.query, [Product.id], cursor=cursor, per_page=per_page, descending=False)
         query = Product.query.order_by(Product.id)
         return query.paginate(page=page, per_page=per_page, error_out=False)
     
     @staticmethod
-    def search(category_id=None, keyword=None, min_price=None, max_price=None, page=1, per_page=10):
+    def search(category_id=None, keyword=None, min_price=None, max_price=None, page=1, per_page=10, cursor=None):
         query = Product.query.filter_by(is_active=True)
         if category_id is not None:
             query = query.filter_by(category_id=category_id)
+        rank = None
         if keyword:
-            query = query.filter(Product.title.ilike(f"%{keyword}%"))
-        if min_price is not None:
-            query = query.filter(Product.price >= min_price)
-        if max_price is not None:
-            query = query.filter(Product.price <= max_price)
-        
-        query =query.order_by(Product.title.desc())
+            # 全文檢索 + 子字串（走 GIN 索引），依相關度排序
+            query, rank = ProductSearchService.apply(query, keyword)
+        if min_price is not None or max_price is not None:
+            # 依特價後的有效售價篩選
+            effective_price = PriceService.effective_price_expression()
+            query = query.outerjoin(ProductPrice, ProductPrice.product_id == Product.id)
+            if min_price is not None:
+                query = query.filter(effective_price >= min_price)
+            if max_price is not None:
+                query = query.filter(effective_price <= max_price)
         
+        # 依 (title, id) 由大到小；關鍵字搜尋時相關度優先
+        keys = [Product.title, Product.id]
+        if rank is not None:
+            keys.insert(0, rank)
+        if cursor is not None:
+            return keyset_paginate(query, keys, cursor=cursor, per_page=per_page)
+
+        query = query.order_by(*[key.desc() for key in keys])
         return query.paginate(page=page, per_page=per_page, error_out=False)
     
     @staticmethod
@@ -40,6 +98,8 @@ class ProductService:
         )
         db.session.add(product)
         db.session.commit()
+        PriceService.refresh([product.id])
+        invalidate_product(product.id, product.category_id)
         return product
 
     @staticmethod
@@ -47,6 +107,7 @@ class ProductService:
         product = Product.get_by_product_id(product_id)
         if not product:
             raise NotFoundError("product not found")
+        old_category_id = product.category_id
         if title:
             product.title = title
         if price:
@@ -58,6 +119,12 @@ class ProductService:
         if images is not None:
             product.images = images
         db.session.commit()
+        PriceService.refresh([product.id])
+        if title or price or description or category_id:
+            # 會影響搜尋/價格篩選/排序結果，新舊分類的列表都要失效
+            invalidate_product(product.id, old_category_id, product.category_id)
+        else:
+            invalidate_product(product.id)
         return product
 
     @staticmethod
@@ -67,6 +134,8 @@ class ProductService:
             raise NotFoundError("product not found")
         db.session.delete(product)
         db.session.commit()
+        invalidate_product(product.id, product.category_id)
+        RecommendationService.mark_all_stale()
         return product
 
     @staticmethod
@@ -101,34 +170,22 @@ class ProductService:
         description=description
         )
         db.session.add(sale)
+        db.session.flush()  # 先取得 sale.id：通知的去重 key 用它區分同一商品、同一開始時間的不同特價
+        # 特價通知（email / line）排進佇列，跟特價一起 commit，交給 notification worker 寄送
+        NotificationService.enqueue_product_on_sale(sale)
         db.session.commit()
-        
-        # 呼叫通知 send mail function
-        notify_util.send_email_notify_users_cart_product_on_sale(product_id, discount, start_date, end_date, description)
-        # 呼叫通知 send line function
-        notify_util.send_line_notify_users_cart_product_on_sale(product_id, discount, start_date, end_date, description)
-        
+        PriceService.refresh([product_id])
+        product = db.session.get(Product, product_id)
+        invalidate_product(product_id, product.category_id if product else None)
         return sale
     
     @staticmethod
-    def get_top_products(limit=5):
+    def get_top_products(limit=5, days=None):
         """
-        取熱賣商品（依訂單明細被賣出數量排行）
+        取熱賣商品（只含上架中），days=None 為累計銷量，7 / 30 為近幾天銷量
+        排行榜由 SalesRankService 在結帳時維護，這裡只取前 limit 名
         """
-        # 依照 OrderItem 統計每個 product_id 的總銷售數量
-        hot_products = (
-            db.session.query(
-                Product,
-                func.coalesce(func.sum(OrderItem.quantity), 0).label("total_sold")
-            )
-            .outerjoin(OrderItem, Product.id == OrderItem.product_id)
-            .group_by(Product.id)
-            .order_by(func.sum(OrderItem.quantity).desc().nullslast())
-            .limit(limit)
-            .all()
-        )
-        # 取出 Product 物件
-        return [prod for prod, total in hot_products]
+        return SalesRankService.get_top_products(limit=limit, days=days)
     
     @staticmethod
     def recommend_for_user(user_id, limit=5):
@@ -149,26 +206,10 @@ class ProductService:
         if not category_ids:
             return []
 
-        # 3. 找這些分類下，未買過的熱賣商品
-        subq = (
-            db.session.query(
-                OrderItem.product_id,
-                db.func.count(OrderItem.id).label('order_count')
-            )
-            .group_by(OrderItem.product_id)
-            .subquery()
-        )
-        products = (
-            db.session.query(Product)
-            .outerjoin(subq, Product.id == subq.c.product_id)
-            .filter(Product.category_id.in_(category_ids))
-            .filter(~Product.id.in_(bought_product_ids))
-            .filter(Product.is_active == True)
-            .order_by(subq.c.order_count.desc().nullslast(), Product.id.desc())
-            .limit(limit)
-            .all()
+        # 3. 找這些分類下，未買過的熱賣商品（各分類熱門排行已預先算好並快取）
+        return ProductService._load_in_order(
+            SalesRankService.popular_product_ids(category_ids, bought_product_ids, limit)
         )
-        return products
     
     #根據購物車
     @staticmethod
@@ -192,74 +233,29 @@ class ProductService:
             return []
         
         # 找這些分類下、尚未在購物車的熱賣商品
-        subq = (
-            db.session.query(
-                OrderItem.product_id,
-                db.func.count(OrderItem.id).label('order_count')
-            )
-            .group_by(OrderItem.product_id)
-            .subquery()
-        )
-        products = (
-            db.session.query(Product)
-            .outerjoin(subq, Product.id == subq.c.product_id)
-            .filter(Product.category_id.in_(category_ids))
-            .filter(~Product.id.in_(cart_product_ids))
-            .filter(Product.is_active == True)
-            .order_by(subq.c.order_count.desc().nullslast(), Product.id.desc())
-            .limit(limit)
-            .all()
+        return ProductService._load_in_order(
+            SalesRankService.popular_product_ids(category_ids, cart_product_ids, limit)
         )
-        return products
+
+    @staticmethod
+    def _load_in_order(product_ids):
+        """依 product_ids 的順序載入商品"""
+        if not product_ids:
+            return []
+        products = {p.id: p for p in Product.query.filter(Product.id.in_(product_ids)).all()}
+        return [products[pid] for pid in product_ids if pid in products]
     
     #協同過濾(有買過你購物車內商品的人，還常常一起買哪些商品)
     @staticmethod
     def recommend_for_cart_collaborative(user_id, limit=5):
-        # 1. 取得購物車內商品 id
+        """
+        共同購買推薦：購物車各商品的前 K 個共同購買商品（離線批次 build_copurchase.py 產生）合併分數
+        線上只查購物車 + product_neighbors + 商品，不再彙總訂單歷史（批次還沒跑過時才即時彙總）
+        """
         cart = Cart.query.filter_by(user_id=user_id, status='active').order_by(Cart.created_at.desc()).first()
         if not cart or not cart.cart_items:
             return []
-        cart_product_ids = [item.product_id for item in cart.cart_items]
-        
-        # 2. 有買過這些商品的用戶 id（不含自己）
-        users = db.session.query(Order.user_id)\
-            .join(OrderItem, Order.id == OrderItem.order_id)\
-            .filter(OrderItem.product_id.in_(cart_product_ids))\
-            .filter(Order.user_id != user_id)\
-            .distinct().all()
-        user_ids = [uid[0] for uid in users]
-        if not user_ids:
-            return []
-
-        # 3. 這些用戶還買過什麼商品，排除購物車已存在商品
-        bought_items = db.session.query(
-                OrderItem.product_id,
-                db.func.count(OrderItem.id).label('cnt')
-            )\
-            .join(Order, Order.id == OrderItem.order_id)\
-            .filter(Order.user_id.in_(user_ids))\
-            .filter(~OrderItem.product_id.in_(cart_product_ids))\
-            .group_by(OrderItem.product_id)\
-            .order_by(db.desc('cnt'))\
-            .limit(limit)\
-            .all()
-        
-        product_ids = [item[0] for item in bought_items]
-        if not product_ids:
-            return []
-
-        # 4. 撈出商品資料
-        products = Product.query.filter(Product.id.in_(product_ids),Product.is_active == True).all()  # 其他條件也可以加進來
-
-        # 最終結果排序依照出現次數
-        id_to_product_map = {p.id: p for p in products}
-        
-        result = []
-        for pid in product_ids:
-            if pid in id_to_product_map:
-                result.append(id_to_product_map[pid])
-        
-        return result
+        return CopurchaseService.recommend([item.product_id for item in cart.cart_items], limit, user_id)
     
     @staticmethod
     def set_product_active_status(product_id, is_active):
@@ -268,4 +264,7 @@ class ProductService:
             raise NotFoundError("product not found")
         product.is_active = is_active
         db.session.commit()
+        invalidate_product(product.id, product.category_id)
+        # 推薦結果裡可能有剛下架的商品（讀取時會濾掉，但會少一個）、或少了剛上架的，全部標成過期
+        RecommendationService.mark_all_stale()
         return product
\ No newline at end of file
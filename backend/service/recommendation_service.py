@@ -0,0 +1,196 @@
+import sys
+import threading
+import traceback
+import uuid
+from flask import current_app
+from models import db, Product
+from cache import cache, record_hit, record_event, add_pending, pop_pending
+
+# 快取的推薦種類：user = 依購買紀錄、cart = 依購物車分類、collaborative = 共同購買
+RECOMMEND_KINDS = ("user", "cart", "collaborative")
+CART_KINDS = ("cart", "collaborative")
+PENDING_NAME = "recommend"
+GLOBAL_VERSION_KEY = "recs:version:all"
+
+class RecommendationService:
+    """
+    會員推薦結果快取：每個會員、每種推薦快取前 RECOMMEND_CACHE_SIZE 名商品 id，請求只讀快取再依 id 載入商品
+    - 過期判斷：結果記下算的當下的會員版本與全域版本；結帳、購物車異動換掉該會員的版本，商品上下架 / 刪除換掉全域版本
+    - 過期的結果照樣回傳（只濾掉已下架商品），同時排進待重算集合，由背景 refresher 批次重算；
+      RECOMMEND_REFRESH_ASYNC 關閉時（測試）改成當場重算
+    - 完全沒有快取（第一次查、被淘汰、limit 超過快取長度）才在請求中計算
+    - 分類熱門排行、共同購買模型本身的變動不換版本，最多 RECOMMEND_CACHE_TIMEOUT 秒後反映
+    """
+
+    @staticmethod
+    def get(kind, user_id, limit=5):
+        """回傳推薦商品（Product list，只含上架中）"""
+        pool_size = current_app.config.get("RECOMMEND_CACHE_SIZE", 20)
+        if limit <= 0:
+            return []
+        if limit > pool_size:
+            return RecommendationService._compute(kind, user_id, limit)
+
+        entry, user_version, global_version = cache.get_many(
+            RecommendationService._entry_key(kind, user_id),
+            RecommendationService._version_key(user_id),
+            GLOBAL_VERSION_KEY,
+        )
+        name = f"recommend_{kind}"
+        record_hit(name, entry is not None)
+        if entry is None:
+            product_ids = RecommendationService._store(kind, user_id, user_version, global_version)
+        elif entry["user_version"] != user_version or entry["global_version"] != global_version:
+            record_event(name, "stale")
+            if current_app.config.get("RECOMMEND_REFRESH_ASYNC"):
+                product_ids = entry["product_ids"]
+                RecommendationService._schedule([(kind, user_id)])
+            else:
+                product_ids = RecommendationService._store(kind, user_id, user_version, global_version)
+        else:
+            product_ids = entry["product_ids"]
+        return RecommendationService._load_active(product_ids, limit)
+
+    @staticmethod
+    def mark_stale(user_id, kinds=RECOMMEND_KINDS):
+        """會員的結帳 / 購物車異動（commit 之後）：換掉會員版本，已有快取的結果排進背景重算"""
+        if not user_id:
+            return
+        RecommendationService._bump(RecommendationService._version_key(user_id))
+        if not current_app.config.get("RECOMMEND_REFRESH_ASYNC"):
+            return
+        keys = [RecommendationService._entry_key(kind, user_id) for kind in kinds]
+        cached = [kind for kind, entry in zip(kinds, cache.get_many(*keys)) if entry is not None]
+        RecommendationService._schedule([(kind, user_id) for kind in cached])
+
+    @staticmethod
+    def mark_all_stale():
+        """商品上下架 / 刪除：所有會員的結果都過期，各自在下次讀取時排進重算"""
+        RecommendationService._bump(GLOBAL_VERSION_KEY)
+
+    @staticmethod
+    def refresh_pending(batch_size=100):
+        """重算待重算集合中最多 batch_size 筆，回傳取出的筆數"""
+        members = pop_pending(PENDING_NAME, batch_size)
+        if not members:
+            return 0
+        pending = [member.split(":", 1) for member in members]
+        versions = cache.get_many(
+            GLOBAL_VERSION_KEY, *(RecommendationService._version_key(user_id) for _, user_id in pending)
+        )
+        global_version = versions[0]
+        for (kind, user_id), user_version in zip(pending, versions[1:]):
+            try:
+                RecommendationService._store(kind, int(user_id), user_version, global_version)
+            except Exception as e:
+                db.session.rollback()
+                traceback.print_exc()
+                print(f"推薦重算失敗 {kind}:{user_id}:", e, file=sys.stderr)
+        return len(members)
+
+    @staticmethod
+    def _store(kind, user_id, user_version, global_version):
+        """
+        計算並寫入快取；版本要在計算「之前」讀取：
+        計算期間若又有異動，寫入的版本已經舊了，下次讀取時會再判定過期，不會把舊結果當成新的
+        """
+        config = current_app.config
+        product_ids = [
+            p.id for p in RecommendationService._compute(kind, user_id, config.get("RECOMMEND_CACHE_SIZE", 20))
+        ]
+        cache.set(
+            RecommendationService._entry_key(kind, user_id),
+            {"product_ids": product_ids, "user_version": user_version, "global_version": global_version},
+            timeout=config.get("RECOMMEND_CACHE_TIMEOUT", 600),
+        )
+        return product_ids
+
+    @staticmethod
+    def _compute(kind, user_id, limit):
+        from service.product_service import ProductService
+        if kind == "user":
+            return ProductService.recommend_for_user(user_id, limit)
+        if kind == "cart":
+            return ProductService.recommend_for_cart(user_id, limit)
+        if kind == "collaborative":
+            return ProductService.recommend_for_cart_collaborative(user_id, limit)
+        raise ValueError(f"未知的推薦種類: {kind}")
+
+    @staticmethod
+    def _load_active(product_ids, limit):
+        """依順序載入上架中的商品，取前 limit 個（過期結果裡可能有剛下架的）"""
+        if not product_ids:
+            return []
+        products = {
+            p.id: p for p in Product.query.filter(Product.id.in_(product_ids), Product.is_active == True).all()
+        }
+        return [products[pid] for pid in product_ids if pid in products][:limit]
+
+    @staticmethod
+    def _schedule(pending):
+        if not pending:
+            return
+        add_pending(PENDING_NAME, *(f"{kind}:{user_id}" for kind, user_id in pending))
+        get_recommendation_refresher(current_app._get_current_object()).wake()
+
+    @staticmethod
+    def _bump(key):
+        # 版本用亂數而不是計數器：版本 key 過期後不會從頭數回舊值，讓舊結果被誤判成最新
+        timeout = current_app.config.get("RECOMMEND_CACHE_TIMEOUT", 600) * 2
+        cache.set(key, uuid.uuid4().hex, timeout=timeout)
+
+    @staticmethod
+    def _entry_key(kind, user_id):
+        return f"recs:{kind}:{user_id}"
+
+    @staticmethod
+    def _version_key(user_id):
+        return f"recs:version:{user_id}"
+
+
+class RecommendationRefresher:
+    """
+    背景重算執行緒：每 interval 秒（或被 wake 叫醒時）把待重算集合分批取出重算，直到取空
+    用 Redis 時集合由所有 worker 共用，哪個 worker 的 refresher 先取到就由它算
+    """
+
+    def __init__(self, app, interval=1.0, batch_size=100):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self._wake = threading.Event()
+        self.refreshed = 0
+        threading.Thread(target=self._run, name="recommend-refresher", daemon=True).start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self.app.app_context():
+                try:
+                    while True:
+                        count = RecommendationService.refresh_pending(self.batch_size)
+                        self.refreshed += count
+                        if count < self.batch_size:
+                            break
+                except Exception as e:
+                    traceback.print_exc()
+                    print("推薦背景重算失敗:", e, file=sys.stderr)
+                finally:
+                    db.session.remove()
+
+_refresher_lock = threading.Lock()
+
+def get_recommendation_refresher(app):
+    with _refresher_lock:
+        refresher = app.extensions.get("recommendation_refresher")
+        if refresher is None:
+            refresher = app.extensions["recommendation_refresher"] = RecommendationRefresher(
+                app,
+                interval=app.config.get("RECOMMEND_REFRESH_INTERVAL", 1.0),
+                batch_size=app.config.get("RECOMMEND_REFRESH_BATCH", 100),
+            )
+        return refresher
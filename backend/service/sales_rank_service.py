@@ -0,0 +1,248 @@
+import heapq
+from models import db, Product, Order, OrderItem, ProductSalesStat, ProductSalesDaily
+from datetime import datetime, timedelta
+from sqlalchemy import func, cast, Date, select
+from sqlalchemy.dialects.postgresql import insert
+from cache import cache, set_tagged, invalidate_tags, category_tag, record_hit
+
+# 熱賣排行：支援的統計視窗（天）；None = 累計
+SALES_RANK_WINDOWS = (7, 30)
+# 視窗排行要加總「商品數 × 天數」筆每日銷量，結果短暫快取（排行變動慢，晚幾十秒反映可接受）
+WINDOW_CACHE_TIMEOUT = 60
+# 分類熱門排行：每個分類快取前 POPULAR_POOL_SIZE 名
+POPULAR_POOL_SIZE = 200
+POPULAR_CACHE_TIMEOUT = 300
+
+class SalesRankService:
+    """
+    維護熱賣排行榜（product_sales_stats 累計銷量 + product_sales_daily 每日銷量）
+    - 寫入：結帳時 record 跟訂單明細同一個交易累加，不另外 commit
+    - 讀取：累計排行走索引取前 N 名；近 7 / 30 天排行只加總視窗內的每日銷量（結果快取 WINDOW_CACHE_TIMEOUT 秒）
+    - 分類熱門：各分類依訂單明細筆數的排行快取在 cache，個人化推薦只需在短清單中排除已買 / 已在購物車的商品
+    - 重建：rebuild 依 order_items 重算（首次上線、匯入舊訂單後），並清掉超出最大視窗的每日銷量
+    """
+
+    @staticmethod
+    def record(rows, order_date=None):
+        """rows：[{product_id, quantity}]（同訂單明細），累加進累計與當日銷量"""
+        sold = {}
+        lines = {}
+        for row in rows:
+            product_id = row.get("product_id")
+            if product_id is not None:
+                sold[product_id] = sold.get(product_id, 0) + int(row.get("quantity") or 0)
+                lines[product_id] = lines.get(product_id, 0) + 1
+        if not sold:
+            return
+        now = datetime.now()
+        day = (order_date or now).date()
+        # 依 product_id 排序寫入，同時結帳的交易以相同順序鎖列，不會互相 deadlock
+        product_ids = sorted(sold)
+
+        stmt = insert(ProductSalesStat).values(
+            [{"product_id": pid, "total_sold": sold[pid], "order_count": lines[pid], "updated_at": now}
+             for pid in product_ids]
+        )
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[ProductSalesStat.product_id],
+            set_={
+                "total_sold": ProductSalesStat.total_sold + stmt.excluded.total_sold,
+                "order_count": ProductSalesStat.order_count + stmt.excluded.order_count,
+                "updated_at": stmt.excluded.updated_at,
+            }
+        ))
+        stmt = insert(ProductSalesDaily).values(
+            [{"product_id": pid, "day": day, "quantity": sold[pid]} for pid in product_ids]
+        )
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[ProductSalesDaily.product_id, ProductSalesDaily.day],
+            set_={"quantity": ProductSalesDaily.quantity + stmt.excluded.quantity}
+        ))
+
+    @staticmethod
+    def get_top_products(limit=5, days=None):
+        """
+        熱賣商品（只含上架中）：依銷量排行，同銷量 id 大的在前
+        視窗內賣出的不足 limit 個時，用累計排行補，再不足用還沒賣出過的商品補
+        """
+        if days is not None and days not in SALES_RANK_WINDOWS:
+            raise ValueError(f"days 只支援 {', '.join(str(d) for d in SALES_RANK_WINDOWS)}")
+        if limit <= 0:
+            return []
+        products = SalesRankService._ranked(limit, days)
+        if days is not None and len(products) < limit:
+            seen = {p.id for p in products}
+            products += [p for p in SalesRankService._ranked(limit, None) if p.id not in seen][:limit - len(products)]
+        if len(products) < limit:
+            # 累計排行不足 limit 代表上架中賣過的商品都已在列表內，其餘都是還沒賣出過的
+            products += (
+                Product.query
+                .filter(Product.is_active == True, ~Product.id.in_([p.id for p in products]))
+                .order_by(Product.id.desc())
+                .limit(limit - len(products))
+                .all()
+            )
+        return products
+
+    @staticmethod
+    def _ranked(limit, days=None):
+        if days is None:
+            return (
+                db.session.query(Product)
+                .join(ProductSalesStat, ProductSalesStat.product_id == Product.id)
+                .filter(Product.is_active == True, ProductSalesStat.total_sold > 0)
+                .order_by(ProductSalesStat.total_sold.desc(), ProductSalesStat.product_id.desc())
+                .limit(limit)
+                .all()
+            )
+        key = f"products:top:{days}:{limit}"
+        product_ids = cache.get(key)
+        if product_ids is None:
+            product_ids = SalesRankService._window_ids(limit, days)
+            # 掛 category:all：商品上下架 / 修改時跟著失效
+            set_tagged(key, product_ids, [category_tag(None)], timeout=WINDOW_CACHE_TIMEOUT)
+        if not product_ids:
+            return []
+        products = {
+            p.id: p for p in Product.query.filter(Product.id.in_(product_ids), Product.is_active == True).all()
+        }
+        return [products[pid] for pid in product_ids if pid in products]
+
+    @staticmethod
+    def _window_ids(limit, days):
+        since = datetime.now().date() - timedelta(days=days - 1)
+        window = (
+            db.session.query(
+                ProductSalesDaily.product_id,
+                func.sum(ProductSalesDaily.quantity).label("sold")
+            )
+            .filter(ProductSalesDaily.day >= since)
+            .group_by(ProductSalesDaily.product_id)
+            .subquery()
+        )
+        return [
+            pid for (pid,) in db.session.query(Product.id)
+            .join(window, window.c.product_id == Product.id)
+            .filter(Product.is_active == True, window.c.sold > 0)
+            .order_by(window.c.sold.desc(), Product.id.desc())
+            .limit(limit)
+            .all()
+        ]
+
+    @staticmethod
+    def category_ranking(category_id):
+        """
+        分類內上架商品的熱門排行（read-through 快取）：訂單明細筆數多的在前、同筆數 id 大的在前、沒賣過的排最後
+        只快取前 POPULAR_POOL_SIZE 名 {"items": [[order_count, product_id]], "truncated": 後面是否還有商品}
+        商品異動時透過 category:<id> 標籤失效；結帳後由 invalidate_popular 失效
+        """
+        key = f"products:popular:{category_id}"
+        ranking = cache.get(key)
+        record_hit("category_popular", ranking is not None)
+        if ranking is not None:
+            return ranking
+        order_count = func.coalesce(ProductSalesStat.order_count, 0)
+        rows = (
+            db.session.query(order_count, Product.id)
+            .outerjoin(ProductSalesStat, ProductSalesStat.product_id == Product.id)
+            .filter(Product.category_id == category_id, Product.is_active == True)
+            .order_by(order_count.desc(), Product.id.desc())
+            .limit(POPULAR_POOL_SIZE + 1)
+            .all()
+        )
+        ranking = {
+            "items": [[count, product_id] for count, product_id in rows[:POPULAR_POOL_SIZE]],
+            "truncated": len(rows) > POPULAR_POOL_SIZE,
+        }
+        set_tagged(key, ranking, [category_tag(category_id)], timeout=POPULAR_CACHE_TIMEOUT)
+        return ranking
+
+    @staticmethod
+    def popular_product_ids(category_ids, exclude_ids=(), limit=5):
+        """
+        多個分類的熱門商品合併排行（排除 exclude_ids），排序同 category_ranking
+        各分類的快取排行已排好序，用 heapq.merge 合併；快取的前 N 名被排除到不夠用時才查資料庫
+        """
+        category_ids = sorted({cid for cid in category_ids if cid is not None})
+        exclude_ids = set(exclude_ids)
+        if not category_ids or limit <= 0:
+            return []
+        streams = []
+        for category_id in category_ids:
+            ranking = SalesRankService.category_ranking(category_id)
+            stream = [(-count, -product_id, 0, product_id) for count, product_id in ranking["items"]]
+            if ranking["truncated"] and stream:
+                # 哨兵：排在該分類快取的最後一名之後，合併走到這裡代表後面的名次要查資料庫才知道
+                stream.append(stream[-1][:2] + (1, None))
+            streams.append(stream)
+        result = []
+        for _, _, _, product_id in heapq.merge(*streams):
+            if product_id is None:
+                return SalesRankService._popular_product_ids_from_db(category_ids, exclude_ids, limit)
+            if product_id not in exclude_ids:
+                result.append(product_id)
+                if len(result) == limit:
+                    break
+        return result
+
+    @staticmethod
+    def _popular_product_ids_from_db(category_ids, exclude_ids, limit):
+        order_count = func.coalesce(ProductSalesStat.order_count, 0)
+        return [
+            product_id for (product_id,) in db.session.query(Product.id)
+            .outerjoin(ProductSalesStat, ProductSalesStat.product_id == Product.id)
+            .filter(Product.category_id.in_(category_ids), Product.is_active == True)
+            .filter(~Product.id.in_(exclude_ids))
+            .order_by(order_count.desc(), Product.id.desc())
+            .limit(limit)
+            .all()
+        ]
+
+    @staticmethod
+    def invalidate_popular(category_ids):
+        """結帳後（commit 之後）失效賣出商品所屬分類的熱門排行"""
+        keys = [f"products:popular:{cid}" for cid in set(category_ids) if cid is not None]
+        if keys:
+            cache.delete_many(*keys)
+
+    @staticmethod
+    def prune(now=None):
+        """刪除超出最大視窗的每日銷量，回傳刪除筆數"""
+        now = now or datetime.now()
+        since = now.date() - timedelta(days=max(SALES_RANK_WINDOWS) - 1)
+        count = ProductSalesDaily.query.filter(ProductSalesDaily.day < since).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @staticmethod
+    def rebuild(now=None):
+        """依 order_items 重算整個排行榜（同一個交易內清空再寫入），回傳有銷量的商品數"""
+        now = now or datetime.now()
+        since = now.date() - timedelta(days=max(SALES_RANK_WINDOWS) - 1)
+        db.session.execute(ProductSalesStat.__table__.delete())
+        db.session.execute(ProductSalesDaily.__table__.delete())
+
+        totals = (
+            select(OrderItem.product_id, func.sum(OrderItem.quantity), func.count(OrderItem.id), func.now())
+            .where(OrderItem.product_id.isnot(None))
+            .group_by(OrderItem.product_id)
+        )
+        result = db.session.execute(
+            insert(ProductSalesStat).from_select(["product_id", "total_sold", "order_count", "updated_at"], totals)
+        )
+        order_day = cast(Order.order_date, Date)
+        daily = (
+            select(OrderItem.product_id, order_day, func.sum(OrderItem.quantity))
+            .join(Order, Order.id == OrderItem.order_id)
+            .where(OrderItem.product_id.isnot(None), Order.order_date >= since)
+            .group_by(OrderItem.product_id, order_day)
+        )
+        db.session.execute(
+            insert(ProductSalesDaily).from_select(["product_id", "day", "quantity"], daily)
+        )
+        db.session.commit()
+        # 累計 / 視窗排行與各分類熱門排行都重算了
+        invalidate_tags(category_tag(None), *(
+            category_tag(cid) for (cid,) in db.session.query(Product.category_id).distinct()
+        ))
+        return result.rowcount
@@ -0,0 +1,66 @@
+import re
+from models import db, Product
+from sqlalchemy import func, literal_column, or_, text, cast, Float
+
+class ProductSearchService:
+    """
+    商品關鍵字搜尋（GET /products?keyword=）
+    - 全文檢索：Product.search_vector = title（權重 A）+ description（權重 B）（GIN 索引 ix_products_search），每個詞做前綴比對並依 ts_rank 排序
+    - 子字串：中文沒有空白斷詞，另外用 pg_trgm GIN 索引支援 ILIKE '%kw%'；資料庫沒有 pg_trgm 時，只有中文關鍵字退回舊的 title ILIKE
+    """
+    _trigram_enabled = None  # 每個 process 只檢查一次
+    NON_ASCII = re.compile(r"[^\x00-\x7f]")
+
+    @staticmethod
+    def build_tsquery(keyword):
+        """'iPhone 99' -> 'iphone:* & 99:*'（只取文字，避免使用者輸入破壞 tsquery 語法）"""
+        tokens = re.findall(r"\w+", (keyword or "").lower())
+        return " & ".join(f"{token}:*" for token in tokens)
+
+    @staticmethod
+    def search_document():
+        # generated column Product.search_vector（GIN 索引 ix_products_search）
+        return Product.search_vector
+
+    @classmethod
+    def trigram_enabled(cls):
+        if cls._trigram_enabled is None:
+            cls._trigram_enabled = db.session.execute(
+                text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_products_title_trgm'")
+            ).first() is not None
+        return cls._trigram_enabled
+
+    @staticmethod
+    def _like_pattern(keyword):
+        escaped = keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return f"%{escaped}%"
+
+    @classmethod
+    def apply(cls, query, keyword):
+        """
+        在 query 上加上關鍵字條件，回傳 (query, rank)；rank 為相關度運算式，越大越相關（無法計算時為 None）
+        """
+        conditions = []
+        rank_terms = []
+        tsquery = cls.build_tsquery(keyword)
+        if tsquery:
+            document = cls.search_document()
+            ts_query = func.to_tsquery(literal_column("'simple'"), tsquery)
+            conditions.append(document.op('@@')(ts_query))
+            rank_terms.append(func.ts_rank(document, ts_query))
+
+        pattern = cls._like_pattern(keyword)
+        if cls.trigram_enabled():
+            conditions.append(Product.title.ilike(pattern, escape="\\"))
+            conditions.append(Product.description.ilike(pattern, escape="\\"))
+            rank_terms.append(func.similarity(Product.title, keyword))
+        elif not tsquery or cls.NON_ASCII.search(keyword):
+            # 沒有 trigram 索引時 ILIKE 一定是全表掃描，只留給全文檢索斷不開的中文關鍵字
+            conditions.append(Product.title.ilike(pattern, escape="\\"))
+        rank = None
+        for term in rank_terms:
+            rank = term if rank is None else rank + term
+        if rank is not None:
+            # ts_rank 回傳 real；轉成 double 讓 cursor 分頁帶回的值能精確比較
+            rank = cast(rank, Float)
+        return query.filter(or_(*conditions)), rank
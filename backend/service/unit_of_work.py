@@ -0,0 +1,35 @@
+from contextlib import contextmanager
+from models import db
+
+# Unit of work：把多個 service 呼叫包成同一個交易
+#   with unit_of_work():
+#       OrderService.set_shipping_info(...)   # 內部的 maybe_commit() 只 flush
+#       AuditService.log(...)
+#   # 離開區塊才 commit 一次；中途發生例外整個 rollback，不會留下一半的訂單
+
+@contextmanager
+def unit_of_work():
+    """可巢狀，只有最外層負責 commit / rollback"""
+    info = db.session.info
+    depth = info.get("unit_of_work_depth", 0)
+    info["unit_of_work_depth"] = depth + 1
+    try:
+        yield db.session
+        if depth == 0:
+            db.session.commit()
+    except Exception:
+        if depth == 0:
+            db.session.rollback()
+        raise
+    finally:
+        info["unit_of_work_depth"] = depth
+
+def in_unit_of_work():
+    return db.session.info.get("unit_of_work_depth", 0) > 0
+
+def maybe_commit():
+    """service 寫入後呼叫：在 unit_of_work 內只 flush（交給外層 commit），否則照舊直接 commit"""
+    if in_unit_of_work():
+        db.session.flush()
+    else:
+        db.session.commit()
@@ -5,6 +5,9 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 from app import create_app
 from models import db, User, Category
 from config import TestingConfig
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 @pytest.fixture(autouse=True)
 def patch_async_notify(monkeypatch):
     monkeypatch.setattr('utils.notify_util.send_email_notify_order_created', lambda *a, **k: None)
@@ -39,3 +42,68 @@ def app():
 @pytest.fixture
 def client(app):
     return app.test_client()
+
+@pytest.fixture
+def query_counter(app):
+    """
+    計算區塊內送出的 SQL 數量，用來驗證列表 API 不會隨筆數產生 N+1 查詢
+        with query_counter() as counter:
+            client.get('/products')
+        counter.count
+    """
+    from contextlib import contextmanager
+    from sqlalchemy import event
+
+    class Counter:
+        count = 0
+
+    @contextmanager
+    def _count():
+        counter = Counter()
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            counter.count += 1
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield counter
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    return _count
+
+# 用本機 HTTP server 當第三方 API（LINE / SendGrid）替身：依序回傳 responses 內的狀態碼，記錄收到的請求
+class FakeHttpServer:
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+        self.client_ports = set()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                fake.requests.append({"path": self.path, "headers": dict(self.headers), "body": body})
+                fake.client_ports.add(self.client_address[1])
+                status, headers = fake.responses.pop(0) if fake.responses else (200, {})
+                payload = b'{}'
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+@pytest.fixture
+def fake_http():
+    fake = FakeHttpServer()
+    yield fake
+    fake.server.shutdown()
@@ -5,6 +5,7 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app import create_app
 from models import Product, db, Order, OrderItem,Category,User
+from service.copurchase_service import CopurchaseService
 from datetime import datetime
 import uuid
 import pytest
@@ -173,11 +174,139 @@ def test_cart_collaborative_recommend(client, user_token_and_id):
 
     client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 1},
                 headers={'Authorization': f'Bearer {token}'})
+    # 批次還沒跑過（新部署）：即時彙總訂單
+    from service.product_service import ProductService
+    assert [p.title for p in ProductService.recommend_for_cart_collaborative(user_id)] == [collab_title]
+
+    # 共同購買模型由離線批次產生
+    CopurchaseService.update(settle_seconds=0)
     res = client.get(f'/carts/{user_id}/recommend/collaborative', headers={'Authorization': f'Bearer {token}'})
     assert res.status_code == 200
     data = res.get_json()
     assert any(p['title'] == collab_title for p in data)
 
+#共同購買模型：增量更新（同一會員重複購買只算一次）與全部重算結果一致，推薦合併鄰居分數並排除下架商品
+def test_copurchase_incremental_matches_rebuild(client, user_token_and_id):
+    from models import ProductCopurchase, ProductNeighbor
+    token, user_id = user_token_and_id
+    p2, p3, p4, p5 = [Product(title=f'CoBuy{i}', price=100, category_id=1, images=[]) for i in range(2, 6)]
+    db.session.add_all([p2, p3, p4, p5])
+    buyers = [User(email=f'cobuy{i}@example.com', password='pw') for i in range(4)]
+    db.session.add_all(buyers)
+    db.session.commit()
+
+    def buy(user, *products):
+        order = Order(user_id=user.id)
+        db.session.add(order)
+        db.session.flush()
+        db.session.add_all([OrderItem(order_id=order.id, product_id=p.id, quantity=1, price=100) for p in products])
+        db.session.commit()
+
+    p1 = db.session.get(Product, 1)
+    buy(buyers[0], p1, p2, p3)
+    buy(buyers[1], p1, p2)
+    buy(buyers[2], p2, p4)
+    assert CopurchaseService.update(settle_seconds=0) == 7
+    buy(buyers[2], p1, p5)
+    buy(buyers[3], p3)
+    buy(buyers[0], p2)
+    assert CopurchaseService.update(settle_seconds=0) == 4
+    assert CopurchaseService.update(settle_seconds=0) == 0
+
+    def snapshot():
+        db.session.expire_all()
+        return (
+            {(r.product_id, r.other_product_id): r.users for r in ProductCopurchase.query.all()},
+            {(r.product_id, r.neighbor_id): r.score for r in ProductNeighbor.query.all()},
+        )
+
+    incremental = snapshot()
+    assert incremental[0][(1, p2.id)] == incremental[0][(p2.id, 1)] == 3
+    assert incremental[0][(1, p4.id)] == 1 and (p3.id, p4.id) not in incremental[0]
+    CopurchaseService.rebuild(settle_seconds=0)
+    assert snapshot() == incremental
+
+    p5.is_active = False
+    db.session.commit()
+    client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 1},
+                headers={'Authorization': f'Bearer {token}'})
+    res = client.get(f'/carts/{user_id}/recommend/collaborative?limit=5', headers={'Authorization': f'Bearer {token}'})
+    assert res.status_code == 200
+    assert [p['id'] for p in res.get_json()] == [p2.id, p4.id, p3.id]
+
+#推薦結果快取：第二次讀快取；購物車異動後回傳過期結果並排進重算，背景重算後才反映；下架商品讀取時就濾掉
+def test_recommendation_cache_refresh(client, app, user_token_and_id, monkeypatch):
+    from cache import get_stats
+    from service.product_service import ProductService
+    from service import recommendation_service
+    from service.recommendation_service import RecommendationService
+    token, user_id = user_token_and_id
+    headers = {'Authorization': f'Bearer {token}'}
+    p2, p3 = Product(title='Rec2', price=100, category_id=1, images=[]), Product(title='Rec3', price=100, category_id=1, images=[])
+    db.session.add_all([p2, p3])
+    db.session.commit()
+
+    def recommend():
+        res = client.get(f'/carts/{user_id}/recommend', headers=headers)
+        assert res.status_code == 200
+        return [p['id'] for p in res.get_json()]
+
+    client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 1}, headers=headers)
+    assert recommend() == [p3.id, p2.id]
+    assert recommend() == [p3.id, p2.id]
+    assert get_stats("recommend_cart") == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+    # 背景模式：不啟動 refresher 執行緒，改由測試呼叫 refresh_pending
+    app.config["RECOMMEND_REFRESH_ASYNC"] = True
+    monkeypatch.setattr(recommendation_service, "get_recommendation_refresher", lambda app: type("Idle", (), {"wake": lambda self: None})())
+    client.post(f'/carts/{user_id}', json={'product_id': p3.id, 'quantity': 1}, headers=headers)
+    assert recommend() == [p3.id, p2.id]
+    assert get_stats("recommend_cart", "stale")["stale"] == 1
+    assert RecommendationService.refresh_pending() == 1
+    assert recommend() == [p2.id]
+
+    ProductService.set_product_active_status(p2.id, False)
+    assert recommend() == []
+    assert RecommendationService.refresh_pending() == 1
+    assert recommend() == []
+    assert get_stats("recommend_cart", "stale") == {"hits": 5, "misses": 1, "hit_rate": 0.8333, "stale": 2}
+
+#購物車 snapshot：帶 If-None-Match 沒變就回 304（只查購物車版本）；購物車異動、特價、上下架後內容與 ETag 都要更新
+def test_cart_snapshot_etag(client, user_token_and_id, query_counter):
+    from datetime import timedelta
+    from service.product_service import ProductService
+    token, user_id = user_token_and_id
+    headers = {'Authorization': f'Bearer {token}'}
+    client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 1}, headers=headers)
+
+    res = client.get(f'/carts/{user_id}', headers=headers)
+    etag = res.headers['ETag']
+    assert res.status_code == 200 and res.get_json()['version'] == 1
+    with query_counter() as counter:
+        res = client.get(f'/carts/{user_id}', headers={**headers, 'If-None-Match': etag})
+    assert res.status_code == 304 and res.headers['ETag'] == etag
+    assert counter.count == 1
+
+    def changed():
+        nonlocal etag
+        res = client.get(f'/carts/{user_id}', headers={**headers, 'If-None-Match': etag})
+        assert res.status_code == 200 and res.headers['ETag'] != etag
+        etag = res.headers['ETag']
+        return res.get_json()
+
+    client.put(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 3}, headers=headers)
+    assert changed()['items'][0]['quantity'] == 3
+    now = datetime.now()
+    ProductService.add_product_onsale(1, 0.5, now - timedelta(days=1), now + timedelta(days=1), 'half')
+    assert changed()['items'][0]['price'] == 50
+    ProductService.set_product_active_status(1, False)
+    assert changed()['items'] == []
+    ProductService.set_product_active_status(1, True)
+    assert changed()['items'][0]['price'] == 50
+
+    guest_res = client.get('/carts/guest/snapshot-guest')
+    assert guest_res.status_code == 200 and guest_res.get_json() == {"cart": None, "items": []}
+
 def test_discount_code_checkout_flow(client, user_token_and_id, discount_code,shipping_info):
     token, user_id = user_token_and_id
 
@@ -528,3 +657,213 @@ def test_guest_cart_update_invalid_quantity(client, guest_id):
 def test_guest_cart_checkout_empty(client, guest_id):
     res = client.post(f'/carts/guest/{guest_id}/checkout', json={'items': []})
     assert res.status_code == 400
+
+#結帳 SQL 數量固定，不隨商品數增加
+def test_checkout_query_count_is_constant(client, user_token_and_id, shipping_info, query_counter):
+    token, user_id = user_token_and_id
+    headers = {'Authorization': f'Bearer {token}'}
+    for i in range(10):
+        db.session.add(Product(title=f'Bulk {i}', price=10 + i, category_id=1, images=[]))
+    db.session.commit()
+    product_ids = [p.id for p in Product.query.filter(Product.title.like('Bulk %')).order_by(Product.id)]
+
+    def checkout(ids):
+        for pid in ids:
+            client.post(f'/carts/{user_id}', json={'product_id': pid, 'quantity': 2}, headers=headers)
+        # 一半全部結帳（刪除購物車明細），一半只結帳部分數量
+        items = [{'product_id': pid, 'quantity': 2 if i % 2 == 0 else 1} for i, pid in enumerate(ids)]
+        with query_counter() as counter:
+            res = client.post(f'/carts/{user_id}/checkout', json={'items': items, 'shipping_info': shipping_info}, headers=headers)
+        assert res.status_code == 200
+        return counter.count, res.get_json()
+
+    few, _ = checkout(product_ids[:2])
+    many, data = checkout(product_ids[2:10])
+    assert few == many
+    order = db.session.get(Order, data['order_id'])
+    assert len(order.order_items) == 8
+    assert data['total'] == sum((10 + i) * (2 if (i - 2) % 2 == 0 else 1) for i in range(2, 10))
+    cart = client.get(f'/carts/{user_id}', headers=headers).get_json()
+    assert {item['product_id']: item['quantity'] for item in cart['items']} == {pid: 1 for pid in product_ids[1::2]}
+
+#結帳整個流程只 commit 一次；中途失敗不留下訂單，購物車不變
+def test_checkout_single_transaction(client, user_token_and_id, shipping_info, discount_code):
+    from sqlalchemy import event
+    from models import AuditLog, UserDiscountCode
+    token, user_id = user_token_and_id
+    headers = {'Authorization': f'Bearer {token}'}
+    client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 3}, headers=headers)
+    items = [{'product_id': 1, 'quantity': 2}]
+    logs_before = AuditLog.query.count()
+
+    # 寄送資訊缺欄位：訂單、明細已寫入後才失敗，必須整筆 rollback
+    res = client.post(f'/carts/{user_id}/checkout',
+                      json={'items': items, 'discount_code': discount_code.code,
+                            'shipping_info': {**shipping_info, 'store_name': None}},
+                      headers=headers)
+    assert res.status_code == 400
+    assert Order.query.count() == 0 and OrderItem.query.count() == 0
+    assert AuditLog.query.count() == logs_before
+    assert UserDiscountCode.query.count() == 0
+    assert client.get(f'/carts/{user_id}', headers=headers).get_json()['items'][0]['quantity'] == 3
+
+    commits = []
+    listener = lambda conn: commits.append(1)
+    event.listen(db.engine, 'commit', listener)
+    try:
+        res = client.post(f'/carts/{user_id}/checkout',
+                          json={'items': items, 'discount_code': discount_code.code, 'shipping_info': shipping_info},
+                          headers=headers)
+    finally:
+        event.remove(db.engine, 'commit', listener)
+    assert res.status_code == 200
+    assert len(commits) == 1
+    assert OrderItem.query.count() == 1
+    assert {log.action for log in AuditLog.query.all()} >= {'update_cart_item_on_checkout', 'add_order_items', 'use', 'checkout', 'set'}
+
+def test_cart_audit_log_async(app, client, user_token_and_id, shipping_info):
+    from models import AuditLog
+    from service.audit_service import AuditService
+    from service.audit_writer import AuditWriter, shutdown_audit_writer
+    import service.audit_writer as audit_writer
+    token, user_id = user_token_and_id
+    headers = {'Authorization': f'Bearer {token}'}
+    app.config['AUDIT_ASYNC'] = True
+    try:
+        # 加入購物車的日誌交給背景 writer，flush 後查得到
+        res = client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 3}, headers=headers)
+        assert res.status_code == 200
+        AuditService.flush()
+        assert AuditLog.query.filter_by(user_id=user_id, action='add', target_type='cart_item').count() == 1
+
+        # 結帳在 unit_of_work 內，日誌仍跟著交易同步寫入
+        res = client.post(f'/carts/{user_id}/checkout',
+                          json={'items': [{'product_id': 1, 'quantity': 1}], 'shipping_info': shipping_info},
+                          headers=headers)
+        assert res.status_code == 200
+        assert AuditLog.query.filter_by(action='checkout').count() == 1
+
+        # queue 滿了（背壓）：enqueue 失敗，改成同步寫入，不會丟日誌
+        shutdown_audit_writer()
+        full = AuditWriter(db.engine, max_queue=1, put_timeout=0)
+        full.enqueue({'action': 'placeholder'})
+        audit_writer._writer = full
+        client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 1}, headers=headers)
+        assert full.rejected == 1
+        assert AuditLog.query.filter_by(user_id=user_id, action='add', target_type='cart_item').count() == 2
+    finally:
+        app.config['AUDIT_ASYNC'] = False
+        audit_writer._writer = None
+
+def test_checkout_notifications_queued(app, client, user_token_and_id, shipping_info, monkeypatch):
+    from datetime import timedelta
+    from models import NotificationJob, NotificationDeadLetter
+    from service.notification_service import NotificationService
+    token, user_id = user_token_and_id
+    headers = {'Authorization': f'Bearer {token}'}
+    sent = []
+    monkeypatch.setattr('utils.notify_util.send_email_notify_order_created', lambda order: sent.append(order.id))
+
+    client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 3}, headers=headers)
+    res = client.post(f'/carts/{user_id}/checkout',
+                      json={'items': [{'product_id': 1, 'quantity': 1}], 'shipping_info': shipping_info},
+                      headers=headers)
+    assert res.status_code == 200
+    order_id = res.get_json()['order_id']
+    # 結帳只排工作，不在請求內寄送
+    assert sent == []
+    assert {job.kind for job in NotificationJob.query.all()} == {'order_created_email', 'order_created_line'}
+
+    assert NotificationService.run_pending() == 2
+    assert sent == [order_id]
+    assert NotificationJob.query.count() == 0
+
+    # 寄送失敗：延後重試，超過次數搬到 dead letter
+    def fail(order):
+        raise RuntimeError('sendgrid down')
+    monkeypatch.setattr('utils.notify_util.send_email_notify_order_created', fail)
+    app.config['NOTIFY_MAX_ATTEMPTS'] = 2
+    client.post(f'/carts/{user_id}/checkout',
+                json={'items': [{'product_id': 1, 'quantity': 1}], 'shipping_info': shipping_info},
+                headers=headers)
+    NotificationService.run_pending()
+    job = NotificationJob.query.filter_by(kind='order_created_email').one()
+    assert job.status == 'pending' and job.attempts == 1 and 'sendgrid down' in job.last_error
+    assert NotificationService.run_pending() == 0  # 還沒到重試時間
+
+    job.run_at = job.run_at - timedelta(hours=2)
+    db.session.commit()
+    assert NotificationService.run_pending() == 1
+    assert NotificationJob.query.count() == 0
+    letter = NotificationDeadLetter.query.one()
+    assert letter.kind == 'order_created_email' and letter.attempts == 2
+
+def test_checkout_notifications_memory_backend(app, client, user_token_and_id, shipping_info, monkeypatch):
+    from models import NotificationJob
+    from service.notification_service import get_memory_broker
+    token, user_id = user_token_and_id
+    headers = {'Authorization': f'Bearer {token}'}
+    sent = []
+    monkeypatch.setattr('utils.notify_util.send_email_notify_order_created', lambda order: sent.append(order.id))
+    app.config['NOTIFY_BACKEND'] = 'memory'
+
+    client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 3}, headers=headers)
+    # 結帳失敗（rollback）不會送出通知
+    client.post(f'/carts/{user_id}/checkout',
+                json={'items': [{'product_id': 1, 'quantity': 1}], 'shipping_info': {**shipping_info, 'store_name': None}},
+                headers=headers)
+    res = client.post(f'/carts/{user_id}/checkout',
+                      json={'items': [{'product_id': 1, 'quantity': 1}], 'shipping_info': shipping_info},
+                      headers=headers)
+    assert res.status_code == 200
+    assert get_memory_broker(app).join()
+    assert sent == [res.get_json()['order_id']]
+    assert NotificationJob.query.count() == 0
+
+#折扣碼搶購：數百個結帳同時搶有限次數的折扣碼，成功次數不能超過上限（總次數、每人次數）
+def test_discount_code_redemption_under_concurrency(app):
+    from concurrent.futures import ThreadPoolExecutor
+    from models import DiscountCode, UserDiscountCode, Cart, CartItem
+    from service.cart_service import CartService
+    period = dict(valid_from=datetime(2000, 1, 1), valid_to=datetime(2099, 12, 31), is_active=True)
+    flash = DiscountCode(code='FLASH', discount=0.9, usage_limit=50, **period)
+    once = DiscountCode(code='ONCE', amount=10, per_user_limit=1, **period)
+    db.session.add_all([flash, once])
+    guests = [f'rush-{i}' for i in range(300)]
+    carts = [Cart(guest_id=g, created_at=datetime.now(), status='active') for g in guests + ['rush-solo']]
+    db.session.add_all(carts)
+    db.session.flush()
+    db.session.add_all([CartItem(cart_id=c.id, product_id=1, quantity=1) for c in carts[:-1]])
+    db.session.add(CartItem(cart_id=carts[-1].id, product_id=1, quantity=30))
+    db.session.commit()
+
+    # 另開一個連線池夠大的 app，讓結帳真的同時進資料庫
+    rush_app = create_app(config_name="testing", test_config={
+        'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'],
+        'SQLALCHEMY_ENGINE_OPTIONS': {'pool_size': 32, 'max_overflow': 0},
+    })
+
+    def checkout(guest_id, code):
+        with rush_app.app_context():
+            try:
+                CartService.checkout_cart([{"product_id": 1, "quantity": 1}], guest_id=guest_id, discount_code=code)
+                return "ok"
+            except ValueError as e:
+                return str(e)
+            finally:
+                db.session.remove()
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        rush = list(pool.map(checkout, guests, ['FLASH'] * len(guests)))
+        solo = list(pool.map(checkout, ['rush-solo'] * 20, ['ONCE'] * 20))
+    with rush_app.app_context():
+        db.engine.dispose()
+
+    assert rush.count("ok") == 50
+    assert all("總使用上限" in r for r in rush if r != "ok")
+    assert solo.count("ok") == 1
+    assert all("可用次數上限" in r for r in solo if r != "ok")
+    db.session.expire_all()
+    assert db.session.get(DiscountCode, flash.id).used_count == 50
+    assert Order.query.filter_by(discount_code_id=flash.id).count() == 50
+    assert [u.used_count for u in UserDiscountCode.query.filter_by(discount_code_id=once.id)] == [1]
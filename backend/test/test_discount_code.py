@@ -155,3 +155,288 @@ def test_post_discount_code_invalid_data(client, admin_token):
     body["valid_from"] = "bad-date"
     res = client.post('/discount_codes/', json=body, headers={'Authorization': f'Bearer {admin_token}'})
     assert res.status_code == 400
+
+def _legacy_apply_discount_code(user_id=None, guest_id=None, cart=None, code=None, items_to_checkout=None):
+    """
+    改成 DiscountEngine 之前的 DiscountService.apply_discount_code（逐一試算，原樣保留），只給測試當對照組
+    :return: (success, message, discount_code物件, 折扣後金額, 折扣金額, 規則說明, used_coupon)
+    """
+    from datetime import datetime
+    from models import DiscountCode, UserDiscountCode, Product
+
+    dc = DiscountCode.query.filter_by(code=code, is_active=True).first()
+    if not dc:
+        return False, "折扣碼不存在或已停用", None, None, None, "", False
+
+    now = datetime.now()
+    if dc.valid_from > now or dc.valid_to < now:
+        return False, "折扣碼不在有效期限", None, None, None, "", False
+
+    user_dc = None
+    if user_id:
+        user_dc = UserDiscountCode.query.filter_by(user_id=user_id, discount_code_id=dc.id).first()
+    elif guest_id:
+        user_dc = UserDiscountCode.query.filter_by(guest_id=guest_id, discount_code_id=dc.id).first()
+    user_usage = user_dc.used_count if user_dc else 0
+
+    def build_items():
+        cart_items_dict = {}
+        for ci in cart.cart_items:
+            cart_items_dict[ci.product_id] = ci
+
+        result = []
+        if not items_to_checkout:
+            return list(cart.cart_items)
+        for checkout_item in items_to_checkout:
+            ci = cart_items_dict.get(checkout_item["product_id"])
+            if ci:
+                temp_item = type('obj', (), {})()
+                temp_item.product = ci.product
+                temp_item.quantity = checkout_item.get("quantity", ci.quantity)
+                temp_item.product_id = ci.product_id
+                result.append(temp_item)
+        return result
+
+    items = build_items()
+    if not items:
+        return False, "沒有任何商品可計算折扣", None, None, None, "", False
+
+    specified_product = Product.get_by_product_id(dc.product_id) if dc.product_id else None
+    rule_msg = ""
+    used_coupon = False
+
+    if dc.product_id:
+        target_item = next((item for item in items if item.product_id == dc.product_id), None)
+        if not target_item:
+            return False, f"此折扣碼僅適用{specified_product.title}", None, None, None, "", False
+
+        original_price = float(target_item.product.price)
+        sale_price = float(target_item.product.get_final_price())
+
+        if dc.discount:
+            coupon_price = original_price * dc.discount
+        elif dc.amount:
+            coupon_price = max(original_price - dc.amount, 0)
+        else:
+            coupon_price = original_price
+
+        lowest_unit_price = min(sale_price, coupon_price)
+
+        if lowest_unit_price == sale_price and sale_price < coupon_price:
+            rule_msg = f"商品專屬折扣碼，特價與折扣碼不可疊加，商品{specified_product.title}特價比折扣碼更優惠，因此折扣碼未被消耗"
+            used_coupon = False
+        elif lowest_unit_price == coupon_price and coupon_price < sale_price:
+            rule_msg = f"本次已套用折扣碼優惠（此為商品{specified_product.title}專屬折扣碼）"
+            used_coupon = True
+        else:
+            rule_msg = f"此為商品{specified_product.title}專屬折扣碼，僅適用指定商品"
+            used_coupon = False
+
+        discounted_total = 0
+        discount_amount = 0
+        for item in items:
+            if item.product_id == dc.product_id:
+                discounted_total += round(lowest_unit_price * item.quantity, 2)
+                discount_amount += round((original_price - lowest_unit_price) * item.quantity, 2)
+            else:
+                discounted_total += round(float(item.product.get_final_price()) * item.quantity, 2)
+    else:
+        rule_msg = "此為全站折扣碼，對所有商品加總後再進行折扣"
+        subtotal = sum(float(item.product.get_final_price()) * item.quantity for item in items)
+        if dc.discount:
+            discount_amount = round(subtotal * (1 - dc.discount), 2)
+            discounted_total = round(subtotal * dc.discount, 2)
+        elif dc.amount:
+            discount_amount = min(subtotal, dc.amount)
+            discounted_total = max(subtotal - dc.amount, 0)
+        else:
+            discounted_total = subtotal
+            discount_amount = 0
+        used_coupon = True
+
+    if dc.min_spend and discounted_total < dc.min_spend:
+        return False, f"未達最低消費金額 {dc.min_spend}", None, None, None, rule_msg, used_coupon
+    if dc.usage_limit and dc.used_count >= dc.usage_limit:
+        return False, "折扣碼已達總使用上限", None, None, None, rule_msg, used_coupon
+    if dc.per_user_limit and user_usage >= dc.per_user_limit:
+        return False, "您已達本折扣碼可用次數上限", None, None, None, rule_msg, used_coupon
+
+    return True, "折扣碼可用", dc, discounted_total, discount_amount, rule_msg, used_coupon
+
+#批次試算：一次試算多個折扣碼，結果（七個欄位）跟改寫前逐一試算的版本相同，並挑出折扣後金額最低的
+def test_evaluate_many_discount_codes(app):
+    from datetime import datetime, timedelta
+    from models import db, Category, Product, ProductOnSale, DiscountCode, UserDiscountCode, Cart, CartItem
+    from service.discount_service import DiscountService
+    from service.discount_engine import DiscountEngine
+    now = datetime.now()
+    db.session.add(Category(id=1, name='cat1'))
+    a, b = Product(title='A', price=100, category_id=1, images=[]), Product(title='B', price=250, category_id=1, images=[])
+    db.session.add_all([a, b])
+    db.session.flush()
+    db.session.add(ProductOnSale(product_id=a.id, discount=0.8, start_date=now - timedelta(days=1), end_date=now + timedelta(days=1)))
+    period = dict(valid_from=now - timedelta(days=1), valid_to=now + timedelta(days=1), is_active=True)
+    db.session.add_all([
+        DiscountCode(code='SITE10', discount=0.9, **period),
+        DiscountCode(code='OFF50', amount=50, **period),
+        DiscountCode(code='A_HALF', product_id=a.id, discount=0.5, **period),
+        DiscountCode(code='A_OFF5', product_id=a.id, amount=5, **period),
+        DiscountCode(code='BIG_SPEND', discount=0.5, min_spend=1000, **period),
+        # 邊界：折抵金額大於售價（折到 0 元）、每人次數已用完、不在有效期限
+        DiscountCode(code='OFF999', amount=999, **period),
+        DiscountCode(code='A_OFF500', product_id=a.id, amount=500, **period),
+        DiscountCode(code='ONCE', discount=0.9, per_user_limit=1, **period),
+        DiscountCode(code='EXPIRED', discount=0.5, valid_from=now - timedelta(days=10), valid_to=now - timedelta(days=1)),
+    ])
+    cart = Cart(guest_id='guest-dc', created_at=now, status='active')
+    db.session.add(cart)
+    db.session.flush()
+    db.session.add_all([CartItem(cart_id=cart.id, product_id=a.id, quantity=2), CartItem(cart_id=cart.id, product_id=b.id, quantity=1)])
+    db.session.add(UserDiscountCode(guest_id='guest-dc', discount_code_id=DiscountCode.query.filter_by(code='ONCE').one().id, used_count=1))
+    db.session.commit()
+
+    codes = ['SITE10', 'OFF50', 'A_HALF', 'A_OFF5', 'BIG_SPEND', 'NOPE']
+    edge_codes = ['OFF999', 'A_OFF500', 'ONCE', 'EXPIRED']
+    results = DiscountEngine.evaluate(codes + edge_codes, cart, guest_id='guest-dc')
+    for code in codes + edge_codes:
+        expected = _legacy_apply_discount_code(guest_id='guest-dc', cart=cart, code=code)
+        assert results[code] == expected, code
+        assert DiscountService.apply_discount_code(guest_id='guest-dc', cart=cart, code=code) == expected, code
+    assert results['SITE10'][3:5] == (369.0, 41.0)
+    assert results['OFF50'][3:5] == (360.0, 50)
+    assert results['A_HALF'][3:] == (350.0, 100.0, "本次已套用折扣碼優惠（此為商品A專屬折扣碼）", True)
+    assert results['A_OFF5'][3:5] == (410.0, 40.0) and results['A_OFF5'][6] is False
+    assert results['BIG_SPEND'][:2] == (False, "未達最低消費金額 1000.0")
+    assert results['NOPE'][:2] == (False, "折扣碼不存在或已停用")
+    # A 特價 80 比折扣碼後 95 便宜：用特價，折扣碼不消耗
+    assert results['A_OFF5'][5] == "商品專屬折扣碼，特價與折扣碼不可疊加，商品A特價比折扣碼更優惠，因此折扣碼未被消耗"
+    assert results['OFF999'][3:] == (0, 410.0, "此為全站折扣碼，對所有商品加總後再進行折扣", True)
+    assert results['A_OFF500'][3:5] == (250.0, 200.0) and results['A_OFF500'][6] is True
+    assert results['ONCE'] == (False, "您已達本折扣碼可用次數上限", None, None, None, "此為全站折扣碼，對所有商品加總後再進行折扣", True)
+    assert results['EXPIRED'] == (False, "折扣碼不在有效期限", None, None, None, "", False)
+
+    code, best = DiscountService.pick_best_discount_code(codes, guest_id='guest-dc', cart=cart)
+    assert code == 'A_HALF' and best == results['A_HALF']
+    # 只結帳 B：A 的專屬折扣碼不適用
+    code, best = DiscountService.pick_best_discount_code(
+        codes, guest_id='guest-dc', cart=cart, items_to_checkout=[{"product_id": b.id, "quantity": 1}]
+    )
+    assert code == 'OFF50' and best[3] == 200.0
+    assert DiscountService.pick_best_discount_code(['NOPE', 'BIG_SPEND'], guest_id='guest-dc', cart=cart) == (None, None)
+
+#隨機（固定 seed）的商品、特價、折扣碼、購物車、使用紀錄：每一組購物車 × 折扣碼的七個欄位都跟改寫前的版本相同
+def test_discount_engine_matches_legacy_randomized(app):
+    import random
+    from datetime import datetime, timedelta
+    from models import db, Category, User, Product, ProductOnSale, DiscountCode, UserDiscountCode, Cart, CartItem
+    from service.discount_service import DiscountService
+    from service.discount_engine import DiscountEngine
+    rng = random.Random(20240601)
+    now = datetime.now()
+    day = timedelta(days=1)
+    db.session.add(Category(id=1, name='cat1'))
+    products = [
+        Product(title=f'P{i}', price=round(rng.uniform(5, 500), rng.choice([0, 2])), category_id=1, images=[])
+        for i in range(8)
+    ]
+    users = [User(email=f'legacy{i}@example.com', password='x') for i in range(3)]
+    db.session.add_all(products + users)
+    db.session.flush()
+    for product in products:
+        # 每個商品最多一筆進行中的特價，另外可能有過期 / 未開始的
+        windows = [(now - 3 * day, now - day), (now + day, now + 3 * day)]
+        if rng.random() < 0.6:
+            windows.append((now - day, now + day))
+        for start, end in rng.sample(windows, rng.randint(0, len(windows))):
+            db.session.add(ProductOnSale(product_id=product.id, discount=rng.choice([0.5, 0.7, 0.85, 0.95]), start_date=start, end_date=end))
+
+    codes = []
+    for i in range(30):
+        target = rng.choice([None] + products)
+        if rng.random() < 0.5:
+            rate = dict(discount=rng.choice([0.5, 0.75, 0.8, 0.88, 0.9, 0.95]))
+        else:
+            rate = dict(amount=rng.choice([1, 5, 33.3, 50, 120, 999]))  # 包含大於售價（折到 0）的金額
+        valid_from, valid_to = rng.choice([(now - day, now + day)] * 8 + [(now - 3 * day, now - day), (now + day, now + 3 * day)])
+        usage_limit = rng.choice([None, None, 3])
+        code = DiscountCode(
+            code=f'R{i}', product_id=target.id if target else None, valid_from=valid_from, valid_to=valid_to,
+            min_spend=rng.choice([None, None, 0, 100, 800]), usage_limit=usage_limit,
+            used_count=rng.randint(0, 4) if usage_limit else 0, per_user_limit=rng.choice([None, None, 1, 2]),
+            is_active=rng.random() > 0.1, **rate
+        )
+        codes.append(code)
+    db.session.add_all(codes)
+    db.session.flush()
+
+    carts = []
+    for i in range(24):
+        # 會員只會有一台 active 購物車，其他的放 checked_out（試算不看購物車狀態）
+        owner = dict(user_id=users[i % 3].id) if i % 2 else dict(guest_id=f'legacy-guest-{i % 5}')
+        cart = Cart(created_at=now, status='active' if i < 6 else 'checked_out', **owner)
+        db.session.add(cart)
+        db.session.flush()
+        for product in rng.sample(products, rng.randint(1, 5)):
+            db.session.add(CartItem(cart_id=cart.id, product_id=product.id, quantity=rng.randint(1, 5)))
+        carts.append((cart, owner))
+    for code in codes:
+        for owner in [dict(user_id=u.id) for u in users] + [dict(guest_id=f'legacy-guest-{i}') for i in range(5)]:
+            if rng.random() < 0.3:
+                db.session.add(UserDiscountCode(discount_code_id=code.id, used_count=rng.randint(1, 2), **owner))
+    db.session.commit()
+
+    names = [code.code for code in codes] + ['MISSING']
+    compared = 0
+    for cart, owner in carts:
+        # 整台結帳、只結帳部分商品（可能改數量）、或只選了不在購物車內的商品
+        cart_product_ids = [ci.product_id for ci in cart.cart_items]
+        checkout_options = [None, [
+            {"product_id": pid, "quantity": rng.randint(1, 3)} if rng.random() < 0.5 else {"product_id": pid}
+            for pid in rng.sample(cart_product_ids, rng.randint(1, len(cart_product_ids)))
+        ]]
+        missing = [p.id for p in products if p.id not in cart_product_ids]
+        if missing:
+            checkout_options.append([{"product_id": missing[0], "quantity": 1}])
+        for items_to_checkout in checkout_options:
+            batch = DiscountEngine.evaluate(names, cart, items_to_checkout=items_to_checkout, **owner)
+            for name in names:
+                expected = _legacy_apply_discount_code(cart=cart, code=name, items_to_checkout=items_to_checkout, **owner)
+                assert batch[name] == expected, (name, owner, items_to_checkout)
+                assert DiscountService.apply_discount_code(
+                    cart=cart, code=name, items_to_checkout=items_to_checkout, **owner
+                ) == expected, (name, owner, items_to_checkout)
+                compared += 1
+    assert compared > 1500
+
+#折扣碼定義快取：查不到的 code 第二次起不查資料庫；新增、停用折扣碼時清除快取
+def test_discount_code_cache(app, query_counter):
+    from datetime import datetime, timedelta
+    from models import db, Category, Product, Cart, CartItem
+    from service.discount_service import DiscountService
+    from service.discount_code_cache import get_discount_code_cache
+    db.session.add(Category(id=1, name='cat1'))
+    product = Product(title='A', price=100, category_id=1, images=[])
+    db.session.add(product)
+    db.session.flush()
+    cart = Cart(guest_id='guest-cache', created_at=datetime.now(), status='active')
+    db.session.add(cart)
+    db.session.flush()
+    db.session.add(CartItem(cart_id=cart.id, product_id=product.id, quantity=1))
+    db.session.commit()
+
+    def apply(code):
+        return DiscountService.apply_discount_code(guest_id='guest-cache', cart=cart, code=code)
+
+    assert apply('GUESS')[1] == "折扣碼不存在或已停用"
+    with query_counter() as counter:
+        assert apply('GUESS')[1] == "折扣碼不存在或已停用"
+    assert counter.count == 0
+
+    now = datetime.now()
+    dc = DiscountService.create_discount_code('GUESS', discount=0.5, valid_from=now - timedelta(days=1), valid_to=now + timedelta(days=1))
+    assert apply('GUESS')[:2] == (True, "折扣碼可用")
+    assert apply('GUESS')[3] == 50.0
+    assert get_discount_code_cache().stats()["hits"] == 2
+
+    DiscountService.deactivate_discount_code(dc)
+    assert apply('GUESS')[1] == "折扣碼不存在或已停用"
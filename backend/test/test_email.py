@@ -0,0 +1,60 @@
+import pytest
+import sys
+import os
+from datetime import datetime
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models import db, Category, Product, EmailOutbox
+from service.email_service import EmailService
+from utils.send_email import send_email_batch, render_email
+
+SALE = {"discount": 0.5, "start_date": datetime(2024, 1, 1), "end_date": datetime(2024, 1, 31), "description": "週年慶"}
+
+@pytest.fixture
+def sendgrid(app, fake_http):
+    app.config['SENDGRID_API_BASE_URL'] = fake_http.url
+    app.config['SENDGRID_API_KEY'] = 'sg-key'
+    app.config['LINEBOT_ADMIN_EMAIL'] = 'shop@example.com'
+    return fake_http
+
+@pytest.fixture
+def product(app):
+    db.session.add(Category(id=1, name='cat1', description='for test'))
+    product = Product(title='<Mug> & Cup', price=200, category_id=1, images=[])
+    db.session.add(product)
+    db.session.commit()
+    return product
+
+def test_render_email_template(product):
+    subject, html = render_email('product_on_sale', product=product, **SALE)
+    assert subject == '您在Raw type購物車內的「<Mug> & Cup」開始特價囉！'
+    assert '&lt;Mug&gt; &amp; Cup' in html and '100.00' in html and '2024/01/01 ~ 2024/01/31' in html
+
+def test_send_email_batch_uses_personalizations(sendgrid):
+    send_email_batch(['a@example.com', 'b@example.com'], 'Hi', '<b>hello</b>')
+    send_email_batch(['c@example.com'], 'Hi', '<b>hello</b>')
+    assert len(sendgrid.requests) == 2
+    assert len(sendgrid.client_ports) == 1  # 同一條 keep-alive 連線
+    req = sendgrid.requests[0]
+    assert req['path'] == '/v3/mail/send'
+    assert req['headers']['Authorization'] == 'Bearer sg-key'
+    assert req['body']['from'] == {'email': 'shop@example.com'}
+    assert sorted(p['to'][0]['email'] for p in req['body']['personalizations']) == ['a@example.com', 'b@example.com']
+
+def test_email_outbox_dedupe_and_retry(sendgrid, product):
+    recipients = [('sale:1:a', 'a@example.com'), ('sale:1:b', 'b@example.com')]
+    assert EmailService.send_batch('product_on_sale', recipients, product=product, **SALE) == 2
+    assert len(sendgrid.requests) == 1  # 內容相同，合併成一次請求
+    # 同一批重跑（例如 worker 重試）不會重寄
+    assert EmailService.send_batch('product_on_sale', recipients, product=product, **SALE) == 0
+    assert len(sendgrid.requests) == 1
+    assert EmailOutbox.query.filter_by(status='sent').count() == 2
+
+    # 寄送失敗：記下錯誤並丟出例外，下次呼叫同一個 key 再寄
+    sendgrid.responses = [(400, {})]
+    with pytest.raises(Exception):
+        EmailService.send('sale:1:c', 'c@example.com', 'product_on_sale', product=product, **SALE)
+    row = EmailOutbox.query.filter_by(dedupe_key='sale:1:c').one()
+    assert row.status == 'failed' and row.attempts == 1 and '400' in row.last_error
+    assert EmailService.send('sale:1:c', 'c@example.com', 'product_on_sale', product=product, **SALE) == 1
+    db.session.refresh(row)
+    assert row.status == 'sent' and row.attempts == 2 and row.sent_at is not None
@@ -0,0 +1,59 @@
+import pytest
+import sys
+import os
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.line_client import LineClient, LineApiError
+from utils.http_client import TokenBucket
+
+def test_line_client_push_reuses_connection(fake_http):
+    client = LineClient('token', base_url=fake_http.url, rate_limit=None)
+    for i in range(5):
+        client.push(f'U{i}', {'type': 'text', 'text': 'hi'})
+    assert len(fake_http.requests) == 5
+    assert len(fake_http.client_ports) == 1  # 同一條 keep-alive 連線
+    req = fake_http.requests[0]
+    assert req['path'] == '/v2/bot/message/push'
+    assert req['headers']['Authorization'] == 'Bearer token'
+    assert req['body'] == {'to': 'U0', 'messages': [{'type': 'text', 'text': 'hi'}]}
+    assert client.stats()['requests'] == 5 and client.stats()['failures'] == 0
+
+def test_line_client_retries_429_and_5xx(fake_http):
+    client = LineClient('token', base_url=fake_http.url, rate_limit=None, backoff=0.01)
+    fake_http.responses = [(429, {'Retry-After': '0'}), (503, {}), (200, {})]
+    client.multicast(['U1', 'U2'], {'type': 'text', 'text': 'sale'})
+    assert len(fake_http.requests) == 3
+    # 重試共用同一個 retry key，LINE 端不會重複送出
+    keys = {req['headers']['X-Line-Retry-Key'] for req in fake_http.requests}
+    assert len(keys) == 1
+    stats = client.stats()
+    assert stats['retries'] == 2 and stats['failures'] == 2
+
+    # 4xx（不是 429）不重試；重試次數用完就丟例外
+    fake_http.requests.clear()
+    fake_http.responses = [(400, {})]
+    with pytest.raises(LineApiError) as exc:
+        client.push('U1', {'type': 'text', 'text': 'x'})
+    assert exc.value.status_code == 400 and len(fake_http.requests) == 1
+    fake_http.responses = [(500, {})] * 4
+    with pytest.raises(LineApiError):
+        client.push('U1', {'type': 'text', 'text': 'x'})
+    assert len(fake_http.requests) == 1 + 4
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, burst=5)
+    start = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    # 前 5 個不用等，之後每秒 50 個：剩下 10 個至少要 0.2 秒
+    assert time.monotonic() - start >= 0.18
+
+def test_push_message_uses_configured_base_url(app, fake_http):
+    from utils.line_bot import push_message
+    app.config['LINE_API_BASE_URL'] = fake_http.url
+    app.config['LINE_CHANNEL_ACCESS_TOKEN'] = 'app-token'
+    assert push_message('U1', 'hello') is True
+    fake_http.responses = [(400, {})]
+    assert push_message('U1', 'hello') is False
+    assert fake_http.requests[0]['headers']['Authorization'] == 'Bearer app-token'
+    assert fake_http.requests[0]['body']['messages'] == [{'type': 'text', 'text': 'hello'}]
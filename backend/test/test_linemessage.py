@@ -0,0 +1,95 @@
+import pytest
+import sys
+import os
+import json
+import base64
+import hashlib
+import hmac
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models import db, User
+from service.line_event_service import get_line_dispatcher
+
+SECRET = 'line-secret'
+
+@pytest.fixture
+def line_api(app, fake_http):
+    app.config['LINE_CHANNEL_SECRET'] = SECRET
+    app.config['LINE_CHANNEL_ACCESS_TOKEN'] = 'line-token'
+    app.config['LINE_API_BASE_URL'] = fake_http.url
+    return fake_http
+
+def post_events(client, events, secret=SECRET):
+    body = json.dumps({'events': events}).encode('utf-8')
+    signature = base64.b64encode(hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()).decode('utf-8')
+    return client.post('/linemessage/webhook', data=body, content_type='application/json',
+                       headers={'X-Line-Signature': signature})
+
+def text_event(user_id, text, reply_token, event_id=None):
+    return {'type': 'message', 'replyToken': reply_token, 'webhookEventId': event_id or reply_token,
+            'source': {'type': 'user', 'userId': user_id}, 'message': {'type': 'text', 'text': text}}
+
+def test_webhook_rejects_invalid_signature(client, line_api):
+    res = post_events(client, [text_event('U1', 'hi', 'r1')], secret='wrong')
+    assert res.status_code == 400
+    assert line_api.requests == []
+
+def test_webhook_replies_in_background(app, client, line_api):
+    db.session.add(User(email='line@example.com', password='x', line_user_id='Ubound'))
+    db.session.commit()
+    events = [text_event('Ubound', '聯絡客服', 'r1'), text_event('Ubound', 'hi', 'r2'),
+              text_event('Ustranger', 'hi', 'r3')]
+    res = post_events(client, events)
+    assert res.status_code == 200
+    get_line_dispatcher(app).join()
+
+    replies = [req for req in line_api.requests if req['path'] == '/v2/bot/message/reply']
+    assert len(replies) == 3 and len(line_api.requests) == 3  # 全部用免費的 reply，不用 push
+    by_token = {req['body']['replyToken']: req['body']['messages'][0]['text'] for req in replies}
+    assert '聯絡客服資訊' in by_token['r1'] and by_token['r2'] == '你好'
+    assert by_token['r3'] == '請先到會員中心綁定 LINE 帳號'
+    # 同一個用戶依序處理
+    tokens = [req['body']['replyToken'] for req in replies if req['body']['replyToken'] in ('r1', 'r2')]
+    assert tokens == ['r1', 'r2']
+
+    # LINE 重送同一個事件：不重複處理
+    post_events(client, [events[0]])
+    get_line_dispatcher(app).join()
+    assert len(line_api.requests) == 3
+
+def test_webhook_falls_back_to_push(app, client, line_api):
+    line_api.responses = [(400, {})]  # reply token 過期
+    post_events(client, [text_event('Ustranger', 'hi', 'expired')])
+    get_line_dispatcher(app).join()
+    assert [req['path'] for req in line_api.requests] == ['/v2/bot/message/reply', '/v2/bot/message/push']
+    assert line_api.requests[1]['body']['to'] == 'Ustranger'
+
+def test_line_user_resolver_cache_and_bind_invalidation(app, client, monkeypatch, query_counter):
+    from service.line_user_resolver import get_line_user_resolver
+    user = User(email='bind@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    resolver = get_line_user_resolver()
+    assert resolver.resolve('Unew') is None
+    with query_counter() as counter:
+        assert resolver.resolve('Unew') is None  # 沒綁定也快取，不再查 users
+    assert counter.count == 0
+
+    # 綁定 callback：換 token、拿 profile 後寫入 line_user_id，並讓快取失效
+    class FakeResponse:
+        def __init__(self, data):
+            self.data = data
+        def json(self):
+            return self.data
+    monkeypatch.setattr('api.linemessage.requests.post', lambda *a, **k: FakeResponse({'access_token': 'tok'}))
+    monkeypatch.setattr('api.linemessage.requests.get', lambda *a, **k: FakeResponse({'userId': 'Unew', 'displayName': 'New'}))
+    res = client.get(f'/linemessage/blinding?code=abc&state={user.id}')
+    assert res.status_code == 200
+    assert resolver.resolve('Unew') == (user.id, 'user')
+    assert User.get_by_line_user_id('Unew').id == user.id
+
+def test_line_user_id_lookup_uses_index(app):
+    from sqlalchemy import text
+    db.session.execute(text('SET LOCAL enable_seqscan = off'))
+    plan = '\n'.join(row[0] for row in db.session.execute(
+        text("EXPLAIN SELECT id, role FROM users WHERE line_user_id = 'U1'")))
+    assert 'ix_users_line_user_id' in plan
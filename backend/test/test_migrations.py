@@ -0,0 +1,106 @@
+import pytest
+import sys
+import os
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models import db
+from migrations import SchemaVersionError, check_schema_version, latest_version, offline_sql, upgrade
+
+SCHEMA = "migration_test"
+
+@pytest.fixture
+def migration_engine(app):
+    """search_path 指到空的 schema：migration 在裡面從頭建表，不影響其他測試用的 public"""
+    db.session.remove()  # CONCURRENTLY 建索引要等所有進行中的交易結束
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        connection.exec_driver_sql(f"CREATE SCHEMA {SCHEMA}")
+    engine = create_engine(
+        app.config["SQLALCHEMY_DATABASE_URI"], connect_args={"options": f"-csearch_path={SCHEMA},public"}
+    )
+    yield engine
+    engine.dispose()
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+
+#從空資料庫升級：建出來的表、欄位、索引要跟 models 一致，再跑一次不做任何事
+def test_upgrade_builds_models_schema(migration_engine):
+    with pytest.raises(SchemaVersionError):
+        check_schema_version(migration_engine)
+    assert upgrade(migration_engine, log=lambda *a: None) == list(range(1, latest_version() + 1))
+    assert upgrade(migration_engine, log=lambda *a: None) == []
+    assert check_schema_version(migration_engine) == latest_version()
+
+    inspector = inspect(migration_engine)
+    for table in db.metadata.sorted_tables:
+        columns = {c["name"]: c["nullable"] for c in inspector.get_columns(table.name, schema=SCHEMA)}
+        assert columns == {c.name: c.nullable for c in table.columns}, table.name
+        indexes = {i["name"] for i in inspector.get_indexes(table.name, schema=SCHEMA)}
+        assert {i.name for i in table.indexes} <= indexes, table.name
+    with migration_engine.connect() as connection:
+        invalid = connection.exec_driver_sql(
+            "SELECT count(*) FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            f"WHERE c.relnamespace = '{SCHEMA}'::regnamespace AND NOT i.indisvalid"
+        ).scalar()
+    assert invalid == 0
+
+#舊資料庫升級：重複的折扣碼使用紀錄合併、多台 active 購物車只留最新的，之前建失敗（INVALID）的索引會重建，熱賣排行依既有訂單回填
+def test_upgrade_existing_database(migration_engine):
+    upgrade(migration_engine, target=3, log=lambda *a: None)
+    with migration_engine.begin() as connection:
+        connection.exec_driver_sql("""
+            INSERT INTO users (id, email, password) VALUES (1, 'legacy@example.com', 'x');
+            INSERT INTO discount_codes (id, code, valid_from, valid_to) VALUES (1, 'OLD', now(), now());
+            INSERT INTO user_discount_codes (user_id, discount_code_id, used_count, last_used_at) VALUES
+                (1, 1, 1, '2024-01-01'), (1, 1, 2, '2024-02-01');
+            INSERT INTO carts (id, guest_id, created_at, status) VALUES
+                (1, 'legacy-guest', '2024-01-01', 'active'), (2, 'legacy-guest', '2024-02-01', 'active');
+            INSERT INTO products (id, title, price) VALUES (1, 'Old Shirt', 100), (2, 'Old Hat', 50);
+            INSERT INTO orders (id, order_date, status) VALUES (1, now(), 'paid'), (2, now() - interval '60 days', 'paid');
+            INSERT INTO order_items (order_id, product_id, quantity, price) VALUES
+                (1, 1, 2, 100), (1, 2, 1, 50), (2, 1, 3, 100);
+        """)
+    with migration_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        with pytest.raises(IntegrityError):
+            connection.exec_driver_sql(
+                "CREATE UNIQUE INDEX CONCURRENTLY uq_carts_active_guest ON carts (guest_id) "
+                "WHERE status = 'active' AND guest_id IS NOT NULL"
+            )
+
+    assert upgrade(migration_engine, log=lambda *a: None) == [4, 5]
+    with migration_engine.connect() as connection:
+        usage = connection.exec_driver_sql(
+            "SELECT used_count, last_used_at::date::text FROM user_discount_codes"
+        ).all()
+        carts = connection.exec_driver_sql("SELECT id, status FROM carts ORDER BY id").all()
+        stats = connection.exec_driver_sql(
+            "SELECT product_id, total_sold, order_count FROM product_sales_stats ORDER BY product_id"
+        ).all()
+        daily = connection.exec_driver_sql(
+            "SELECT product_id, quantity FROM product_sales_daily ORDER BY product_id"
+        ).all()
+        valid = connection.exec_driver_sql(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            f"WHERE c.relname = 'uq_carts_active_guest' AND c.relnamespace = '{SCHEMA}'::regnamespace"
+        ).scalar()
+    assert [tuple(row) for row in usage] == [(3, '2024-02-01')]
+    assert [tuple(row) for row in carts] == [(1, 'checked_out'), (2, 'active')]
+    assert valid is True
+    # 累計含所有訂單，每日銷量只回填最近 30 天
+    assert [tuple(row) for row in stats] == [(1, 5, 2), (2, 1, 1)]
+    assert [tuple(row) for row in daily] == [(1, 2), (2, 1)]
+
+#離線 SQL：包交易的版本用 BEGIN / COMMIT，CONCURRENTLY 不能出現在交易內
+def test_offline_sql():
+    in_transaction = False
+    for line in offline_sql().splitlines():
+        if line == "BEGIN;":
+            in_transaction = True
+        elif line == "COMMIT;":
+            in_transaction = False
+        elif "CONCURRENTLY" in line:
+            assert not in_transaction, line
+    assert offline_sql().count("INSERT INTO schema_migrations") == latest_version()
+    assert "CREATE TABLE IF NOT EXISTS categories" not in offline_sql(from_version=1)
@@ -222,4 +222,27 @@ def test_guest_cancel_order_twice(client, guest_order):
     assert resp1.status_code == 200
     # 第二次應該不能再取消
     resp2 = client.post(url, json={"email": guest_order["guest_email"]})
-    assert resp2.status_code in (400, 404)
\ No newline at end of file
+    assert resp2.status_code in (400, 404)
+def test_orders_cursor_pagination(client, user_token_and_id, shipping_info):
+    token, user_id = user_token_and_id
+    headers = {'Authorization': f'Bearer {token}'}
+    for _ in range(3):
+        client.post(f'/carts/{user_id}', json={'product_id': 1, 'quantity': 1}, headers=headers)
+        client.post(f'/carts/{user_id}/checkout',
+                    json={'items': [{'product_id': 1, 'quantity': 1}], 'shipping_info': shipping_info},
+                    headers=headers)
+
+    expected = [o['id'] for o in client.get('/orders?per_page=100', headers=headers).get_json()['orders']]
+    assert len(expected) == 3
+    ids, cursor = [], ''
+    while cursor is not None:
+        data = client.get(f'/orders?per_page=2&cursor={cursor}', headers=headers).get_json()
+        ids += [o['id'] for o in data['orders']]
+        cursor = data['next_cursor']
+    assert ids == expected
+
+    admin_headers = {'Authorization': f'Bearer {admin_token(client)}'}
+    data = client.get('/orders/all?per_page=2&cursor=', headers=admin_headers).get_json()
+    assert len(data['orders']) == 2 and data['next_cursor']
+    data = client.get(f"/orders/all?per_page=2&cursor={data['next_cursor']}", headers=admin_headers).get_json()
+    assert len(data['orders']) == 1 and data['next_cursor'] is None
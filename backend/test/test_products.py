@@ -221,3 +221,437 @@ def test_product_sale_admin_permission(client, admin_token):
     # 非 admin 不可設定特價
     res = client.post(f'/products/sale/{pid}', json=sale_body)
     assert res.status_code in (401, 403)
+
+#商品列表查詢數量固定（特價批次查詢，不會每個商品 lazy load sales）
+def test_product_list_query_count_is_constant(client, admin_token, query_counter):
+    from models import Product, ProductOnSale
+    from datetime import datetime
+    for i in range(8):
+        p = Product(title=f'QC{i}', price=100 + i, category_id=1, images=[])
+        db.session.add(p)
+        db.session.flush()
+        db.session.add(ProductOnSale(product_id=p.id, discount=0.5,
+                                     start_date=datetime(2000, 1, 1), end_date=datetime(2099, 1, 1)))
+    db.session.commit()
+    db.session.expire_all()
+
+    def count_get(url, **kwargs):
+        with query_counter() as counter:
+            res = client.get(url, **kwargs)
+        assert res.status_code == 200
+        return counter.count, res.get_json()
+
+    few, data = count_get('/products?per_page=2')
+    many, data = count_get('/products?per_page=8')
+    assert few == many
+    assert all(p['on_sale'] and p['sale_price'] == round(p['price'] * 0.5, 2) for p in data['products'])
+
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    few, _ = count_get('/products/admin?per_page=2', headers=headers)
+    many, data = count_get('/products/admin?per_page=8', headers=headers)
+    assert few == many
+    assert len(data['products']) == 8
+
+    few, _ = count_get('/products/guest/recommend?limit=2')
+    many, data = count_get('/products/guest/recommend?limit=8')
+    assert few == many
+    assert len(data) == 8
+
+#有效售價投影：新增特價後更新，價格篩選依特價後售價
+def test_product_price_projection_and_sale_price_filter(client, admin_token):
+    from models import ProductPrice, ProductOnSale
+    from datetime import datetime
+    from service.price_service import PriceService
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    res = client.post('/products', json={'title': 'PriceProj', 'price': 100, 'category_id': 1, 'images': []}, headers=headers)
+    pid = res.get_json()['product_id']
+    row = db.session.get(ProductPrice, pid)
+    assert float(row.final_price) == 100 and row.sale_id is None and row.valid_until is None
+
+    sale_body = {"discount": 0.5, "start_date": "2000-01-01T00:00:00", "end_date": "2099-12-31T23:59:59"}
+    res = client.post(f'/products/sale/{pid}', json=sale_body, headers=headers)
+    assert res.status_code == 200
+    db.session.expire_all()
+    row = db.session.get(ProductPrice, pid)
+    assert float(row.final_price) == 50
+    assert row.sale_id == res.get_json()['sale_id']
+    assert row.valid_until == datetime(2099, 12, 31, 23, 59, 59)
+
+    # 原價 100 不在 40~60，但特價 50 在
+    res = client.get('/products?min_price=40&max_price=60')
+    assert any(p['id'] == pid and p['sale_price'] == 50 for p in res.get_json()['products'])
+    res = client.get('/products?min_price=90')
+    assert not any(p['id'] == pid for p in res.get_json()['products'])
+
+    # 直接寫 ORM 新增的特價：投影會被清掉，讀取改用即時計算，refresh_due 再補回
+    db.session.add(ProductOnSale(product_id=pid, discount=0.3,
+                                 start_date=datetime(2000, 1, 1), end_date=datetime(2099, 1, 1)))
+    db.session.commit()
+    assert db.session.get(ProductPrice, pid) is None
+    assert PriceService.refresh_due() >= 1
+    row = db.session.get(ProductPrice, pid)
+    # 重疊特價取第一筆（與 get_current_sale 相同）
+    assert float(row.final_price) == 50
+    assert row.valid_until == datetime(2099, 1, 1)
+
+#全文檢索：標題與描述都能搜尋，標題命中的排前面，特殊字元不會造成錯誤
+def test_product_keyword_full_text_search(client, admin_token):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    client.post('/products', json={'title': 'Leather Wallet', 'price': 500, 'category_id': 1,
+                                   'description': 'handmade gift'}, headers=headers)
+    client.post('/products', json={'title': 'Gift Card', 'price': 300, 'category_id': 1,
+                                   'description': 'store credit'}, headers=headers)
+    client.post('/products', json={'title': '旗艦手機', 'price': 9999, 'category_id': 1,
+                                   'description': '最新款'}, headers=headers)
+
+    titles = [p['title'] for p in client.get('/products?keyword=gift').get_json()['products']]
+    assert titles == ['Gift Card', 'Leather Wallet']
+    # 前綴比對 + 多個詞
+    titles = [p['title'] for p in client.get('/products?keyword=leath wal').get_json()['products']]
+    assert titles == ['Leather Wallet']
+    # 中文子字串
+    titles = [p['title'] for p in client.get('/products?keyword=手機').get_json()['products']]
+    assert titles == ['旗艦手機']
+    # 可與分類、價格條件一起用
+    titles = [p['title'] for p in client.get('/products?keyword=gift&max_price=400&category_id=1').get_json()['products']]
+    assert titles == ['Gift Card']
+    res = client.get('/products?keyword=%25%27%26|!:*')
+    assert res.status_code == 200 and res.get_json()['products'] == []
+
+#關鍵字搜尋（含分類、價格條件、cursor 分頁）實際送出的查詢都不能退回循序掃描；沒有分類條件時要走全文檢索的 GIN 索引
+def test_product_search_uses_gin_index(app):
+    from sqlalchemy import event, text
+    from service.product_service import ProductService
+    searches = [
+        (dict(keyword='phone'), True),
+        (dict(keyword='phone case', min_price=100, max_price=400), True),
+        (dict(keyword='phone', cursor=''), True),
+        # 有分類條件時 planner 可以改走分類的索引
+        (dict(keyword='phone', category_id=1, max_price=400), False),
+    ]
+    for kwargs, uses_gin in searches:
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if "FROM products" in statement:
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            ProductService.search(**kwargs)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+        assert statements, kwargs
+
+        # 測試資料很少，planner 本來就會選循序掃描：關掉 enable_seqscan 後仍然出現 Seq Scan 代表沒有可用的索引
+        for statement, parameters in statements:
+            db.session.execute(text("SET LOCAL enable_seqscan = off"))
+            try:
+                plan = "\n".join(row[0] for row in db.session.connection().exec_driver_sql("EXPLAIN " + statement, parameters))
+            finally:
+                db.session.rollback()
+            assert 'Seq Scan' not in plan, (kwargs, plan)
+            if uses_gin:
+                assert 'ix_products_search' in plan, (kwargs, plan)
+
+def test_product_cursor_pagination(client, admin_token):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    for i in range(5):
+        client.post('/products', json={'title': f'Cursor Item {i}', 'price': 100 + i, 'category_id': 1,
+                                       'description': 'cursor test'}, headers=headers)
+
+    def walk(url):
+        titles, cursor = [], ''
+        while True:
+            data = client.get(f'{url}&per_page=2&cursor={cursor}', headers=headers).get_json()
+            assert 'total' not in data
+            titles += [p['title'] for p in data['products']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                return titles
+
+    # 游標分頁與頁碼分頁順序一致，且不重複、不遺漏
+    expected = [p['title'] for p in client.get('/products?per_page=100').get_json()['products']]
+    assert walk('/products?category_id=1') == expected
+    assert walk('/products?keyword=cursor') == [p['title'] for p in client.get('/products?keyword=cursor&per_page=100').get_json()['products']]
+    admin_ids = [p['id'] for p in client.get('/products/admin?per_page=100', headers=headers).get_json()['products']]
+    ids, cursor = [], ''
+    while cursor is not None:
+        data = client.get(f'/products/admin?per_page=3&cursor={cursor}', headers=headers).get_json()
+        ids += [p['id'] for p in data['products']]
+        cursor = data['next_cursor']
+    assert ids == admin_ids
+
+    res = client.get('/products?cursor=not-a-cursor')
+    assert res.status_code == 400
+    # 格式正確但值的型別不對（["abc","x"]、[1,2]、相關度放字串）：400，不是 500
+    from utils.pagination import encode_cursor
+    for url in ['/products?cursor=' + encode_cursor(['abc', 'x']), '/products?cursor=' + encode_cursor([1, 2]),
+                '/products?cursor=' + encode_cursor([None, 1]),
+                '/products?keyword=cursor&cursor=' + encode_cursor(['0.5', 'Cursor Item 1', 1]),
+                '/products/admin?cursor=' + encode_cursor([True])]:
+        res = client.get(url, headers=headers)
+        assert res.status_code == 400, url
+        assert res.get_json()['error'] == 'invalid cursor'
+
+@pytest.fixture(params=['SimpleCache', 'RedisCache'])
+def cache_backend(app, request):
+    """商品列表快取：本機 SimpleCache，以及用 fakeredis 當 Redis 的替身（沒裝 fakeredis 就跳過）"""
+    from cache import cache
+    if request.param == 'RedisCache':
+        fakeredis = pytest.importorskip('fakeredis')
+        from flask_caching.backends.rediscache import RedisCache
+        app.extensions['cache'][cache] = RedisCache(host=fakeredis.FakeRedis(), key_prefix='ecommerce:')
+    return cache
+
+def test_product_list_cache_targeted_invalidation(client, admin_token, query_counter, cache_backend):
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    db.session.add(Category(id=2, name='other', description='for test'))
+    db.session.commit()
+    p1 = client.post('/products', json={'title': 'Cat1 Item', 'price': 100, 'category_id': 1}, headers=headers).get_json()['product_id']
+    client.post('/products', json={'title': 'Cat2 Item', 'price': 200, 'category_id': 2}, headers=headers)
+
+    def get(url):
+        with query_counter() as counter:
+            data = client.get(url).get_json()
+        return counter.count, data
+
+    for url in ('/products?category_id=1', '/products?category_id=2', '/products'):
+        get(url)
+    assert get('/products?category_id=2')[0] == 0   # 命中快取，不查 DB
+
+    # 只改圖片：只失效含這個商品的列表
+    client.put(f'/products/{p1}', json={'images': ['https://img/new.jpg']}, headers=headers)
+    queries, data = get('/products?category_id=1')
+    assert queries > 0 and data['products'][0]['images'] == ['https://img/new.jpg']
+    assert get('/products?category_id=2')[0] == 0
+
+    # 改價格：分類 1 與不分類的列表失效，分類 2 的列表保留
+    get('/products?category_id=1')
+    client.put(f'/products/{p1}', json={'price': 150}, headers=headers)
+    queries, data = get('/products')
+    assert queries > 0 and {p['title']: p['price'] for p in data['products']}['Cat1 Item'] == 150
+    assert get('/products?category_id=1')[0] > 0
+    assert get('/products?category_id=2')[0] == 0
+
+    # 新增商品到分類 2：分類 2 與不分類的列表出現新商品
+    client.post('/products', json={'title': 'Cat2 New', 'price': 300, 'category_id': 2}, headers=headers)
+    assert 'Cat2 New' in [p['title'] for p in get('/products?category_id=2')[1]['products']]
+    assert 'Cat2 New' in [p['title'] for p in get('/products')[1]['products']]
+    assert get('/products?category_id=1')[0] == 0
+
+    # 下架：含該商品的列表失效
+    client.post(f'/products/{p1}/deactivate', headers=headers)
+    assert 'Cat1 Item' not in [p['title'] for p in get('/products')[1]['products']]
+
+def test_product_detail_cache(client, admin_token, query_counter, cache_backend):
+    import time
+    from datetime import datetime, timedelta
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    pid = client.post('/products', json={'title': 'Detail Item', 'price': 100, 'category_id': 1}, headers=headers).get_json()['product_id']
+
+    assert client.get(f'/products/{pid}').get_json()['price'] == 100
+    with query_counter() as counter:
+        assert client.get(f'/products/{pid}').status_code == 200
+    assert counter.count == 0
+
+    # 修改後失效
+    client.put(f'/products/{pid}', json={'price': 120}, headers=headers)
+    assert client.get(f'/products/{pid}').get_json()['price'] == 120
+
+    # TTL 不超過下一次特價開始：特價 2 秒後開始，快取過期後就會看到特價
+    start = datetime.now() + timedelta(seconds=2)
+    sale_body = {"discount": 0.5, "start_date": start.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "end_date": (start + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S")}
+    client.post(f'/products/sale/{pid}', json=sale_body, headers=headers)
+    assert client.get(f'/products/{pid}').get_json()['on_sale'] is False
+    time.sleep((start - datetime.now()).total_seconds() + 1.1)
+    data = client.get(f'/products/{pid}').get_json()
+    assert data['on_sale'] is True and data['sale_price'] == 60
+
+    # 下架後查不到
+    client.post(f'/products/{pid}/deactivate', headers=headers)
+    assert client.get(f'/products/{pid}').status_code == 404
+
+    stats = client.get('/products/cache/stats', headers=headers).get_json()['product_detail']
+    assert stats['hits'] == 1 and stats['misses'] == 5
+
+#命中率計數器不過期：超過 CACHE_DEFAULT_TIMEOUT、快取項目超過 SimpleCache 的 threshold 都不會歸零
+def test_cache_stats_do_not_expire(app, cache_backend, monkeypatch):
+    import time
+    import cachelib.simple
+    from cache import record_hit, record_event, get_stats
+    record_hit("stats_test", True)
+    record_hit("stats_test", False)
+    later = time.time() + app.config["CACHE_DEFAULT_TIMEOUT"] + 60
+    monkeypatch.setattr(cachelib.simple, "time", lambda: later)
+    for i in range(600):
+        cache_backend.set(f"filler:{i}", i)
+    record_hit("stats_test", True)
+    record_event("stats_test", "stale")
+    assert get_stats("stats_test", "stale") == {"hits": 2, "misses": 1, "hit_rate": 0.6667, "stale": 1}
+
+#特價通知 fan-out：一次查出收件人、去重、LINE multicast 分批，不在 admin 請求內寄送
+def test_product_sale_notification_fanout(client, admin_token, monkeypatch, query_counter):
+    from models import Cart, CartItem, NotificationJob, EmailOutbox
+    from service.notification_service import NotificationService
+    import service.notification_service as notification_service
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    pid = client.post('/products', json={'title': 'Fanout', 'price': 100, 'category_id': 1, 'images': []},
+                      headers=headers).get_json()['product_id']
+    users = [User(email=f'fan{i}@example.com', password='x', line_user_id=f'U{i}' if i % 2 == 0 else None) for i in range(6)]
+    db.session.add_all(users)
+    db.session.flush()
+    for user in users:
+        cart = Cart(user_id=user.id, status='active')
+        db.session.add(cart)
+        db.session.flush()
+        db.session.add(CartItem(cart_id=cart.id, product_id=pid, quantity=1))
+    # 已結帳的購物車、訪客購物車不通知（每個會員只會有一台 active 購物車，見 uq_carts_active_user）
+    for cart in (Cart(user_id=users[0].id, status='checked_out'), Cart(guest_id='guest-fanout', status='active')):
+        db.session.add(cart)
+        db.session.flush()
+        db.session.add(CartItem(cart_id=cart.id, product_id=pid, quantity=1))
+    db.session.commit()
+
+    emails, multicasts = [], []
+    monkeypatch.setattr('service.email_service.send_email_batch', lambda to, subject, html: emails.append(sorted(to)))
+    monkeypatch.setattr('utils.notify_util.multicast_message', lambda ids, msg: multicasts.append(list(ids)))
+    monkeypatch.setattr(notification_service, 'LINE_MULTICAST_LIMIT', 2)
+
+    sale_body = {"discount": 0.5, "start_date": "2024-01-01T00:00:00", "end_date": "2099-12-31T23:59:59"}
+    res = client.post(f'/products/sale/{pid}', json=sale_body, headers=headers)
+    assert res.status_code == 200
+    assert emails == [] and multicasts == []
+    assert [job.kind for job in NotificationJob.query.all()] == ['product_on_sale']
+
+    with query_counter() as counter:
+        NotificationService.run_pending()
+    # 收件人一次 join 查詢，不隨購物車數量產生 N+1
+    assert counter.count <= 8
+    assert sorted(job.kind for job in NotificationJob.query.all()) == ['product_on_sale_email'] + ['product_on_sale_line'] * 2
+
+    NotificationService.run_pending()
+    assert emails == [sorted(u.email for u in users)]
+    assert sorted(sum(multicasts, [])) == ['U0', 'U2', 'U4'] and all(len(ids) <= 2 for ids in multicasts)
+    assert NotificationJob.query.count() == 0
+    assert EmailOutbox.query.filter_by(status='sent').count() == len(users)
+
+    # 修正特價（開始時間相同、折扣不同）是另一筆特價，要再通知一次
+    res = client.post(f'/products/sale/{pid}', json={**sale_body, "discount": 0.4}, headers=headers)
+    assert res.status_code == 200
+    NotificationService.run_pending()
+    NotificationService.run_pending()
+    assert emails == [sorted(u.email for u in users)] * 2
+    assert EmailOutbox.query.filter_by(status='sent').count() == 2 * len(users)
+
+#熱賣排行：結帳時累加，排行只含上架商品；近 7 天排行只看視窗內的銷量；rebuild 與累加結果一致
+def test_top_products_leaderboard(client, admin_token):
+    from models import Order, OrderItem, ProductSalesStat
+    from datetime import datetime, timedelta
+    from service.cart_service import CartService
+    from service.sales_rank_service import SalesRankService
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    a, b, c, d = [
+        client.post('/products', json={'title': f'Top{t}', 'price': 100, 'category_id': 1, 'images': []},
+                    headers=headers).get_json()['product_id']
+        for t in 'ABCD'
+    ]
+    for guest_id, items in (('guest-top-1', [(a, 3), (b, 1)]), ('guest-top-2', [(b, 1), (d, 5)])):
+        for product_id, quantity in items:
+            CartService.add_to_cart(guest_id=guest_id, product_id=product_id, quantity=quantity)
+        CartService.checkout_cart([{'product_id': pid, 'quantity': qty} for pid, qty in items], guest_id=guest_id)
+
+    def top(query):
+        res = client.get(f'/products/guest/recommend?{query}')
+        assert res.status_code == 200
+        return [p['id'] for p in res.get_json()]
+
+    assert top('limit=3') == [d, a, b]
+    client.post(f'/products/{d}/deactivate', headers=headers)
+    # 下架商品不列入；賣出的不足 limit 時用沒賣過的上架商品補
+    assert top('limit=3') == [a, b, c]
+
+    incremental = {row.product_id: row.total_sold for row in ProductSalesStat.query.all()}
+    assert incremental == {a: 3, b: 2, d: 5}
+
+    # 60 天前的舊訂單（不經過結帳）→ rebuild 後計入累計，但不在近 7 天排行
+    order = Order(guest_id='guest-top-old', order_date=datetime.now() - timedelta(days=60), total=0, status='paid')
+    db.session.add(order)
+    db.session.flush()
+    db.session.add(OrderItem(order_id=order.id, product_id=c, quantity=10, price=100))
+    db.session.commit()
+    SalesRankService.rebuild()
+    db.session.expire_all()
+    assert {row.product_id: row.total_sold for row in ProductSalesStat.query.all()} == {**incremental, c: 10}
+    assert top('limit=2') == [c, a]
+    assert top('limit=2&days=7') == [a, b]
+    assert top('limit=3&days=30') == [a, b, c]
+    assert client.get('/products/guest/recommend?days=5').status_code == 400
+
+#分類熱門排行：快取 + 合併後的推薦順序與原本即時彙總 order_items 的結果相同（含快取清單不夠用時查資料庫）
+def test_category_popularity_matches_live_ranking(client, admin_token, monkeypatch, query_counter):
+    from models import Product, OrderItem
+    from service.cart_service import CartService
+    from service.product_service import ProductService
+    import service.sales_rank_service as sales_rank_service
+    db.session.add(Category(id=2, name='second', description='for test'))
+    db.session.commit()
+    products = []
+    for i in range(12):
+        p = Product(title=f'Pop{i}', price=100, category_id=1 + i % 2, images=[])
+        db.session.add(p)
+        products.append(p)
+    db.session.commit()
+    user = User(email='popular@example.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    # 各商品賣出不同筆數（有同筆數、有沒賣過的）
+    for n, p in enumerate(products[:9]):
+        for j in range(n % 4):
+            guest_id = f'guest-pop-{n}-{j}'
+            CartService.add_to_cart(guest_id=guest_id, product_id=p.id, quantity=3)
+            CartService.checkout_cart([{'product_id': p.id, 'quantity': 3}], guest_id=guest_id)
+    CartService.add_to_cart(user_id=user.id, product_id=products[1].id, quantity=1)
+    CartService.checkout_cart([{'product_id': products[1].id, 'quantity': 1}], user_id=user.id)
+    products[6].is_active = False
+    db.session.commit()
+
+    def live(category_ids, exclude_ids, limit):
+        """改版前的即時排行"""
+        subq = (
+            db.session.query(OrderItem.product_id, db.func.count(OrderItem.id).label('order_count'))
+            .group_by(OrderItem.product_id).subquery()
+        )
+        return [
+            p.id for p in db.session.query(Product)
+            .outerjoin(subq, Product.id == subq.c.product_id)
+            .filter(Product.category_id.in_(category_ids), ~Product.id.in_(exclude_ids), Product.is_active == True)
+            .order_by(subq.c.order_count.desc().nullslast(), Product.id.desc())
+            .limit(limit).all()
+        ]
+
+    # 會員買過分類 2 的商品 → 推薦分類 2 沒買過的商品
+    for limit in (1, 3, 10):
+        assert [p.id for p in ProductService.recommend_for_user(user.id, limit)] == live([2], [products[1].id], limit)
+    # 快取命中後不再彙總 order_items
+    with query_counter() as counter:
+        ProductService.recommend_for_user(user.id, 3)
+    assert counter.count <= 3
+
+    # 購物車含兩個分類：合併兩個分類的排行；快取清單只放 2 名時，被排除到不夠用就查資料庫
+    CartService.add_to_cart(user_id=user.id, product_id=products[0].id, quantity=1)
+    CartService.add_to_cart(user_id=user.id, product_id=products[5].id, quantity=1)
+    cart_ids = [products[0].id, products[5].id]
+    for pool in (200, 2):
+        monkeypatch.setattr(sales_rank_service, 'POPULAR_POOL_SIZE', pool)
+        sales_rank_service.SalesRankService.invalidate_popular([1, 2])
+        for limit in (2, 5, 12):
+            assert [p.id for p in ProductService.recommend_for_cart(user.id, limit)] == live([1, 2], cart_ids, limit)
+
+    # 結帳後排行立即反映
+    for j in range(4):
+        CartService.add_to_cart(guest_id=f'guest-pop-late-{j}', product_id=products[11].id, quantity=1)
+        CartService.checkout_cart([{'product_id': products[11].id, 'quantity': 1}], guest_id=f'guest-pop-late-{j}')
+    assert [p.id for p in ProductService.recommend_for_cart(user.id, 5)] == live([1, 2], cart_ids, 5)
+    assert ProductService.recommend_for_cart(user.id, 1)[0].id == products[11].id
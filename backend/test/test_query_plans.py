@@ -0,0 +1,95 @@
+import pytest
+import sys
+import os
+from datetime import datetime
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from models import db, Cart, User
+from service.cart_service import CartService
+from service.order_service import OrderService
+from utils import notify_util
+
+def _explain(query, parameters=None):
+    """
+    回傳 query（ORM 查詢，或攔截到的 SQL 字串 + 參數）的執行計畫（文字）
+    測試資料很少，planner 本來就會選循序掃描：關掉 enable_seqscan 後仍然出現 Seq Scan 代表沒有可用的索引
+    """
+    if isinstance(query, str):
+        sql = query
+    else:
+        statement = query.statement if hasattr(query, "statement") else query
+        sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+    db.session.execute(text("SET LOCAL enable_seqscan = off"))
+    try:
+        return "\n".join(row[0] for row in db.session.connection().exec_driver_sql("EXPLAIN " + sql, parameters))
+    finally:
+        db.session.rollback()
+
+def _captured(call):
+    """執行 call，回傳它送出的 SELECT [(SQL, 參數)]（沒有資料時 service 會丟 NotFoundError / ValueError，查詢已經送出）"""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        call()
+    except ValueError:
+        pass
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture)
+    return statements
+
+#購物車、訂單的熱門查詢都要走索引，新查詢不能悄悄退回循序掃描
+#檢查的是 service 實際用的查詢（共用的查詢 helper，或攔截 service 送出的 SQL），不是另外手抄的版本
+@pytest.mark.parametrize("name", [
+    "active_cart_user", "active_cart_guest", "cart_item", "onsale_recipients",
+])
+def test_hot_queries_use_indexes(app, name):
+    queries = {
+        "active_cart_user": lambda: CartService._active_cart_query(user_id=1),
+        "active_cart_guest": lambda: CartService._active_cart_query(guest_id='g'),
+        "cart_item": lambda: CartService._cart_item_query(1, 1),
+        "onsale_recipients": lambda: notify_util._product_on_sale_recipients_query(1),
+    }
+    plan = _explain(queries[name]())
+    assert "Seq Scan" not in plan, plan
+
+@pytest.mark.parametrize("name", [
+    "cart_user", "cart_guest", "checkout_cart", "orders_user", "orders_user_cursor", "order_detail", "order_detail_guest",
+])
+def test_hot_service_queries_use_indexes(app, name):
+    calls = {
+        # 購物車連同明細、商品一次載入（join cart_items 要走 cart_id 的索引）
+        "cart_user": lambda: CartService.get_cart(user_id=1),
+        "cart_guest": lambda: CartService.get_cart(guest_id='g'),
+        "checkout_cart": lambda: CartService._get_active_cart(guest_id='g'),
+        "orders_user": lambda: OrderService.get_user_orders(1),
+        "orders_user_cursor": lambda: OrderService.get_user_orders(1, cursor=''),
+        "order_detail": lambda: OrderService.get_order_detail(1),
+        "order_detail_guest": lambda: OrderService.get_order_detail_guest(1, 'g', 'guest@example.com'),
+    }
+    statements = _captured(calls[name])
+    assert statements
+    for statement, parameters in statements:
+        plan = _explain(statement, parameters)
+        assert "Seq Scan" not in plan, (statement, plan)
+
+#每個會員 / 訪客只能有一台 active 購物車；已結帳的不受限制
+def test_one_active_cart_per_owner(app):
+    user = User(email='cartowner@test.com', password='x')
+    db.session.add(user)
+    db.session.commit()
+    for owner in ({"user_id": user.id}, {"guest_id": "guest-one-cart"}):
+        cart = CartService._get_or_create_active_cart(**owner)
+        assert CartService._get_or_create_active_cart(**owner).id == cart.id
+        db.session.add(Cart(created_at=datetime.now(), status='checked_out', **owner))
+        db.session.commit()
+        db.session.add(Cart(created_at=datetime.now(), status='active', **owner))
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
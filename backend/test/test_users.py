@@ -178,3 +178,15 @@ def test_recommend_for_user_auto_fill_with_hot_products(client, new_user, admin_
 
     # 應不重複
     assert len(returned_titles) == 3
+
+def test_get_all_users_cursor(client, admin_token, new_user):
+    for i in range(3):
+        new_user(f"cursor{i}@example.com")
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    expected = [u['id'] for u in client.get('/users/all?per_page=100', headers=headers).get_json()['users']]
+    ids, cursor = [], ''
+    while cursor is not None:
+        data = client.get(f'/users/all?per_page=2&cursor={cursor}', headers=headers).get_json()
+        ids += [u['id'] for u in data['users']]
+        cursor = data['next_cursor']
+    assert ids == expected
@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# 第三方 HTTP API（LINE、SendGrid）共用的 client 基底：每個 process 共用一個，底層是 keep-alive 的 requests.Session 連線池
+# - 逾時：(連線, 讀取) 秒數可設定，不會卡住 worker
+# - 重試：429 / 5xx / 連線錯誤以指數退避 + jitter 重試，429 依 Retry-After
+# - 限流：token bucket 控制每秒送出的請求數
+# - 統計：請求數、失敗數、重試數、限流等待、延遲
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class HttpApiError(Exception):
+    def __init__(self, service, status_code, body):
+        super().__init__(f"{service} {status_code}: {body}")
+        self.status_code = status_code
+        self.body = body
+
+class TokenBucket:
+    """每秒補 rate 個 token，最多存 burst 個；拿不到就等到有為止"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """回傳等待的秒數"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1  # 先預約，不夠的部分用等待補
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class PooledHttpClient:
+    service_name = "HTTP API"
+    error_class = HttpApiError
+
+    def __init__(self, base_url, headers=None, connect_timeout=3, read_timeout=10,
+                 max_retries=3, backoff=0.5, rate_limit=None, pool_size=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(headers or {})
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "failures": 0, "retries": 0, "throttled_seconds": 0.0,
+                       "latency_ms_total": 0.0, "latency_ms_max": 0.0}
+
+    def post(self, path, body, headers=None):
+        """送出請求，成功回傳 response JSON（沒有內容回傳 {}），失敗丟 error_class / requests 例外"""
+        url = self.base_url + path
+        for attempt in range(self.max_retries + 1):
+            if self.limiter:
+                waited = self.limiter.acquire()
+                if waited:
+                    self._record(throttled_seconds=waited)
+            start = time.perf_counter()
+            try:
+                res = self.session.post(url, json=body, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record_request(start, failed=True)
+                if attempt == self.max_retries:
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
+            ok = self._is_success(res, attempt, headers)
+            self._record_request(start, failed=not ok)
+            if ok:
+                return res.json() if res.content and "json" in res.headers.get("Content-Type", "") else {}
+            if res.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                raise self.error_class(self.service_name, res.status_code, res.text)
+            self._sleep_before_retry(attempt, res.headers.get("Retry-After"))
+
+    def _is_success(self, res, attempt, headers):
+        return res.status_code < 300
+
+    def _sleep_before_retry(self, attempt, retry_after=None):
+        self._record(retries=1)
+        if retry_after and retry_after.isdigit():
+            delay = float(retry_after)
+        else:
+            # full jitter：0 ~ backoff * 2^attempt，多個 worker 同時失敗時不會一起重打
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+        time.sleep(delay)
+
+    # ---- 統計 ----
+    def _record_request(self, start, failed):
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._stats["failures"] += int(failed)
+            self._stats["latency_ms_total"] += elapsed
+            self._stats["latency_ms_max"] = max(self._stats["latency_ms_max"], elapsed)
+
+    def _record(self, **values):
+        with self._stats_lock:
+            for key, value in values.items():
+                self._stats[key] += value
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        total = stats.pop("latency_ms_total")
+        stats["latency_ms_avg"] = round(total / stats["requests"], 2) if stats["requests"] else 0.0
+        stats["latency_ms_max"] = round(stats["latency_ms_max"], 2)
+        stats["throttled_seconds"] = round(stats["throttled_seconds"], 3)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+def current_config():
+    """Flask app context 內用 current_app.config，純 script 執行時用 config["default"]"""
+    try:
+        from flask import current_app
+        return current_app.config
+    except RuntimeError:
+        from config import config as config_map
+        default = config_map["default"]
+        return {key: getattr(default, key) for key in dir(default) if key.isupper()}
@@ -1,30 +1,31 @@
-from flask import current_app
-from linebot import LineBotApi
 from linebot.models import TextSendMessage, FlexSendMessage
+from utils.line_client import get_line_client
 
-def get_line_bot_api():
-    """動態抓 LINE access token，支援 Flask context 或純 script 執行"""
-    try:
-        token = current_app.config["LINE_CHANNEL_ACCESS_TOKEN"]
-    except RuntimeError:
-        from config import config
-        token = config["default"].LINE_CHANNEL_ACCESS_TOKEN
-    return LineBotApi(token)
+# 推播都走同一個長駐的 LineClient（連線池 + 逾時 + 重試 + 限流），不再每次推播都建一個新的 LineBotApi
 
 def push_message(user_id, message):
-    line_bot_api = get_line_bot_api()
     try:
-        line_bot_api.push_message(user_id, TextSendMessage(text=message))
+        get_line_client().push(user_id, TextSendMessage(text=message))
         return True
     except Exception as e:
         print("Line推播失敗:", e)
         return False
 
+LINE_MULTICAST_LIMIT = 500  # LINE multicast 一次最多 500 個 user id
+
+def multicast_message(user_ids, message):
+    """同一則文字訊息一次推給多位用戶（呼叫端負責切成每批 LINE_MULTICAST_LIMIT 人以內）"""
+    try:
+        get_line_client().multicast(user_ids, TextSendMessage(text=message))
+        return True
+    except Exception as e:
+        print("Line multicast 失敗:", e)
+        return False
+
 def push_flex_message(user_id, flex_content, alt_text="商品列表"):
-    line_bot_api = get_line_bot_api()
     try:
         message = FlexSendMessage(alt_text=alt_text, contents=flex_content)
-        line_bot_api.push_message(user_id, message)
+        get_line_client().push(user_id, message)
         return True
     except Exception as e:
         print("Line推播失敗(Flex):", e)
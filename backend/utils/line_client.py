@@ -0,0 +1,79 @@
+import os
+import threading
+import uuid
+from utils.http_client import PooledHttpClient, HttpApiError, current_config
+
+# LINE Messaging API client：連線池、逾時、重試、限流、統計見 PooledHttpClient
+# 推播帶 X-Line-Retry-Key，LINE 端收到重複的 key 不會重送，重試不會讓用戶收到兩次
+
+class LineApiError(HttpApiError):
+    pass
+
+class LineClient(PooledHttpClient):
+    service_name = "LINE API"
+    error_class = LineApiError
+
+    def __init__(self, access_token, base_url="https://api.line.me", rate_limit=100, **kwargs):
+        super().__init__(
+            base_url,
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+            rate_limit=rate_limit,
+            **kwargs,
+        )
+        self.access_token = access_token
+        self.pid = os.getpid()
+
+    # ---- Messaging API ----
+    def push(self, to, messages):
+        return self.post("/v2/bot/message/push", {"to": to, "messages": _to_json(messages)}, idempotent=True)
+
+    def multicast(self, to, messages):
+        return self.post("/v2/bot/message/multicast", {"to": list(to), "messages": _to_json(messages)}, idempotent=True)
+
+    def reply(self, reply_token, messages):
+        return self.post("/v2/bot/message/reply", {"replyToken": reply_token, "messages": _to_json(messages)})
+
+    def post(self, path, body, idempotent=False):
+        """idempotent=True 時帶 X-Line-Retry-Key（同一次呼叫的每次重試共用），LINE 會擋掉重複的請求"""
+        headers = {"X-Line-Retry-Key": str(uuid.uuid4())} if idempotent else None
+        return super().post(path, body, headers=headers)
+
+    def _is_success(self, res, attempt, headers):
+        # 409：同一個 retry key 已經成功送出過（前一次其實有送到），視為成功
+        if headers and attempt > 0 and res.status_code == 409:
+            return True
+        return super()._is_success(res, attempt, headers)
+
+def _to_json(messages):
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    return [m.as_json_dict() if hasattr(m, "as_json_dict") else m for m in messages]
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_line_client():
+    """
+    取得目前 process 的 LINE client（第一次使用才建立）
+    gunicorn fork 後 pid 不同會重新建立，不沿用 master 的連線；token / base url 改了也會重建
+    """
+    global _client
+    config = current_config()
+    token = config.get("LINE_CHANNEL_ACCESS_TOKEN")
+    base_url = config.get("LINE_API_BASE_URL", "https://api.line.me")
+    with _client_lock:
+        if (_client is None or _client.pid != os.getpid()
+                or _client.access_token != token or _client.base_url != base_url.rstrip("/")):
+            if _client is not None and _client.pid == os.getpid():
+                _client.close()
+            _client = LineClient(
+                token,
+                base_url=base_url,
+                connect_timeout=config.get("LINE_CONNECT_TIMEOUT", 3),
+                read_timeout=config.get("LINE_READ_TIMEOUT", 10),
+                max_retries=config.get("LINE_MAX_RETRIES", 3),
+                rate_limit=config.get("LINE_RATE_LIMIT", 100),
+                pool_size=config.get("LINE_POOL_SIZE", 10),
+            )
+        return _client
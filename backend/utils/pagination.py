@@ -0,0 +1,81 @@
+# utils/pagination.py
+# Keyset（cursor）分頁：不做 COUNT(*)、不用 OFFSET，深頁也只是一次索引範圍掃描
+#   page = keyset_paginate(query, [Order.order_date, Order.id], cursor=request.args.get('cursor'), per_page=10)
+#   page.items / page.next_cursor（None 表示沒有下一頁）
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import tuple_
+
+
+class KeysetPage:
+    def __init__(self, items, per_page, next_cursor):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(values):
+    """排序欄位值 -> 網址安全的字串（datetime 以 ISO 格式保存）"""
+    payload = [{"dt": v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, types):
+    """
+    encode_cursor 的反向；types 是各排序欄位的 Python 型別（None 表示不檢查）
+    值的型別對不上（被竄改的 cursor）一律 ValueError，不讓它進到 SQL 的 tuple 比較
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw.decode("utf-8"))
+        if not isinstance(payload, list) or len(payload) != len(types):
+            raise ValueError
+        return [_coerce(value, python_type) for value, python_type in zip(payload, types)]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError("invalid cursor")
+
+
+def _coerce(value, python_type):
+    if python_type is datetime:
+        return datetime.fromisoformat(value["dt"])
+    if isinstance(value, (dict, list)) or value is None or isinstance(value, bool):
+        raise ValueError
+    if python_type is None or isinstance(value, python_type):
+        return value
+    # JSON 沒有分 int / float：整數的相關度（如 0）會以 int 回來
+    if python_type is float and isinstance(value, int):
+        return float(value)
+    raise ValueError
+
+
+def _python_type(key):
+    try:
+        return key.type.python_type
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+def keyset_paginate(query, keys, cursor=None, per_page=10, descending=True):
+    """
+    依 keys 排序取一頁（query 不要先 order_by）
+    - keys：排序欄位/運算式，最後一個必須唯一（通常是 id），且方向一致，(k1, k2, ...) 上最好有索引
+    - cursor：上一頁回傳的 next_cursor；空字串或 None 代表第一頁
+    多取一筆判斷是否還有下一頁
+    """
+    per_page = max(per_page, 1)
+    if cursor:
+        values = decode_cursor(cursor, [_python_type(key) for key in keys])
+        if descending:
+            query = query.filter(tuple_(*keys) < tuple_(*values))
+        else:
+            query = query.filter(tuple_(*keys) > tuple_(*values))
+    order_by = [key.desc() for key in keys] if descending else [key.asc() for key in keys]
+    rows = query.add_columns(*keys).order_by(*order_by).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(list(rows[-1][1:]))
+    return KeysetPage([row[0] for row in rows], per_page, next_cursor)
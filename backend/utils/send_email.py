@@ -1,8 +1,8 @@
 import os
-import os
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-from flask import current_app
+import threading
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from sendgrid.helpers.mail import Mail, Personalization, To
+from utils.http_client import PooledHttpClient, HttpApiError, current_config
 
 # def send_email_resend(to_email, subject, html_content):
 #     # 盡量用 current_app 拿 config，沒有就 fallback config["default"]
@@ -21,22 +21,80 @@ from flask import current_app
 #     })
 #     return response
 
+# 信件範本（templates/email/*.html）在 import 時編譯一次，之後每封信只做 render
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates", "email")
+_env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(["html"]), trim_blocks=True)
+EMAIL_TEMPLATES = {
+    name: _env.get_template(f"{name}.html")
+    for name in ("order_created", "order_status", "product_on_sale")
+}
+
+def render_email(name, **context):
+    """回傳 (subject, html)；subject 由範本內的 {% set subject = ... %} 決定"""
+    module = EMAIL_TEMPLATES[name].make_module(context)
+    return module.subject, str(module).strip()
+
+
+class SendGridError(HttpApiError):
+    pass
+
+class SendGridClient(PooledHttpClient):
+    """SendGrid v3 mail/send client：連線池、逾時、重試、統計見 PooledHttpClient"""
+    service_name = "SendGrid"
+    error_class = SendGridError
+
+    def __init__(self, api_key, base_url="https://api.sendgrid.com", **kwargs):
+        super().__init__(
+            base_url,
+            headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+            **kwargs,
+        )
+        self.api_key = api_key
+        self.pid = os.getpid()
+
+    def send(self, mail):
+        return self.post("/v3/mail/send", mail.get() if isinstance(mail, Mail) else mail)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_email_client():
+    """每個 process 共用一個 SendGrid client（fork 後或金鑰 / base url 改了會重建）"""
+    global _client
+    config = current_config()
+    api_key = config.get("SENDGRID_API_KEY")
+    base_url = config.get("SENDGRID_API_BASE_URL", "https://api.sendgrid.com")
+    with _client_lock:
+        if (_client is None or _client.pid != os.getpid()
+                or _client.api_key != api_key or _client.base_url != base_url.rstrip("/")):
+            if _client is not None and _client.pid == os.getpid():
+                _client.close()
+            _client = SendGridClient(
+                api_key,
+                base_url=base_url,
+                connect_timeout=config.get("SENDGRID_CONNECT_TIMEOUT", 3),
+                read_timeout=config.get("SENDGRID_READ_TIMEOUT", 10),
+                max_retries=config.get("SENDGRID_MAX_RETRIES", 3),
+                pool_size=config.get("SENDGRID_POOL_SIZE", 10),
+            )
+        return _client
+
+
+EMAIL_BATCH_LIMIT = 1000  # SendGrid 一次請求最多 1000 個 personalizations
+
+def build_mail(to_emails, subject, html_content):
+    """同一封信寄給多位收件人：每人一個 personalization（收件人彼此看不到）"""
+    message = Mail(from_email=current_config().get("LINEBOT_ADMIN_EMAIL"),  # SendGrid 後台必須認證過
+                   subject=subject, html_content=html_content)
+    for to_email in to_emails:
+        personalization = Personalization()
+        personalization.add_to(To(to_email))
+        message.add_personalization(personalization)
+    return message
+
 def send_email(to_email, subject, html_content):
-    try:
-        sendgrid_api_key = current_app.config["SENDGRID_API_KEY"]
-        from_email = current_app.config["LINEBOT_ADMIN_EMAIL"]
-    except RuntimeError:
-        from config import config
-        sendgrid_api_key = config["default"].SENDGRID_API_KEY
-        from_email = config["default"].LINEBOT_ADMIN_EMAIL
-
-    message = Mail(
-        from_email=from_email,  # SendGrid 後台必須認證過
-        to_emails=to_email,
-        subject=subject,
-        html_content=html_content,
-    )
-    sg = SendGridAPIClient(sendgrid_api_key)
-    response = sg.send(message)
-    print("SendGrid response:", response.status_code)
-    return response
\ No newline at end of file
+    return get_email_client().send(build_mail([to_email], subject, html_content))
+
+def send_email_batch(to_emails, subject, html_content):
+    """一次請求寄給整批收件人，呼叫端負責切成每批 EMAIL_BATCH_LIMIT 人以內"""
+    return get_email_client().send(build_mail(to_emails, subject, html_content))